@@ -0,0 +1,132 @@
+import numpy as np
+import xarray as xr
+from land import cell_chunks, cell_class_values, class_index, region_totals
+
+# Years for the carbon stock of newly converted land to level off. Classes
+# which are not listed keep sequestering at a constant rate per hectare. This
+# includes Peatland, as restored peat keeps accumulating carbon at a roughly
+# steady rate well beyond the model horizon, so its stock stays linear
+carbon_maturity = {"Broadleaf woodland":80,
+                   "Coniferous woodland":40,
+                   "Agroforestry":40,
+                   "Silvopasture":40}
+
+# Shape parameter of the Chapman-Richards growth curves
+carbon_curve_shape = 3
+
+def growth_curve(ages, seq_ha_yr, maturity=None, shape=carbon_curve_shape):
+    """Carbon stock per hectare of land converted a number of years ago.
+
+    Uses a Chapman-Richards curve, S * (1 - exp(-k * age))**shape, with the
+    maximum stock S = seq_ha_yr * maturity and k = shape / maturity, so the
+    stock levels off after the maturity age. Without a maturity age the stock
+    grows linearly at seq_ha_yr.
+
+    Parameters
+    ----------
+    ages : array_like
+        Years since conversion. Non positive ages have no stock.
+    seq_ha_yr : float
+        Mean sequestration rate per hectare until maturity.
+    maturity : float, optional
+        Age at which the stock levels off.
+    shape : float
+        Shape parameter of the curve.
+
+    Returns
+    -------
+    stock : numpy.ndarray
+        Carbon stock per hectare at each age.
+    """
+
+    ages = np.maximum(np.asarray(ages, dtype=float), 0)
+
+    if maturity is None:
+        return seq_ha_yr * ages
+
+    k = shape / maturity
+    return seq_ha_yr * maturity * (1 - np.exp(-k * ages))**shape
+
+def cohort_stock(adoption, seq_ha_yr, maturity=None):
+    """Carbon stock per hectare of converted land on each year of the
+    adoption curve.
+
+    Land is converted following the adoption curve, so the area converted on
+    each year forms a cohort with its own age. Land converted in a given year
+    sequesters carbon from that same year.
+
+    Parameters
+    ----------
+    adoption : xarray.DataArray
+        Adoption of the land use change, with a Year dimension on consecutive
+        years.
+    seq_ha_yr : float
+        Mean sequestration rate per hectare until maturity.
+    maturity : float, optional
+        Age at which the stock levels off.
+
+    Returns
+    -------
+    stock : xarray.DataArray
+        Stock per hectare of the final converted area, on each year.
+    """
+
+    years = adoption.Year.values
+    planted = np.diff(adoption.values, prepend=0)
+    ages = years[:, None] - years[None, :] + 1
+    stock = growth_curve(ages, seq_ha_yr, maturity) @ planted
+
+    return xr.DataArray(stock, dims="Year", coords={"Year":years})
+
+def carbon_sequestration(state, classes, seq_ha_yr, adoption, years):
+    """Computes the annual sequestration of a set of land classes, with the
+    land converted into each class following a growth curve.
+
+    This is an aggregate cohort model, not a per-cell one. The area gained by
+    each class is summed over the valid cells into a national total, and that
+    total is aged in yearly cohorts along the land adoption curve, using the
+    growth curve of its class. Every cell shares the same adoption curve, so
+    the cohorts of the national total match those of the individual cells.
+    Land which already had the class in the baseline map keeps sequestering
+    at a constant rate, ramped up by the adoption curve.
+
+    Parameters
+    ----------
+    state : dict
+        The land state.
+    classes : list
+        Land classes to compute.
+    seq_ha_yr : list
+        Mean sequestration rate per hectare of each class.
+    adoption : xarray.DataArray
+        Adoption of the land use changes, with a Year dimension on consecutive
+        years.
+    years : array_like
+        Years at which to return the sequestration.
+
+    Returns
+    -------
+    sequestration : xarray.DataArray
+        Annual sequestration, with dimensions aggregate_class and Year.
+    """
+
+    years = np.atleast_1d(years)
+    adoption = adoption.sel(Year=adoption.Year <= years.max())
+
+    index = class_index(state, classes)
+    gained = np.zeros(len(classes))
+    for chunk in cell_chunks(len(state["cells"])):
+        cells = np.arange(chunk.start, chunk.stop)
+        current = cell_class_values(state, index, cells)
+        gained += np.clip(current - state["cells"][chunk][:, index], 0, None).sum(axis=0)
+    retained = region_totals(state)[:, index].sum(axis=0) - gained
+
+    ramp = adoption.sel(Year=years).values
+    out = np.zeros((len(classes), len(years)))
+    for i, (land_class, seq) in enumerate(zip(classes, seq_ha_yr)):
+        stock = cohort_stock(adoption, seq, carbon_maturity.get(land_class))
+        rate = stock.copy(data=np.diff(stock.values, prepend=0))
+        out[i] = retained[i] * seq * ramp + gained[i] * rate.sel(Year=years).values
+
+    return xr.DataArray(out, dims=("aggregate_class", "Year"),
+                        coords={"aggregate_class":list(classes), "Year":years})
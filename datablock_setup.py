@@ -2,17 +2,52 @@ import numpy as np
 import xarray as xr
 import streamlit as st
 import copy
+from importlib import metadata
+
+from land import land_state, land_class_totals, land_ranking, land_zones, land_pyramid, \
+    copy_land_state
+from grouping import item_memberships
+from glossary import new_land_classes
 
 from agrifoodpy.impact.model import fbs_impacts, fair_co2_only
 from agrifoodpy.pipeline import Pipeline
 
+def baseline_version():
+    """Returns a string identifying the versions of the baseline data and
+    model packages, so that results computed with other versions are not
+    reused."""
+
+    versions = []
+    for package in ["agrifoodpy", "agrifoodpy_data"]:
+        try:
+            versions.append(f"{package} {metadata.version(package)}")
+        except metadata.PackageNotFoundError:
+            versions.append(f"{package} unknown")
+
+    return ", ".join(versions)
+
+def datablock_setup(horizon=2050):
+    """Returns the baseline datablock.
+
+    The food, impact and population data are cached by food_datablock_setup,
+    which returns a new copy on every call. The land data is built once per
+    process by land_setup and shared by every datablock, each of which gets
+    its own copy of the land state with copy_land_state. Cell level arrays
+    are never modified by land use changes, so they are not copied.
+    """
+
+    datablock = food_datablock_setup(horizon)
+
+    land = land_setup()
+    datablock["land"] = {**land, "state":copy_land_state(land["state"])}
+
+    return datablock
+
 @st.cache_data(ttl=60*60*24)
-def datablock_setup():
+def food_datablock_setup(horizon=2050):
     from agrifoodpy_data.food import FAOSTAT, Nutrients_FAOSTAT
     from agrifoodpy_data.impact import PN18_FAOSTAT
     from agrifoodpy_data.population import UN
-    from agrifoodpy_data.land import NaturalEngland_ALC_1000 as ALC
-    from agrifoodpy_data.land import UKCEH_LC_1000
     datablock = {}
     datablock["food"] = {}
     datablock["land"] = {}
@@ -29,7 +64,7 @@ def datablock_setup():
 
     area_fao = 229 #UK
     # area_fao = 5000 # WORLD
-    years = np.arange(2020, 2051)
+    years = np.arange(2020, horizon+1)
 
     # ------------------------------
     # Select population data from UN
@@ -202,6 +237,26 @@ def datablock_setup():
     # datablock["impact"]["C"] = C_base
     # datablock["impact"]["F"] = F_base
 
+    # -------------------------------
+    # Baseline data for comparison
+    # -------------------------------
+
+    datablock["food"]["baseline"] = copy.deepcopy(datablock["food"]["g/cap/day"])
+
+    # Item group membership matrices, for the group sums of the views
+    datablock["food"]["memberships"] = item_memberships(datablock["food"]["g/cap/day"])
+
+    return datablock
+
+@st.cache_resource(ttl=60*60*24)
+def land_setup():
+    """Builds the baseline land data, shared by all sessions and by the
+    evaluated datablocks in the result cache."""
+
+    from agrifoodpy_data.land import NaturalEngland_ALC_1000 as ALC
+    from agrifoodpy_data.land import UKCEH_LC_1000
+    land = {}
+
     # -------------------------------
     # Land use data
     # -------------------------------
@@ -213,16 +268,29 @@ def datablock_setup():
 
     peatland = xr.open_dataarray("images/peatland_binary_mask.nc")
 
-    # datablock["land"]["percentage_land_use"] = LC.where(np.isfinite(ALC.grade))
-    datablock["land"]["percentage_land_use"] = LC
-    datablock["land"]["dominant_classification"] = ALC.grade
-    datablock["land"]["peatland"] = peatland
+    # Land use is tracked as class totals per peatland region. The cell level
+    # map is only built when it needs to be displayed
+    land["state"] = land_state(LC,
+                               mask_layers={"peatland":peatland},
+                               new_classes=new_land_classes)
+    land["dominant_classification"] = ALC.grade
+    land["peatland"] = peatland
 
-    # -------------------------------
-    # Baseline data for comparison
-    # -------------------------------
+    # Cell orders for prioritised land allocation: lowest quality ALC grades
+    # and peat cells are converted first
+    land_ranking(land["state"], ALC.grade, "alc_grade", ascending=False)
+    land_ranking(land["state"], peatland, "peatland", ascending=False)
 
-    datablock["land"]["baseline"] = copy.deepcopy(datablock["land"]["percentage_land_use"])
-    datablock["food"]["baseline"] = copy.deepcopy(datablock["food"]["g/cap/day"])
+    # Zone layers for reporting land use by ALC grade and peatland
+    land_zones(land["state"], "ALC grade", ALC.grade,
+               labels={grade:f"Grade {grade}" for grade in range(1, 6)})
+    land_zones(land["state"], "Peatland", peatland,
+               labels={0:"Non peatland", 1:"Peatland"})
+
+    # Coarser map levels for display
+    land_pyramid(land["state"])
+
+    # Baseline data for comparison
+    land["baseline"] = land_class_totals(land["state"])
 
-    return datablock
\ No newline at end of file
+    return land
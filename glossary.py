@@ -74,13 +74,38 @@ option_list = ["Summary",
                "CO2e emission per food group",
                "CO2e emission per food item",
             #    "CO2 emissions per sector",
-               # "CO2e concentration",
-               # "Radiative forcing",
-            #    "Temperature anomaly",
+               "CO2e concentration",
+               "Radiative forcing",
+               "Temperature anomaly",
                "Per capita daily values",
                "Land",
                "Self-sufficiency ratio"]
 
+# Optional pipeline outputs needed by each view. Views with "trajectory" plot
+# whole trajectories over the years, any other view only needs the reference
+# and metric years and uses the endpoint evaluation mode. The bottom panel,
+# shown on every view but the summary, needs the headline metrics
+view_outputs = {"Summary":["emissions", "sequestration", "metrics"],
+                "CO2e emission per food group":["trajectory", "emissions", "sequestration", "metrics"],
+                "CO2e emission per food item":["trajectory", "emissions", "sequestration", "metrics"],
+                "CO2e concentration":["trajectory", "emissions", "sequestration", "metrics", "temperature"],
+                "Radiative forcing":["trajectory", "emissions", "sequestration", "metrics", "temperature"],
+                "Temperature anomaly":["trajectory", "emissions", "sequestration", "metrics", "temperature"],
+                "Per capita daily values":["emissions", "sequestration", "metrics"],
+                "Land":["emissions", "sequestration", "metrics"],
+                "Self-sufficiency ratio":["trajectory", "emissions", "sequestration", "metrics"]}
+
+# Step, in years, between the metric years which can be selected in the
+# summary views when only the endpoint is evaluated
+metric_year_step = 5
+
+# Food quantities with precomputed self-sufficiency metrics
+metric_quantities = ["g/cap/day",
+                     "g_prot/cap/day",
+                     "g_fat/cap/day",
+                     "g_co2e/cap/day",
+                     "kCal/cap/day"]
+
 FAOSTAT_percapita_items = ["Weight",
                            "Energy",
                            "Fat",
@@ -135,6 +160,15 @@ land_label_dict = {
     'Peatland' : "Peatland",
 }
 
+# Land classes created by the model, in addition to the baseline map classes
+new_land_classes = ["BECCS",
+                    "Peatland",
+                    "Managed arable",
+                    "Managed pasture",
+                    "Mixed farming",
+                    "Silvopasture",
+                    "Agroforestry"]
+
 sector_emissions_dict = {
     "F-gases":2.48,
     "Waste":7.83,
@@ -165,4 +199,38 @@ sector_emissions_colors = {
     "Surface transport":"#7142ff",
     "Land use sinks":"#1a5f31",
     "Removals":"#000000",
-}
\ No newline at end of file
+}
+
+# Fixed source axis of the sequestration and cost ledgers
+sequestration_sources = ["Broadleaf woodland",
+                         "Coniferous woodland",
+                         "Peatland",
+                         "Managed pasture",
+                         "Managed arable",
+                         "Mixed farming",
+                         "Silvopasture",
+                         "Agroforestry",
+                         "BECCS from waste",
+                         "BECCS from overseas biomass",
+                         "BECCS from land",
+                         "DACCS"]
+
+sequestration_index = {source:i for i, source in enumerate(sequestration_sources)}
+
+# Integer positions of the ledger source groups shown in the plots
+land_sink_index = [sequestration_index[source] for source in ["Broadleaf woodland",
+                                                               "Coniferous woodland",
+                                                               "Peatland",
+                                                               "Managed pasture",
+                                                               "Managed arable",
+                                                               "Mixed farming",
+                                                               "Silvopasture",
+                                                               "Agroforestry"]]
+
+removals_index = [sequestration_index[source] for source in ["BECCS from waste",
+                                                              "BECCS from overseas biomass",
+                                                              "BECCS from land",
+                                                              "DACCS"]]
+
+forest_sink_index = [sequestration_index[source] for source in ["Broadleaf woodland",
+                                                                 "Coniferous woodland"]]
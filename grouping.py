@@ -0,0 +1,126 @@
+import functools
+import numpy as np
+import pandas as pd
+import xarray as xr
+from scipy import sparse
+
+# Item coordinates used to group food balance sheets in the views
+group_coordinates = ["Item_origin", "Item_group", "Item_name"]
+
+def membership_matrix(labels, sort=True):
+    """Builds the sparse membership matrix of a set of group labels.
+
+    Parameters
+    ----------
+    labels : array_like
+        Group label of each element. Elements with a missing label do not
+        belong to any group.
+    sort : bool, optional
+        Whether to sort the groups by label, as xarray groupby does, or keep
+        them in order of first appearance.
+
+    Returns
+    -------
+    groups : numpy.ndarray
+        Group labels.
+    matrix : scipy.sparse.csr_matrix
+        (groups, elements) matrix, with ones where an element belongs to a
+        group.
+    """
+
+    codes, groups = pd.factorize(np.asarray(labels), sort=sort)
+    members = np.flatnonzero(codes >= 0)
+
+    matrix = sparse.csr_matrix((np.ones(len(members)), (codes[members], members)),
+                               shape=(len(groups), len(codes)))
+
+    return np.asarray(groups), matrix
+
+def item_memberships(fbs, coordinates=group_coordinates):
+    """Precomputes the membership matrices of the items of a food balance
+    sheet for a set of grouping coordinates.
+
+    Returns a dictionary with an entry per coordinate, holding the item
+    labels the matrix was built for, the group labels and the membership
+    matrix.
+    """
+
+    memberships = {}
+    for coordinate in coordinates:
+        groups, matrix = membership_matrix(fbs[coordinate].values)
+        memberships[coordinate] = {"labels":pd.Index(fbs[coordinate].values),
+                                   "groups":groups,
+                                   "matrix":matrix}
+
+    return memberships
+
+@functools.lru_cache(maxsize=64)
+def labels_membership(labels):
+    """Returns the group labels and membership matrix of a tuple of item
+    labels, cached on the labels"""
+
+    return membership_matrix(np.array(labels, dtype=object))
+
+def item_membership(fbs, coordinate, memberships=None):
+    """Returns the group labels and membership matrix of the items of a food
+    balance sheet, reusing the precomputed matrix if it was built for the
+    same item labels.
+
+    Otherwise the matrix is taken from the labels_membership cache. The
+    precomputed memberships belong to datablocks shared between sessions,
+    so they are never modified."""
+
+    entry = memberships.get(coordinate) if memberships is not None else None
+    labels = pd.Index(fbs[coordinate].values)
+
+    if entry is None or not entry["labels"].equals(labels):
+        return labels_membership(tuple(labels))
+
+    return entry["groups"], entry["matrix"]
+
+def group_sum(fbs, coordinate, new_name=None, memberships=None):
+    """Sums the quantities of a food balance sheet over the items of each
+    group of a coordinate, as a single sparse matrix product over every year
+    and element.
+
+    Equivalent to fbs.fbs.group_sum, with missing values summed as zero.
+
+    Parameters
+    ----------
+    fbs : xarray.Dataset or xarray.DataArray
+        Input food balance sheet, with an Item dimension.
+    coordinate : str
+        Item coordinate with the group labels.
+    new_name : str, optional
+        New name for the group dimension.
+    memberships : dict, optional
+        Precomputed membership matrices, as returned by item_memberships.
+
+    Returns
+    -------
+    grouped : xarray.Dataset or xarray.DataArray
+        Food balance sheet with the group dimension replacing Item.
+    """
+
+    groups, matrix = item_membership(fbs, coordinate, memberships)
+    name = coordinate if new_name is None else new_name
+
+    if isinstance(fbs, xr.Dataset):
+        variables = [var for var in fbs.data_vars if "Item" in fbs[var].dims]
+        stacked = fbs[variables].to_array(dim="variable")
+        grouped = group_sum(stacked, coordinate, new_name, memberships).to_dataset(dim="variable")
+        for var in fbs.data_vars:
+            if var not in variables:
+                grouped[var] = fbs[var]
+        return grouped
+
+    other = [dim for dim in fbs.dims if dim != "Item"]
+    values = fbs.fillna(0).transpose("Item", *other).values
+    sums = matrix @ values.reshape(len(values), -1)
+
+    coords = {key:coord for key, coord in fbs.coords.items() if "Item" not in coord.dims}
+    coords[name] = groups
+
+    return xr.DataArray(sums.reshape((len(groups),) + values.shape[1:]),
+                        dims=[name, *other], coords=coords,
+                        name=fbs.name, attrs=fbs.attrs)
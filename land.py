@@ -0,0 +1,1115 @@
+import numpy as np
+import xarray as xr
+import streamlit as st
+import hashlib
+
+# Maximum number of cells processed at once by cell level operations. This
+# bounds the memory used by temporary arrays on high resolution maps
+cell_chunk_size = 2**18
+
+# Cell sizes, in the units of the map coordinates, of the coarser levels of
+# the land use map pyramid used for display
+pyramid_resolutions = (1000, 5000, 10000)
+
+# Land which is not assigned to any class, such as the difference filled by
+# land_fill, is reported under this name in the transition matrices
+unallocated_class = "Unallocated"
+
+def land_state(baseline, mask_layers=None, new_classes=None,
+               dim="aggregate_class"):
+    """Builds an aggregate land use state from a baseline land use map.
+
+    Every land use change in the model moves a fraction of some classes into
+    other classes, optionally restricted to a masked region of the map. These
+    changes are linear on the per-cell class percentages, so instead of
+    updating the map they are accumulated as one operator per region. Regions
+    are the unique combinations of values of the mask layers, and the area of
+    each class within each region is precomputed here, so class totals can be
+    evaluated without touching the cell level data.
+
+    The baseline map and mask layers are converted to cell level arrays one
+    block of rows at a time, which bounds the memory used by temporary arrays
+    on high resolution maps.
+
+    Parameters
+    ----------
+    baseline : xarray.DataArray
+        Percentage land use map, with a class dimension and spatial dimensions.
+    mask_layers : dict, optional
+        Maps layer names to spatial DataArrays that land use changes can be
+        restricted to, e.g. {"peatland": peatland}.
+    new_classes : list, optional
+        Classes which are not in the baseline map but can be created by the
+        model. These are initialised as zero on all valid cells.
+    dim : str
+        Name of the class dimension.
+
+    Returns
+    -------
+    state : dict
+        The land state.
+    """
+
+    if mask_layers is None:
+        mask_layers = {}
+    if new_classes is None:
+        new_classes = []
+
+    baseline = baseline.transpose(dim, ...)
+    spatial_dims = baseline.dims[1:]
+    spatial_shape = baseline.shape[1:]
+    base_classes = list(baseline[dim].values)
+    classes = base_classes + [c for c in new_classes if c not in base_classes]
+    nclass = len(classes)
+    layer_names = list(mask_layers.keys())
+    layers = {name:mask_layers[name].transpose(*spatial_dims) for name in layer_names}
+
+    row_size = int(np.prod(spatial_shape[1:]))
+    block_rows = max(1, cell_chunk_size // row_size)
+    blocks = [slice(start, min(start + block_rows, spatial_shape[0]))
+              for start in range(0, spatial_shape[0], block_rows)]
+
+    def read_block(rows):
+        flat = baseline.isel({spatial_dims[0]:rows}).values
+        flat = flat.reshape(len(base_classes), -1)
+        return flat, np.flatnonzero(np.isfinite(flat).any(axis=0))
+
+    # Cells with data in any class are valid, the rest are kept as NaN
+    cell_index = []
+    layer_cells = {name:[] for name in layer_names}
+    for rows in blocks:
+        flat, valid = read_block(rows)
+        cell_index.append(valid + rows.start * row_size)
+        for name in layer_names:
+            layer = layers[name].isel({spatial_dims[0]:rows}).values.ravel()
+            layer_cells[name].append(layer[valid])
+    cell_index = np.concatenate(cell_index)
+
+    # Cell percentages, augmented with a constant term to allow affine
+    # operations, such as filling cells up to a total percentage
+    cells = np.zeros((len(cell_index), nclass+1))
+
+    start = 0
+    for rows in blocks:
+        flat, valid = read_block(rows)
+        block = np.zeros((len(valid), nclass+1))
+        block[:, :len(base_classes)] = np.nan_to_num(flat[:, valid].T)
+        block[:, -1] = 1
+        cells[start:start+len(valid)] = block
+        start += len(valid)
+
+    # Split the valid cells in regions with unique mask layer values
+    layer_values = {}
+    layer_codes = []
+    for name in layer_names:
+        values, codes = np.unique(np.concatenate(layer_cells[name]),
+                                  return_inverse=True)
+        layer_values[name] = values
+        layer_codes.append(codes.ravel())
+
+    if len(layer_codes) > 0:
+        region_layers, region = np.unique(np.stack(layer_codes, axis=1),
+                                          axis=0, return_inverse=True)
+        region = region.ravel()
+    else:
+        region_layers = np.zeros((1, 0), dtype=int)
+        region = np.zeros(len(cell_index), dtype=int)
+
+    nregion = len(region_layers)
+    baseline_sums = group_sums(cells, region, nregion)
+
+    state = {"dim":dim,
+             "classes":classes,
+             "spatial_dims":spatial_dims,
+             "spatial_coords":{d:baseline[d].values for d in spatial_dims},
+             "spatial_shape":spatial_shape,
+             "cell_index":cell_index,
+             "cells":cells,
+             "region":region,
+             "layer_names":layer_names,
+             "layer_values":layer_values,
+             "region_layers":region_layers,
+             "baseline_sums":baseline_sums,
+             "operators":np.tile(np.eye(nclass+1), (nregion, 1, 1)),
+             "region_parent":np.arange(nregion),
+             "stages":[],
+             "zones":{},
+             "zone_values":{},
+             "zone_sums":{},
+             "pyramid":{},
+             "transitions":{}}
+
+    return state
+
+def cell_chunks(ncell):
+    """Yields slices splitting a number of cells in chunks of at most
+    cell_chunk_size cells"""
+
+    for start in range(0, ncell, cell_chunk_size):
+        yield slice(start, min(start + cell_chunk_size, ncell))
+
+def group_sums(cells, groups, ngroup):
+    """Sums the cell level percentages over groups of cells, one chunk of
+    cells at a time.
+
+    Parameters
+    ----------
+    cells : numpy.ndarray
+        Cell level percentages, as a (cells, classes) array.
+    groups : numpy.ndarray
+        Group of each cell, between 0 and ngroup-1.
+    ngroup : int
+        Number of groups.
+
+    Returns
+    -------
+    sums : numpy.ndarray
+        Sums over each group, as a (groups, classes) array.
+    """
+
+    sums = np.zeros((ngroup, cells.shape[1]))
+    for chunk in cell_chunks(len(groups)):
+        block = cells[chunk]
+        for i in range(block.shape[1]):
+            sums[:, i] += np.bincount(groups[chunk], weights=block[:, i],
+                                      minlength=ngroup)
+
+    return sums
+
+def copy_land_state(state):
+    """Returns a copy of the land state which can be modified without
+    affecting the original. Cell level data is shared between copies."""
+
+    new_state = dict(state)
+    new_state["operators"] = state["operators"].copy()
+    new_state["transitions"] = dict(state["transitions"])
+    return new_state
+
+def land_cell_arrays(state):
+    """Returns the cell level arrays of the land state which are not modified
+    by land use changes, and are shared by every copy of the state"""
+
+    arrays = [state["cells"], state["cell_index"]]
+    arrays += list(state["zones"].values())
+    arrays += list(state["rankings"].values()) if "rankings" in state else []
+    for level in state["pyramid"].values():
+        arrays += [level["blocks"], level["count"]]
+
+    return arrays
+
+def class_index(state, classes):
+    """Returns the positions of the given classes in the land state"""
+
+    if np.isscalar(classes):
+        classes = [classes]
+
+    index = []
+    for c in classes:
+        if c not in state["classes"]:
+            raise KeyError(f"Unknown land class: {c}")
+        index.append(state["classes"].index(c))
+
+    return np.array(index, dtype=int)
+
+def land_regions(state, mask_layer=None, mask_values=None):
+    """Returns a boolean array selecting the regions where the mask layer
+    takes any of the given values. Selects all regions if no values are given.
+    """
+
+    nregion = len(state["region_layers"])
+    if mask_layer is None or mask_values is None:
+        return np.ones(nregion, dtype=bool)
+
+    if mask_layer not in state["layer_names"]:
+        raise KeyError(f"Land state has no mask layer {mask_layer}")
+
+    layer_pos = state["layer_names"].index(mask_layer)
+    values = state["layer_values"][mask_layer]
+    selected_codes = np.flatnonzero(np.isin(values, mask_values))
+
+    return np.isin(state["region_layers"][:, layer_pos], selected_codes)
+
+def region_totals(state):
+    """Returns the current class areas for each region, including the constant
+    term, as a (region, class + 1) array."""
+
+    return np.einsum("rij,rj->ri", state["operators"], state["baseline_sums"])
+
+def land_area(state, classes=None, mask_layer=None, mask_values=None):
+    """Computes the total area of the given land classes
+
+    Parameters
+    ----------
+    state : dict
+        The land state.
+    classes : str, list, optional
+        Classes to be added. If not given, all classes are added.
+    mask_layer : str, optional
+        Mask layer used to restrict the computation to a region of the map.
+    mask_values : scalar, list, optional
+        Values of the mask layer defining the region.
+
+    Returns
+    -------
+    area : float
+        Total area of the classes, in the units of the baseline map.
+    """
+
+    if classes is None:
+        index = np.arange(len(state["classes"]))
+    else:
+        index = class_index(state, classes)
+
+    regions = land_regions(state, mask_layer, mask_values)
+    totals = region_totals(state)[regions]
+
+    return totals[:, index].sum()
+
+def land_class_totals(state):
+    """Returns the total area of each land class as a DataArray"""
+
+    totals = region_totals(state).sum(axis=0)[:-1]
+    return xr.DataArray(totals, coords={state["dim"]:state["classes"]},
+                        dims=state["dim"])
+
+def land_zones(state, name, zone_map, labels=None):
+    """Adds a zone layer to the land state, in place, so class totals can be
+    reported for each zone with land_zone_totals.
+
+    Unlike mask layers, zone layers do not split the land state into regions,
+    so any number of them can be added without slowing down land use
+    changes.
+
+    Parameters
+    ----------
+    state : dict
+        The land state.
+    name : str
+        Name of the zone layer.
+    zone_map : xarray.DataArray
+        Spatial DataArray with the zone of each cell, such as a nations map,
+        ALC grades or the peatland mask.
+    labels : dict, optional
+        Maps zone values to the names used when reporting. Cells with no zone
+        are reported as "No data".
+
+    Returns
+    -------
+    state : dict
+        The land state.
+    """
+
+    if labels is None:
+        labels = {}
+
+    values = zone_map.transpose(*state["spatial_dims"]).values.ravel()
+    values, codes = np.unique(values[state["cell_index"]], return_inverse=True)
+
+    names = []
+    for value in values:
+        if isinstance(value, float) and np.isnan(value):
+            names.append("No data")
+        else:
+            names.append(labels.get(value, value))
+
+    state["zones"] = {**state["zones"], name:codes.ravel()}
+    state["zone_values"] = {**state["zone_values"], name:names}
+
+    return state
+
+def zone_class_totals(state, name, codes, nzone):
+    """Returns the total area of each class on each zone, as a (zones,
+    classes) array.
+
+    The baseline area of each class is summed over every combination of zone
+    and region present in the map, in a single pass over the cells, and
+    cached under the given name until the cells are split into new regions.
+
+    Parameters
+    ----------
+    state : dict
+        The land state.
+    name : str
+        Name under which the baseline sums are cached.
+    codes : numpy.ndarray
+        Zone of each valid cell, between 0 and nzone-1.
+    nzone : int
+        Number of zones.
+    """
+
+    nclass = len(state["classes"])
+
+    # The cache is shared between copies of the land state, and is only
+    # reused by states with the same region assignment array
+    cached = state["zone_sums"].get(name)
+    if cached is None or cached[0] is not state["region"]:
+        nregion = len(state["region_layers"])
+        key = codes.astype(np.int64) * nregion + state["region"]
+        pairs, pair_index = np.unique(key, return_inverse=True)
+        sums = group_sums(state["cells"], pair_index.ravel(), len(pairs))
+
+        # Sort the pairs by region, so each region is a contiguous block
+        order = np.argsort(pairs % nregion, kind="stable")
+        pair_region = (pairs % nregion)[order]
+        bounds = np.searchsorted(pair_region, np.arange(nregion+1))
+        cached = (state["region"], (pairs // nregion)[order], bounds, sums[order])
+        state["zone_sums"][name] = cached
+
+    _, pair_zone, bounds, sums = cached
+
+    values = np.empty((len(sums), nclass))
+    for r in np.flatnonzero(np.diff(bounds)):
+        block = slice(bounds[r], bounds[r+1])
+        values[block] = sums[block] @ state["operators"][r, :nclass].T
+
+    return np.stack([np.bincount(pair_zone, weights=values[:, i], minlength=nzone)
+                     for i in range(nclass)], axis=1)
+
+def land_zone_totals(state, name):
+    """Returns the total area of each class on each zone of a zone layer.
+
+    The baseline area of each class on every combination of zone and region
+    is computed in a single pass over the cells, and only recomputed after
+    the cells have been split into new regions. Totals are then evaluated
+    from the region operators, as with land_class_totals.
+
+    Parameters
+    ----------
+    state : dict
+        The land state.
+    name : str
+        Name of the zone layer, as given to land_zones.
+
+    Returns
+    -------
+    totals : xarray.DataArray
+        Area of each class on each zone, with the zone layer and class
+        dimensions.
+    """
+
+    if name not in state["zones"]:
+        raise KeyError(f"Unknown zone layer: {name}")
+
+    totals = zone_class_totals(state, name, state["zones"][name],
+                               len(state["zone_values"][name]))
+
+    return xr.DataArray(totals,
+                        coords={name:state["zone_values"][name],
+                                state["dim"]:state["classes"]},
+                        dims=(name, state["dim"]))
+
+def land_pyramid(state, resolutions=pyramid_resolutions):
+    """Adds coarser levels of the land use map to the land state, in place.
+
+    Each level groups the valid cells in square blocks. Like zone layers,
+    the class totals of every block are evaluated from the region operators,
+    so coarse maps stay up to date with land use changes without touching
+    the cell level data.
+
+    Parameters
+    ----------
+    state : dict
+        The land state, with two spatial dimensions.
+    resolutions : list
+        Cell size of each level, in the units of the map coordinates. Levels
+        which are not coarser than the map are skipped.
+
+    Returns
+    -------
+    state : dict
+        The land state.
+    """
+
+    ny, nx = state["spatial_shape"]
+    spacing = np.abs(np.diff(state["spatial_coords"][state["spatial_dims"][0]][:2]))
+    resolution = spacing[0] if len(spacing) > 0 else 1
+
+    rows, cols = np.unravel_index(state["cell_index"], (ny, nx))
+
+    pyramid = dict(state["pyramid"])
+    for level in resolutions:
+        factor = int(round(level / resolution))
+        if factor <= 1:
+            continue
+        blocks = (rows // factor) * -(-nx // factor) + cols // factor
+        pyramid[factor] = {"blocks":blocks,
+                           "count":np.bincount(blocks, minlength=-(-ny // factor) * -(-nx // factor))}
+
+    state["pyramid"] = pyramid
+
+    return state
+
+def land_pyramid_map(state, factor):
+    """Returns a level of the land use map pyramid, with the mean percentage
+    of each class over the valid cells of each block.
+
+    Parameters
+    ----------
+    state : dict
+        The land state.
+    factor : int
+        Number of cells along each side of the blocks of the level, as added
+        by land_pyramid.
+
+    Returns
+    -------
+    pctg : xarray.DataArray
+        Percentage land use map of the level, with the class dimension first
+        and NaN on blocks without valid cells.
+    """
+
+    level = state["pyramid"][factor]
+    nclass = len(state["classes"])
+    shape = tuple(-(-n // factor) for n in state["spatial_shape"])
+
+    totals = zone_class_totals(state, f"pyramid {factor}", level["blocks"],
+                               len(level["count"]))
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        pctg = totals / level["count"][:, None]
+    pctg[level["count"] == 0] = np.nan
+
+    return xr.DataArray(pctg.T.reshape((nclass,) + shape),
+                        coords=block_coords(state, factor),
+                        dims=(state["dim"],) + tuple(state["spatial_dims"]))
+
+def block_coords(state, factor):
+    """Returns the coordinates of a land use map coarsened in square blocks
+    of factor cells along each side, at the mean coordinate of each block"""
+
+    coords = {state["dim"]:state["classes"]}
+    for d in state["spatial_dims"]:
+        values = state["spatial_coords"][d]
+        starts = np.arange(0, len(values), factor)
+        coords[d] = np.add.reduceat(values, starts) / np.diff(np.append(starts, len(values)))
+
+    return coords
+
+def land_block_map(state, factor):
+    """Returns the land use map coarsened in square blocks of factor cells
+    along each side, with the mean percentage of each class over the valid
+    cells of each block.
+
+    Unlike land_pyramid_map, any factor can be used. The cell level map is
+    materialised one block of rows at a time with land_use_blocks, so only
+    the coarse map is held in memory.
+
+    Parameters
+    ----------
+    state : dict
+        The land state, with two spatial dimensions.
+    factor : int
+        Number of cells along each side of the blocks.
+
+    Returns
+    -------
+    pctg : xarray.DataArray
+        Coarse percentage land use map, with the class dimension first and
+        NaN on blocks without valid cells.
+    """
+
+    nclass = len(state["classes"])
+    nx = state["spatial_shape"][1]
+    ncol = -(-nx // factor)
+    block_rows = factor * max(1, cell_chunk_size // (nx * factor))
+
+    out = []
+    for block in land_use_blocks(state, block_rows):
+        values = block.values
+        nrow = -(-values.shape[1] // factor)
+
+        # Pad the block to whole coarse blocks with cells without data
+        padded = np.full((nclass, nrow * factor, ncol * factor), np.nan)
+        padded[:, :values.shape[1], :nx] = values
+        padded = padded.reshape(nclass, nrow, factor, ncol, factor)
+
+        count = np.isfinite(padded[0]).sum(axis=(1, 3))
+        with np.errstate(invalid="ignore", divide="ignore"):
+            pctg = np.nansum(padded, axis=(2, 4)) / count
+        pctg[:, count == 0] = np.nan
+        out.append(pctg)
+
+    return xr.DataArray(np.concatenate(out, axis=1),
+                        coords=block_coords(state, factor),
+                        dims=(state["dim"],) + tuple(state["spatial_dims"]))
+
+def land_transitions(state):
+    """Returns the gross area flows between classes recorded by the land use
+    changes applied to the land state.
+
+    Flows from land_fill are netted within each region of the land state.
+
+    Returns
+    -------
+    transitions : xarray.DataArray
+        Area moved from each class into each other class, with from_class and
+        to_class dimensions. Unallocated land is included as an extra class.
+    """
+
+    names = state["classes"] + [unallocated_class]
+    matrix = np.zeros((len(names), len(names)))
+    for (from_class, to_class), area in state["transitions"].items():
+        matrix[names.index(from_class), names.index(to_class)] += area
+
+    return xr.DataArray(matrix, coords={"from_class":names, "to_class":names},
+                        dims=("from_class", "to_class"))
+
+def land_transfer(state, from_classes, to_classes, fraction, weights=None,
+                  mask_layer=None, mask_values=None):
+    """Moves a fraction of the land in a set of classes into a different set
+    of classes, in place.
+
+    Parameters
+    ----------
+    state : dict
+        The land state.
+    from_classes : str, list
+        Classes from which land is taken.
+    to_classes : str, list
+        Classes which receive the land.
+    fraction : float
+        Fraction of each of the from_classes to be moved.
+    weights : list, optional
+        Fraction of the moved land received by each of the to_classes. If not
+        given, land is split evenly.
+    mask_layer : str, optional
+        Mask layer used to restrict the change to a region of the map.
+    mask_values : scalar, list, optional
+        Values of the mask layer defining the region.
+
+    Returns
+    -------
+    moved : float
+        Total area moved between classes.
+    """
+
+    src = class_index(state, from_classes)
+    dst = class_index(state, to_classes)
+
+    if weights is None:
+        weights = np.ones(len(dst)) / len(dst)
+    weights = np.atleast_1d(weights)
+
+    regions = land_regions(state, mask_layer, mask_values)
+    region_moved = region_totals(state)[regions][:, src] * fraction
+    moved = region_moved.sum()
+
+    record_transitions(state, src, dst, region_moved, weights)
+
+    step = np.eye(len(state["classes"])+1)
+    step[src, src] -= fraction
+    step[np.ix_(dst, src)] += np.outer(weights, np.full(len(src), fraction))
+
+    state["operators"][regions] = step @ state["operators"][regions]
+
+    return moved
+
+def land_fill(state, to_classes, weights=None, total=100):
+    """Adds or removes land from a set of classes so each valid cell adds up
+    to a fixed total, in place.
+
+    Parameters
+    ----------
+    state : dict
+        The land state.
+    to_classes : str, list
+        Classes which receive or give up the difference.
+    weights : list, optional
+        Fraction of the difference assigned to each of the to_classes. If not
+        given, the difference is split evenly.
+    total : float
+        Total percentage of each cell.
+    """
+
+    dst = class_index(state, to_classes)
+    nclass = len(state["classes"])
+
+    if weights is None:
+        weights = np.ones(len(dst)) / len(dst)
+    weights = np.atleast_1d(weights)
+
+    # The difference is taken from, or given back to, unallocated land
+    totals = region_totals(state)
+    region_delta = total * totals[:, nclass] - totals[:, :nclass].sum(axis=1)
+    record_transitions(state, [nclass], dst, region_delta[:, None], weights)
+
+    step = np.eye(nclass+1)
+    step[dst, :nclass] -= weights[:, None]
+    step[dst, nclass] += weights * total
+
+    state["operators"] = step @ state["operators"]
+
+def land_ranking(state, score, name, ascending=True):
+    """Precomputes the order in which valid cells are converted by
+    land_allocate, sorted by a score map, and stores it in the land state.
+
+    Parameters
+    ----------
+    state : dict
+        The land state.
+    score : xarray.DataArray
+        Spatial map with the score of each cell, e.g. the ALC grade.
+    name : str
+        Name of the ranking.
+    ascending : bool
+        If True, cells with the lowest score are converted first. Cells
+        without a score are always converted last.
+    """
+
+    values = score.transpose(*state["spatial_dims"]).values.ravel()
+    values = values[state["cell_index"]].astype(float)
+    if not ascending:
+        values = -values
+
+    rankings = dict(state.get("rankings", {}))
+    rankings[name] = np.argsort(values, kind="stable")
+    state["rankings"] = rankings
+
+    return state
+
+def cell_class_values(state, index, cells):
+    """Returns the current area of each of the classes at the given class
+    positions on a subset of cells, as a (cells, classes) array"""
+
+    cells = np.asarray(cells)
+    rows = state["operators"][:, index, :]
+
+    out = np.empty((len(cells), len(index)))
+    for chunk in cell_chunks(len(cells)):
+        chunk_cells = cells[chunk]
+        region = state["region"][chunk_cells]
+
+        # Group the cells by region, so each region is a single matrix product
+        order = np.argsort(region, kind="stable")
+        bounds = np.searchsorted(region[order], np.arange(len(rows)+1))
+        values = state["cells"][chunk_cells[order]]
+
+        chunk_out = np.empty((len(chunk_cells), len(index)))
+        for r in np.flatnonzero(np.diff(bounds)):
+            chunk_out[order[bounds[r]:bounds[r+1]]] = values[bounds[r]:bounds[r+1]] @ rows[r].T
+        out[chunk] = chunk_out
+
+    return out
+
+def pair_flows(src, dst, moved, weights):
+    """Splits the area moved out of each source class between the destination
+    classes, as a (n, src, dst) array. Flows from a class into itself are
+    dropped."""
+
+    src = np.asarray(src)
+    dst = np.asarray(dst)
+    flows = np.asarray(moved)[:, :, None] * np.asarray(weights)[None, None, :]
+    flows[:, src[:, None] == dst[None, :]] = 0
+
+    return flows
+
+def record_transitions(state, src, dst, moved, weights):
+    """Adds the area flows of a land use change to the national transition
+    matrix of the land state, in place.
+
+    Parameters
+    ----------
+    state : dict
+        The land state.
+    src, dst : list
+        Positions of the source and destination classes. The position after
+        the last class is unallocated land.
+    moved : numpy.ndarray
+        Area moved out of each source class, as a (n, src) array over regions
+        or cells. Negative areas are recorded as flows in the opposite
+        direction.
+    weights : list
+        Fraction of the moved area received by each destination class.
+    """
+
+    flows = pair_flows(src, dst, moved, weights)
+    forward = np.clip(flows, 0, None).sum(axis=0)
+    backward = -np.clip(flows, None, 0).sum(axis=0)
+
+    names = state["classes"] + [unallocated_class]
+    transitions = state["transitions"]
+
+    for i, j in zip(*np.nonzero(forward)):
+        key = (names[src[i]], names[dst[j]])
+        transitions[key] = transitions.get(key, 0.) + forward[i, j]
+
+    for i, j in zip(*np.nonzero(backward)):
+        key = (names[dst[j]], names[src[i]])
+        transitions[key] = transitions.get(key, 0.) + backward[i, j]
+
+def split_regions(state, cells, step):
+    """Applies an operator to a subset of cells, in place, by moving them to
+    new regions. Each new region keeps the mask layer values of the region
+    the cells come from."""
+
+    region = state["region"].copy()
+    old_regions = np.unique(region[cells])
+    new_ids = np.arange(len(state["region_layers"]),
+                        len(state["region_layers"]) + len(old_regions))
+
+    remap = np.zeros(len(state["region_layers"]), dtype=int)
+    remap[old_regions] = new_ids
+    region[cells] = remap[region[cells]]
+
+    state["region"] = region
+    state["region_parent"] = np.concatenate([state["region_parent"], old_regions])
+    state["region_layers"] = np.concatenate([state["region_layers"],
+                                             state["region_layers"][old_regions]])
+    state["operators"] = np.concatenate([state["operators"],
+                                         step @ state["operators"][old_regions]])
+
+    # Only the regions the cells move between change their baseline sums
+    moved_sums = np.zeros((len(old_regions), state["cells"].shape[1]))
+    for chunk in cell_chunks(len(cells)):
+        chunk_cells = cells[chunk]
+        moved_sums += group_sums(state["cells"][chunk_cells],
+                                 region[chunk_cells] - new_ids[0],
+                                 len(old_regions))
+
+    baseline_sums = np.concatenate([state["baseline_sums"], moved_sums])
+    baseline_sums[old_regions] -= moved_sums
+    state["baseline_sums"] = baseline_sums
+
+    return state
+
+def land_allocate(state, from_classes, to_classes, area, ranking, weights=None,
+                  mask_layer=None, mask_values=None):
+    """Moves land from a set of classes into a different set of classes in
+    rank order, in place, until a target area has been moved.
+
+    Cells are converted completely, following a ranking precomputed with
+    land_ranking, and the last cell is converted partially to match the
+    target area. The cumulative eligible area along the ranking is computed
+    one chunk of cells at a time, only until it reaches the target area, and
+    the last cell is found with a binary search. The cost of an allocation
+    grows with the ranked cells it reaches, not with the size of the map.
+
+    Parameters
+    ----------
+    state : dict
+        The land state.
+    from_classes : str, list
+        Classes from which land is taken.
+    to_classes : str, list
+        Classes which receive the land.
+    area : float
+        Total area to be moved, in the units of the baseline map.
+    ranking : str
+        Name of a ranking stored in the land state with land_ranking, which
+        also registers rankings from other score maps.
+    weights : list, optional
+        Fraction of the moved land received by each of the to_classes. If not
+        given, land is split evenly.
+    mask_layer : str, optional
+        Mask layer used to restrict the change to a region of the map.
+    mask_values : scalar, list, optional
+        Values of the mask layer defining the region.
+
+    Returns
+    -------
+    moved : float
+        Total area moved between classes.
+    """
+
+    ranked = state["rankings"][ranking]
+
+    src = class_index(state, from_classes)
+    dst = class_index(state, to_classes)
+
+    if weights is None:
+        weights = np.ones(len(dst)) / len(dst)
+    weights = np.atleast_1d(weights)
+
+    if area <= 0:
+        return 0.
+
+    # Eligible area of the ranked cells, accumulated one chunk at a time
+    # until the target area is reached
+    rows = state["operators"][:, src, :].sum(axis=1)
+    regions = land_regions(state, mask_layer, mask_values)
+
+    order, available, cumulative = [], [], []
+    total = 0.
+    for chunk in cell_chunks(len(ranked)):
+        cells = ranked[chunk]
+        region = state["region"][cells]
+        chunk_available = np.einsum("ij,ij->i", state["cells"][cells], rows[region])
+        eligible = (chunk_available > 0) & regions[region]
+        if not eligible.any():
+            continue
+
+        order.append(cells[eligible])
+        available.append(chunk_available[eligible])
+        cumulative.append(np.cumsum(np.concatenate([[total], available[-1]]))[1:])
+        total = cumulative[-1][-1]
+        if total >= area:
+            break
+
+    if len(order) == 0:
+        return 0.
+
+    order = np.concatenate(order)
+    available = np.concatenate(available)
+    cumulative = np.concatenate(cumulative)
+    area = min(area, cumulative[-1])
+
+    # Cells before the last one are converted completely
+    last = np.searchsorted(cumulative, area)
+    previous = cumulative[last-1] if last > 0 else 0.
+
+    converted = order[:last+1]
+    fractions = np.ones(len(converted))
+    fractions[-1] = (area - previous) / available[last]
+    cell_moved = cell_class_values(state, src, converted) * fractions[:, None]
+    record_transitions(state, src, dst, cell_moved, weights)
+
+    def step(fraction):
+        operator = np.eye(len(state["classes"])+1)
+        operator[src, src] -= fraction
+        operator[np.ix_(dst, src)] += np.outer(weights, np.full(len(src), fraction))
+        return operator
+
+    if last > 0:
+        split_regions(state, order[:last], step(1))
+
+    split_regions(state, order[last:last+1], step(fractions[-1]))
+
+    return area
+
+def parent_regions(state, nregion):
+    """Returns, for each region of the land state, the region among the first
+    nregion regions which it was split from"""
+
+    index = np.arange(len(state["region_parent"]))
+    split = index >= nregion
+    while split.any():
+        index[split] = state["region_parent"][index[split]]
+        split = index >= nregion
+
+    return index
+
+def land_stage(state, previous, name, adoption):
+    """Records the land use change between a previous land state and the
+    given state as an intervention stage, paired with its adoption curve.
+
+    Each stage only stores the change of the region operators, so land use at
+    any year is reconstructed with land_state_at without storing a map per
+    year.
+
+    Parameters
+    ----------
+    state : dict
+        The land state after the intervention.
+    previous : dict
+        The land state before the intervention.
+    name : str
+        Name of the intervention.
+    adoption : xarray.DataArray
+        Adoption of the intervention, between 0 and 1, with a Year dimension.
+
+    Returns
+    -------
+    state : dict
+        The land state, with the stage added.
+    """
+
+    base = previous["operators"][parent_regions(state, len(previous["operators"]))]
+    stage = {"name":name,
+             "delta":state["operators"] - base,
+             "adoption":adoption}
+
+    state["stages"] = state["stages"] + [stage]
+
+    return state
+
+def land_state_at(state, year):
+    """Returns the land state at a given year, with each intervention stage
+    scaled by its adoption curve at that year.
+
+    Years outside the range of an adoption curve use its closest value.
+    """
+
+    nclass = len(state["classes"])
+    operators = np.tile(np.eye(nclass+1), (len(state["operators"]), 1, 1))
+
+    for stage in state["stages"]:
+        adoption = stage["adoption"]
+        years = adoption.Year.values
+        weight = float(adoption.sel(Year=np.clip(year, years.min(), years.max())))
+        index = parent_regions(state, len(stage["delta"]))
+        operators += weight * stage["delta"][index]
+
+    new_state = copy_land_state(state)
+    new_state["operators"] = operators
+
+    return new_state
+
+def land_class_trajectory(state, years):
+    """Returns the total area of each land class at a set of years, as a
+    DataArray with a Year dimension.
+
+    Class totals are linear in the adoption of each intervention stage, so
+    the totals of every year are computed in a single pass from the totals
+    of each stage, without building the land state at each year.
+    """
+
+    years = np.atleast_1d(years)
+    totals = state["baseline_sums"].sum(axis=0)
+
+    weights = np.zeros((len(years), len(state["stages"])))
+    changes = np.zeros((len(state["stages"]), len(totals)))
+
+    for i, stage in enumerate(state["stages"]):
+        adoption = stage["adoption"]
+        stage_years = adoption.Year.values
+        weights[:, i] = adoption.sel(Year=np.clip(years, stage_years.min(), stage_years.max())).values
+        index = parent_regions(state, len(stage["delta"]))
+        changes[i] = np.einsum("rij,rj->i", stage["delta"][index], state["baseline_sums"])
+
+    totals = totals + weights @ changes
+
+    return xr.DataArray(totals[:, :-1], coords={"Year":years, state["dim"]:state["classes"]},
+                        dims=("Year", state["dim"]))
+
+def land_use_map(state, rows=None):
+    """Materialises the cell level percentage land use map from the land
+    state.
+
+    Parameters
+    ----------
+    state : dict
+        The land state.
+    rows : slice, optional
+        Block of positions along the first spatial dimension to materialise.
+        If not given, the whole map is returned.
+
+    Returns
+    -------
+    pctg : xarray.DataArray
+        Percentage land use map, with the class dimension first and NaN on
+        cells without data.
+    """
+
+    nclass = len(state["classes"])
+    shape = tuple(state["spatial_shape"])
+
+    if rows is None:
+        rows = slice(0, shape[0])
+    rows = slice(*rows.indices(shape[0])[:2])
+    row_size = int(np.prod(shape[1:]))
+
+    # Valid cells are sorted by position, so the cells of a block of rows are
+    # contiguous
+    start, stop = np.searchsorted(state["cell_index"],
+                                  [rows.start * row_size, rows.stop * row_size])
+
+    out = np.full((nclass, (rows.stop - rows.start) * row_size), np.nan)
+    for chunk in cell_chunks(stop - start):
+        cells = np.arange(start + chunk.start, start + chunk.stop)
+        values = cell_class_values(state, np.arange(nclass), cells)
+        out[:, state["cell_index"][cells] - rows.start * row_size] = values.T
+
+    coords = {state["dim"]:state["classes"]}
+    coords.update(state["spatial_coords"])
+    coords[state["spatial_dims"][0]] = coords[state["spatial_dims"][0]][rows]
+
+    return xr.DataArray(out.reshape((nclass, rows.stop - rows.start) + shape[1:]),
+                        coords=coords,
+                        dims=(state["dim"],) + tuple(state["spatial_dims"]))
+
+def land_use_blocks(state, block_rows=None):
+    """Yields the cell level percentage land use map one block of rows at a
+    time, so full resolution maps can be processed without materialising
+    them at once.
+
+    Parameters
+    ----------
+    state : dict
+        The land state.
+    block_rows : int, optional
+        Number of rows along the first spatial dimension on each block. If not
+        given, blocks hold about cell_chunk_size cells.
+
+    Yields
+    ------
+    pctg : xarray.DataArray
+        Percentage land use map of a block of rows.
+    """
+
+    shape = tuple(state["spatial_shape"])
+    if block_rows is None:
+        block_rows = max(1, cell_chunk_size // int(np.prod(shape[1:])))
+
+    for start in range(0, shape[0], block_rows):
+        yield land_use_map(state, slice(start, start + block_rows))
+
+def land_fingerprint(state):
+    """Returns a hash identifying the current land use of a land state"""
+
+    digest = hashlib.sha1()
+    digest.update(state["baseline_sums"].tobytes())
+    digest.update(state["operators"].tobytes())
+    digest.update(state["region"].tobytes())
+    return digest.hexdigest()
+
+@st.cache_resource(max_entries=8)
+def _cached_land_use_map(fingerprint, _state):
+    return land_use_map(_state)
+
+def land_display_map(datablock, pixels, year=None):
+    """Returns the level of the land use map pyramid which matches a display
+    size, so rendering cost depends on the display size rather than on the
+    map resolution.
+
+    The coarsest level with at least the given number of blocks along its
+    longest side is used. If no level is fine enough, maps larger than the
+    display are coarsened to it block by block with land_block_map, and
+    smaller maps are returned at full resolution.
+
+    Parameters
+    ----------
+    datablock : dict
+        The datablock.
+    pixels : int
+        Size of the longest side of the display, in pixels.
+    year : int, optional
+        Year of the map. If not given, the final land use is returned.
+
+    Returns
+    -------
+    pctg : xarray.DataArray
+        Percentage land use map.
+    factor : int
+        Number of map cells along each side of the returned cells.
+    """
+
+    state = datablock["land"]["state"]
+
+    factor = 1
+    for level in sorted(state["pyramid"]):
+        if max(-(-n // level) for n in state["spatial_shape"]) >= pixels:
+            factor = level
+
+    if factor > 1:
+        if year is not None:
+            state = land_state_at(state, year)
+        return land_pyramid_map(state, factor), factor
+
+    factor = max(1, max(state["spatial_shape"]) // pixels)
+    if factor == 1:
+        return cached_land_use_map(datablock, year), 1
+
+    if year is not None:
+        state = land_state_at(state, year)
+
+    return land_block_map(state, factor), factor
+
+def cached_land_use_map(datablock, year=None):
+    """Returns the cell level land use map of a datablock, materialising it
+    only once for each distinct land use state. If a year is given, returns
+    the map at that year instead of the final land use."""
+
+    state = datablock["land"]["state"]
+    if year is not None:
+        state = land_state_at(state, year)
+    return _cached_land_use_map(land_fingerprint(state), state)
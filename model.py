@@ -4,7 +4,14 @@ from agrifoodpy.food.food import FoodBalanceSheet
 from agrifoodpy.utils.scaling import logistic_scale, linear_scale
 import warnings
 import copy
+import functools
 import streamlit as st
+from glossary import sequestration_sources, sequestration_index, metric_quantities, \
+    land_sink_index, removals_index, forest_sink_index, sector_emissions_dict
+from land import *
+from temperature import fair_response
+from carbon import carbon_sequestration
+from grouping import group_sum
 
 def project_future(datablock, cc_decline=False):
     """Project future food consumption based on scale
@@ -22,13 +29,6 @@ def project_future(datablock, cc_decline=False):
     datablock : Dict
         New dictionary containinng projected food consumption data
     """
-    years = np.arange(2021,2051)
-
-    pop = datablock["population"]["population"]
-
-    scale = pop.sel(Region=826, Year=np.arange(2021, 2051)) / \
-               pop.sel(Region=826, Year=2020)
-
     # Per capita per day values remain constant
     g_cap_day = datablock["food"]["g/cap/day"]
     g_prot_cap_day = datablock["food"]["g_prot/cap/day"]
@@ -37,6 +37,16 @@ def project_future(datablock, cc_decline=False):
 
     years_past = g_cap_day.Year.values
 
+    # Only the requested years are evaluated, either the full trajectory or
+    # the endpoints needed by the summary views
+    years = datablock["global_parameters"].get("years", np.arange(2020, 2051))
+    years = np.array([year for year in years if year > years_past[-1]])
+
+    pop = datablock["population"]["population"]
+
+    scale = pop.sel(Region=826, Year=years) / \
+               pop.sel(Region=826, Year=2020)
+
     g_cap_day = g_cap_day.fbs.add_years(years, "constant")
     g_prot_cap_day = g_prot_cap_day.fbs.add_years(years, "constant")
     g_fat_cap_day = g_fat_cap_day.fbs.add_years(years, "constant")
@@ -72,6 +82,63 @@ def project_future(datablock, cc_decline=False):
     datablock["food"]["kCal/cap/day"] = kcal_cap_day
     datablock["impact"]["gco2e/gfood"] = g_co2e_g
 
+    # Emissions per capita on the projected years. Nodes flag the items they
+    # change, and compute_emissions only recomputes those rows
+    datablock["food"]["g_co2e/cap/day"] = g_cap_day * g_co2e_g
+    datablock = clear_changed_items(datablock)
+
+    # Allocate the sequestration ledger on the projected year range
+    datablock = sequestration_ledger(datablock)
+
+    return datablock
+
+def sequestration_ledger(datablock):
+    """Preallocates the sequestration and cost ledgers.
+
+    Both ledgers are DataArrays with a fixed "Item" axis of sequestration
+    sources, given by glossary.sequestration_sources, and the "Year" axis of
+    the food data. Nodes write their sources with write_sequestration.
+    """
+
+    years = datablock["food"]["g/cap/day"].Year.values
+    shape = (len(sequestration_sources), len(years))
+    coords = {"Item": sequestration_sources, "Year": years}
+
+    datablock["impact"]["co2e_sequestration"] = xr.DataArray(np.zeros(shape),
+                                                             dims=["Item", "Year"],
+                                                             coords=coords,
+                                                             name="sequestration")
+
+    datablock["impact"]["cost"] = xr.DataArray(np.zeros(shape),
+                                               dims=["Item", "Year"],
+                                               coords=coords,
+                                               name="cost")
+
+    return datablock
+
+def write_sequestration(datablock, source, sequestration, cost=None):
+    """Writes the sequestration, and optionally the cost, of a source into
+    the ledgers.
+
+    The row is written to a copy of each ledger, so that ledgers of cached
+    datablocks shared with other sessions are not modified."""
+
+    if source not in sequestration_index:
+        raise KeyError(f"'{source}' is not a sequestration ledger source")
+
+    if "co2e_sequestration" not in datablock["impact"]:
+        datablock = sequestration_ledger(datablock)
+
+    idx = sequestration_index[source]
+    ledgers = {"co2e_sequestration":sequestration, "cost":cost}
+
+    for ledger_key, values in ledgers.items():
+        if values is None:
+            continue
+        ledger = datablock["impact"][ledger_key].copy()
+        ledger.values[idx] = values
+        datablock["impact"][ledger_key] = ledger
+
     return datablock
 
 def item_scaling(datablock, scale, source, scaling_nutrient,
@@ -116,19 +183,17 @@ def item_scaling(datablock, scale, source, scaling_nutrient,
     out = check_negative_source(out, "production", "imports")
     out = check_negative_source(out, "imports", "production")
 
-    ratio = out / food_orig
-    ratio = ratio.where(~np.isnan(ratio), 1)
-
     # Scale land use
-    pctg = datablock["land"]["percentage_land_use"].copy(deep=True)
-    land_out = production_land_scale(pctg, out, food_orig, bdleaf_conif_ratio=st.session_state.bdleaf_conif_ratio/100)
-    datablock["land"]["percentage_land_use"] = land_out
+    land = copy_land_state(datablock["land"]["state"])
+    land_out = production_land_scale(land, out, food_orig, bdleaf_conif_ratio=st.session_state.bdleaf_conif_ratio/100,
+                                     year=datablock["global_parameters"]["target_year"])
+    datablock["land"]["state"] = land_stage(land_out, datablock["land"]["state"],
+                                            "Food supply scaling", land_adoption(datablock))
 
     # Update per cap/day values and per year values using the same ratio, which
     # is independent of population growth
     qty_key = ["g/cap/day", "g_prot/cap/day", "g_fat/cap/day", "kCal/cap/day"]
-    for key in qty_key:
-        datablock["food"][key] *= ratio
+    datablock = propagate_ratio(datablock, out, food_orig, qty_key)
 
     return datablock
 
@@ -222,20 +287,16 @@ def balanced_scaling(fbs, items, scale, element, year=None, adoption=None,
             warnings.warn("Cannot keep food constant when scaling all items.")
             constant = False
 
-    # Define Dataarray to use as pivot
+    # Define year to use as pivot. This does not need to be one of the
+    # evaluated years of the array
     if "Year" in fbs.dims:
         if year is None:
             if np.isscalar(fbs.Year.values):
                 year = fbs.Year.values
-                fbs_toscale = fbs
             else:
                 year = fbs.Year.values[-1]
-                fbs_toscale = fbs.isel(Year=-1)
-        else:
-            fbs_toscale = fbs.sel(Year=year)
 
     else:
-        fbs_toscale = fbs
         try:
             year = fbs.Year.values
         except AttributeError:
@@ -255,7 +316,11 @@ def balanced_scaling(fbs, items, scale, element, year=None, adoption=None,
         y2 = np.min([year + timescale, fbs.Year.values[-1]])
         y3 = fbs.Year.values[-1]
         
-        scale_arr = scale_func(y0, y1, y2, y3, c_init=1, c_end = scale)
+        if adoption == "logistic":
+            basis = logistic_basis(fbs.Year.values, y2 - y1, y1)
+            scale_arr = expand_coefficients(logistic_coefficients(1, scale), basis)
+        else:
+            scale_arr = scale_func(y0, y1, y2, y3, c_init=1, c_end = scale)
         
         # # Extend the dataset to include all the years of the array
         # fbs_toscale = fbs_toscale * xr.ones_like(scale_arr)
@@ -306,8 +371,9 @@ def food_waste_model(datablock, waste_scale, kcal_rda, source, elasticity=None):
 
     # This is the maximum factor we can multiply food by to achieve consumption
     # equal to rda_kcal, multiplied by the ambition level
-    waste_factor = (food_orig["food"].isel(Year=-1).sum(dim="Item") - kcal_rda) \
-                 / food_orig["food"].isel(Year=-1).sum(dim="Item") \
+    target_year = datablock["global_parameters"]["target_year"]
+    waste_factor = (food_orig["food"].sel(Year=target_year).sum(dim="Item") - kcal_rda) \
+                 / food_orig["food"].sel(Year=target_year).sum(dim="Item") \
                  * (waste_scale / 100)
     
     waste_factor = waste_factor.to_numpy()
@@ -329,19 +395,17 @@ def food_waste_model(datablock, waste_scale, kcal_rda, source, elasticity=None):
     out = check_negative_source(out, "production")
     out = check_negative_source(out, "imports")
 
-    # Scale all per capita qantities proportionally
-    ratio = out / food_orig
-    ratio = ratio.where(~np.isnan(ratio), 1)
-
     # Scale land use
-    pctg = datablock["land"]["percentage_land_use"].copy(deep=True)
-    land_out = production_land_scale(pctg, out, food_orig, bdleaf_conif_ratio=st.session_state.bdleaf_conif_ratio/100)
+    land = copy_land_state(datablock["land"]["state"])
+    land_out = production_land_scale(land, out, food_orig, bdleaf_conif_ratio=st.session_state.bdleaf_conif_ratio/100,
+                                     year=datablock["global_parameters"]["target_year"])
 
-    datablock["land"]["percentage_land_use"] = land_out
+    datablock["land"]["state"] = land_stage(land_out, datablock["land"]["state"],
+                                            "Food waste", land_adoption(datablock))
 
+    # Scale all per capita qantities proportionally
     qty_key = ["g/cap/day", "g_prot/cap/day", "g_fat/cap/day", "kCal/cap/day"]
-    for key in qty_key:
-        datablock["food"][key] *= ratio
+    datablock = propagate_ratio(datablock, out, food_orig, qty_key)
 
     return datablock
 
@@ -405,6 +469,8 @@ def cultured_meat_model(datablock, cultured_scale, labmeat_co2e, items, copy_fro
     datablock["impact"]["gco2e/gfood"] = datablock["impact"]["gco2e/gfood"].fbs.add_items(new_items)
     datablock["impact"]["gco2e/gfood"].loc[{"Item":new_items}] = labmeat_co2e
 
+    datablock = mark_changed_items(datablock, np.union1d(item_changes(out, food_orig), new_items))
+
     # Recompute per capita values
     for key_pc, key_n in zip(qty_key[1:], nutrition_keys):
         datablock["food"][key_pc] = datablock["food"]["g/cap/day"] * datablock["food"][key_n]
@@ -412,17 +478,15 @@ def cultured_meat_model(datablock, cultured_scale, labmeat_co2e, items, copy_fro
     kcal_cap_day = datablock["food"]["kCal/cap/day"]
 
     out_kcal_cap_day = scale_kcal_feed(kcal_cap_day, kcal_orig, new_items)
-    ratio = out_kcal_cap_day / kcal_cap_day
-    ratio = ratio.where(~np.isnan(ratio), 1)
-
-    for key in qty_key:
-        datablock["food"][key] *= ratio
+    datablock = propagate_ratio(datablock, out_kcal_cap_day, kcal_cap_day, qty_key)
 
     # Scale land use
-    pctg = datablock["land"]["percentage_land_use"].copy(deep=True)
-    land_out = production_land_scale(pctg, out, food_orig, bdleaf_conif_ratio=st.session_state.bdleaf_conif_ratio/100)
+    land = copy_land_state(datablock["land"]["state"])
+    land_out = production_land_scale(land, out, food_orig, bdleaf_conif_ratio=st.session_state.bdleaf_conif_ratio/100,
+                                     year=datablock["global_parameters"]["target_year"])
 
-    datablock["land"]["percentage_land_use"] = land_out
+    datablock["land"]["state"] = land_stage(land_out, datablock["land"]["state"],
+                                            "Cultured meat", land_adoption(datablock))
 
     return datablock
 
@@ -434,21 +498,145 @@ def compute_emissions(datablock):
     pop = datablock["population"]["population"]
     pop_world = pop.sel(Region = 826)
 
-    # Compute emissions per capita per day
-    co2e_cap_day = datablock["food"]["g/cap/day"] * datablock["impact"]["gco2e/gfood"]
+    food = datablock["food"]["g/cap/day"]
+    impacts = datablock["impact"]["gco2e/gfood"]
+    co2e_cap_day = datablock["food"].get("g_co2e/cap/day")
+    changed = datablock["food"].get("changed_items")
+
+    # Compute emissions per capita per day. Only the rows of the items
+    # flagged by the nodes are recomputed, the rest are kept from the
+    # projection
+    if changed is None or co2e_cap_day is None \
+        or not np.array_equal(co2e_cap_day.Year.values, food.Year.values):
+
+        co2e_cap_day = food * impacts
+
+    else:
+        changed = changed.reindex(Item=food.Item.values, fill_value=True)
+        items = food.Item.values[changed.values | ~np.isin(food.Item.values, co2e_cap_day.Item.values)]
+
+        co2e_cap_day = co2e_cap_day.reindex(Item=food.Item.values)
+        co2e_cap_day = co2e_cap_day.assign_coords({name:food[name] for name in food.coords
+                                                   if food[name].dims == ("Item",)})
+        if len(items):
+            co2e_cap_day = write_item_rows(co2e_cap_day, food.sel(Item=items) * impacts.sel(Item=items))
 
     # Compute emissions per year
     datablock["food"]["g_co2e/cap/day"] = co2e_cap_day
     datablock["impact"]["g_co2e/year"] = co2e_cap_day * pop_world * 365.25
 
+    return clear_changed_items(datablock)
+
+def compute_metrics(datablock):
+    """Computes the headline metrics shown across the views, for every
+    evaluated year, and stores them in datablock["metrics"].
+
+    The metrics are:
+
+    ssr : Self-sufficiency ratio for each food quantity in
+        metric_quantities, with dimensions Quantity and Year.
+    origin_supply : Production and domestic use per item origin, for each
+        food quantity.
+    emissions, origin_emissions : Production emissions, in t CO2e / year, in
+        total and per item origin.
+    sequestration, land_sinks, forest_sinks, removals : Total sequestration,
+        in t CO2e / year, and its land sink, forest and removals sources.
+    net_emissions : Production emissions minus total sequestration.
+    sector_balance : Sectoral emissions and removals, in Mt CO2e / year, with
+        the agriculture, land use sinks and removals sectors computed.
+    """
+
+    food = datablock["food"]
+    metrics = {}
+
+    # Supply quantities on a common Quantity dimension, so every reduction
+    # is computed once for all quantities and years
+    quantities = [quantity for quantity in metric_quantities if quantity in food]
+    supply = xr.concat([food[quantity][["production", "imports", "exports"]] for quantity in quantities],
+                       dim="Quantity", join="outer").fillna(0)
+    supply = supply.assign_coords(Quantity=quantities)
+    supply["domestic"] = supply["production"] + supply["imports"] - supply["exports"]
+
+    metrics["ssr"] = supply["production"].sum(dim="Item") / supply["domestic"].sum(dim="Item")
+    metrics["origin_supply"] = group_sum(supply[["production", "domestic"]], "Item_origin", "Item",
+                                         food.get("memberships"))
+
+    # Emissions and sequestration, in t CO2e / year
+    emissions = datablock["impact"]["g_co2e/year"]["production"] / 1e6
+    sequestration = datablock["impact"]["co2e_sequestration"]
+
+    metrics["emissions"] = emissions.sum(dim="Item")
+    metrics["origin_emissions"] = group_sum(emissions, "Item_origin", "Item", food.get("memberships"))
+    metrics["sequestration"] = sequestration.sum(dim="Item")
+    metrics["land_sinks"] = sequestration.isel(Item=land_sink_index).sum(dim="Item")
+    metrics["forest_sinks"] = sequestration.isel(Item=forest_sink_index).sum(dim="Item")
+    metrics["removals"] = sequestration.isel(Item=removals_index).sum(dim="Item")
+    metrics["net_emissions"] = metrics["emissions"] - metrics["sequestration"]
+
+    # Sectoral balance, in Mt CO2e / year. Non agrifood sectors are fixed
+    balance = xr.DataArray(data=np.array(list(sector_emissions_dict.values()), dtype=float),
+                           name="Sectoral emissions",
+                           coords={"Sector":list(sector_emissions_dict.keys())})
+    balance = balance.expand_dims(Year=emissions.Year.values, axis=1).copy()
+    balance.loc[{"Sector":"Agriculture"}] = metrics["emissions"] / 1e6
+    balance.loc[{"Sector":"Land use sinks"}] = -metrics["land_sinks"] / 1e6
+    balance.loc[{"Sector":"Removals"}] = -metrics["removals"] / 1e6
+    metrics["sector_balance"] = balance
+
+    datablock["metrics"] = metrics
+
+    return datablock
+
+def expand_steady_tail(datablock):
+    """Expands the food and impact arrays evaluated on a strided steady state
+    tail of years to yearly values.
+
+    After the adoption period every intervention curve is flat, and only
+    smooth drivers such as population keep changing, so the tail years
+    between the evaluated ones are linearly interpolated.
+    """
+
+    years = np.asarray(datablock["global_parameters"]["years"])
+    annual_years = np.arange(years[0], years[-1]+1)
+
+    if len(annual_years) == len(years):
+        return datablock
+
+    for group in ["food", "impact"]:
+        for key, value in datablock[group].items():
+            if isinstance(value, (xr.DataArray, xr.Dataset)) \
+                and "Year" in value.dims \
+                and np.array_equal(value.Year.values, years):
+
+                datablock[group][key] = interpolate_years(value, annual_years)
+
     return datablock
 
+def interpolate_years(da, years):
+    """Linearly interpolates an array with a Year dimension to a new set of
+    years within its range. Evaluated years are kept exactly."""
+
+    da_years = da.Year.values
+    i_hi = np.clip(np.searchsorted(da_years, years), 1, len(da_years)-1)
+    i_lo = i_hi - 1
+
+    weight = (years - da_years[i_lo]) / (da_years[i_hi] - da_years[i_lo])
+    weight = xr.DataArray(weight, dims="Year", coords={"Year":years})
+
+    lo = da.isel(Year=i_lo).assign_coords(Year=years)
+    hi = da.isel(Year=i_hi).assign_coords(Year=years)
+
+    out = xr.where(weight == 1, hi, lo * (1-weight) + hi * weight, keep_attrs=True)
+
+    return out.transpose(*da.dims)
+
 def compute_t_anomaly(datablock):
     """Computes the temperature anomaly, concentration and radiation forcing from
     the per year emissions using the FAIR model.
-    """
 
-    from agrifoodpy.impact.model import fair_co2_only
+    FaIR responses are cached on the emissions trajectory quantised to
+    temperature.fair_tolerance, so only new trajectories trigger a FaIR run.
+    """
 
     # g co2e / year
     g_co2e_year = datablock["impact"]["g_co2e/year"]["production"].sum(
@@ -458,7 +646,7 @@ def compute_t_anomaly(datablock):
     Gt_co2e_year = g_co2e_year * 1e-15
 
     # Compute temperature anomaly based on emissions
-    T, C, F = fair_co2_only(Gt_co2e_year)
+    T, C, F = fair_response(Gt_co2e_year)
 
     T = T.rename({"timebounds": "Year"})
         
@@ -469,63 +657,67 @@ def compute_t_anomaly(datablock):
     return datablock
 
 def forest_land_model(datablock, forest_fraction, bdleaf_conif_ratio,
-                      map_mask=None, mask_vals=None):
+                      map_mask=None, mask_vals=None, priority=None):
     """Replaces arable and livestock land with forest land.
     If positive, spare_fraction only replaces pasature land and changes it to forest land.
     If negative, spare_fraction only replaces forest land and changes it to a mix of
     pasture land and arable land, which depends on the original land distribution.
+    If a priority ranking is given, positive changes convert pasture cells
+    in rank order instead of a uniform fraction of every cell.
     """
     
     timescale = datablock["global_parameters"]["timescale"]
-    pctg = datablock["land"]["percentage_land_use"].copy(deep=True)
-    old_use_pasture = datablock["land"]["percentage_land_use"].sel({"aggregate_class":["Improved grassland", "Semi-natural grassland"]}).sum()
-    old_use_arable = datablock["land"]["percentage_land_use"].sel({"aggregate_class":["Arable"]}).sum()
-    baseline_pctg = datablock["land"]["baseline"]
-
-    # if no alc grade is provided, then use the whole map
-    if mask_vals is not None or map_mask is not None:
-        alc = datablock["land"][map_mask]
-        alc_mask = np.isin(alc, mask_vals)
-    else:
-        alc_mask = np.ones_like(pctg, dtype=bool)
+    land = copy_land_state(datablock["land"]["state"])
+    pasture = ["Improved grassland", "Semi-natural grassland"]
+    forest = ["Broadleaf woodland", "Coniferous woodland"]
+    forest_weights = [bdleaf_conif_ratio, 1-bdleaf_conif_ratio]
+    old_use_pasture = land_area(land, pasture)
+    old_use_arable = land_area(land, "Arable")
 
-    total_uk_land = pctg.sum()
+    total_uk_land = land_area(land)
 
-    total_forestable_pasture_land = pctg.where(alc_mask, other=0).sel({"aggregate_class":["Improved grassland", "Semi-natural grassland"]}).sum()
-    total_forestable_arable_land = pctg.where(alc_mask, other=0).sel({"aggregate_class":["Arable"]}).sum()
+    # if no mask values are provided, then use the whole map
+    total_forestable_pasture_land = land_area(land, pasture, map_mask, mask_vals)
+    total_forestable_arable_land = land_area(land, "Arable", map_mask, mask_vals)
 
     pasture_to_agricultural = total_forestable_pasture_land / (total_forestable_arable_land + total_forestable_pasture_land)
 
     forestable_pasture_ratio = total_forestable_pasture_land / total_uk_land
     forestable_arable_ratio = total_forestable_arable_land / total_uk_land
 
-    to_forest_pasture = pctg.where(alc_mask, other=0).sel({"aggregate_class":["Improved grassland", "Semi-natural grassland"]})
-    to_forest_arable = pctg.where(alc_mask, other=0).sel({"aggregate_class":"Arable"})
-
     # Spare the specified land type
-    if forest_fraction >= 0:
-        delta_forest_pasture = to_forest_pasture * forest_fraction / forestable_pasture_ratio
+    if forest_fraction >= 0 and priority is not None:
+        land_allocate(land, pasture, forest,
+                      forest_fraction * total_uk_land, priority,
+                      weights=forest_weights,
+                      mask_layer=map_mask, mask_values=mask_vals)
+
+    elif forest_fraction >= 0:
+        land_transfer(land, pasture, forest,
+                      forest_fraction / forestable_pasture_ratio,
+                      weights=forest_weights,
+                      mask_layer=map_mask, mask_values=mask_vals)
         
     else:
-        delta_forest_pasture = to_forest_pasture * forest_fraction / forestable_pasture_ratio * pasture_to_agricultural
-        delta_forest_arable = to_forest_arable * forest_fraction / forestable_arable_ratio * (1-pasture_to_agricultural)
-        pctg.loc[{"aggregate_class":"Arable"}] -= delta_forest_arable
-        pctg.loc[{"aggregate_class":"Broadleaf woodland"}] += delta_forest_arable*bdleaf_conif_ratio
-        pctg.loc[{"aggregate_class":"Coniferous woodland"}] += delta_forest_arable*(1-bdleaf_conif_ratio)
-        
-    pctg.loc[{"aggregate_class":["Improved grassland", "Semi-natural grassland"]}] -= delta_forest_pasture
-    pctg.loc[{"aggregate_class":"Broadleaf woodland"}] += delta_forest_pasture.sum(dim="aggregate_class")*bdleaf_conif_ratio
-    pctg.loc[{"aggregate_class":"Coniferous woodland"}] += delta_forest_pasture.sum(dim="aggregate_class")*(1-bdleaf_conif_ratio)
+        land_transfer(land, "Arable", forest,
+                      forest_fraction / forestable_arable_ratio * (1-pasture_to_agricultural),
+                      weights=forest_weights,
+                      mask_layer=map_mask, mask_values=mask_vals)
+        land_transfer(land, pasture, forest,
+                      forest_fraction / forestable_pasture_ratio * pasture_to_agricultural,
+                      weights=forest_weights,
+                      mask_layer=map_mask, mask_values=mask_vals)
 
     # Add spared class to the land use map
-    datablock["land"]["percentage_land_use"] = pctg
+    datablock["land"]["state"] = land_stage(land, datablock["land"]["state"],
+                                            "Forested land", land_adoption(datablock))
 
     # Scale food production and imports
-    new_use_pasture = pctg.sel({"aggregate_class":["Improved grassland", "Semi-natural grassland"]}).sum()
-    new_use_arable = pctg.sel({"aggregate_class":"Arable"}).sum()
+    new_use_pasture = land_area(land, pasture)
+    new_use_arable = land_area(land, "Arable")
     
-    scale_use_pasture = (new_use_pasture/old_use_pasture).to_numpy()
-    scale_use_arable = (new_use_arable/old_use_arable).to_numpy()
+    scale_use_pasture = new_use_pasture/old_use_pasture
+    scale_use_arable = new_use_arable/old_use_arable
 
     food_orig = datablock["food"]["g/cap/day"]
     scale_forest_pasture = logistic_food_supply(food_orig, timescale, 1, scale_use_pasture)
@@ -549,56 +741,44 @@ def forest_land_model(datablock, forest_fraction, bdleaf_conif_ratio,
     out = check_negative_source(out, "production")
     out = check_negative_source(out, "imports")
 
-    ratio = out / food_orig
-    ratio = ratio.where(~np.isnan(ratio), 1)
-
     # Update per cap/day values and per year values using the same ratio, which
     # is independent of population growth
     qty_key = ["g/cap/day", "g_prot/cap/day", "g_fat/cap/day", "kCal/cap/day"]
-    for key in qty_key:
-        datablock["food"][key] *= ratio
+    datablock = propagate_ratio(datablock, out, food_orig, qty_key)
 
     # datablock["food"]["g/cap/day"] = out
 
     return datablock
 
 def peatland_restoration(datablock, restore_fraction, land_type, items,
-                         peat_map_key=None, mask_val=None):
+                         peat_map_key=None, mask_val=None, priority=None):
     """Replaces a specified land type fraction and sets it to a new type called
     'peatland'. Scales food production and imports to reflect the change in land
-    use.
+    use. If a priority ranking is given, cells are restored in rank order
+    instead of a uniform fraction of every cell.
     """
         
     timescale = datablock["global_parameters"]["timescale"]
-    peat_map_da = datablock["land"][peat_map_key]
-    pctg = datablock["land"]["percentage_land_use"].copy(deep=True)
-    old_use = datablock["land"]["percentage_land_use"].sel({"aggregate_class":land_type}).sum()
-
-    # if no alc grade is provided, then use the whole map
-    if mask_val is not None:
-        peat_mask = np.isin(peat_map_da, mask_val)
+    land = copy_land_state(datablock["land"]["state"])
+    old_use = land_area(land, land_type)
+
+    # Spare the specified land type. If no mask value is provided, then use
+    # the whole map
+    if priority is not None:
+        restore_area = restore_fraction * land_area(land, land_type, peat_map_key, mask_val)
+        land_allocate(land, land_type, "Peatland", restore_area, priority,
+                      mask_layer=peat_map_key, mask_values=mask_val)
     else:
-        peat_mask = np.ones_like(pctg, dtype=bool)
-
-    to_spare = pctg.where(peat_mask, other=0).sel({"aggregate_class":land_type})
-
-    # Spare the specified land type
-    delta_spared =  to_spare * restore_fraction
-    pctg.loc[{"aggregate_class":land_type}] -= delta_spared
-
-    if "Peatland" not in pctg.aggregate_class.values:
-        spared_new_class = xr.zeros_like(pctg.isel(aggregate_class=0)).where(np.isfinite(pctg.isel(aggregate_class=0)))
-        spared_new_class["aggregate_class"] = "Peatland"
-        pctg = xr.concat([pctg, spared_new_class], dim="aggregate_class")
-
-    pctg.loc[{"aggregate_class":"Peatland"}] += delta_spared.sum(dim="aggregate_class")
+        land_transfer(land, land_type, "Peatland", restore_fraction,
+                      mask_layer=peat_map_key, mask_values=mask_val)
 
     # Add spared class to the land use map
-    datablock["land"]["percentage_land_use"] = pctg
+    datablock["land"]["state"] = land_stage(land, datablock["land"]["state"],
+                                            "Peatland restoration", land_adoption(datablock))
 
     # Scale food production and imports
-    new_use = pctg.sel({"aggregate_class":land_type}).sum()
-    scale_use = (new_use/old_use).to_numpy()
+    new_use = land_area(land, land_type)
+    scale_use = new_use/old_use
 
     food_orig = datablock["food"]["g/cap/day"]
     scale_spare = logistic_food_supply(food_orig, timescale, 1, scale_use)
@@ -611,15 +791,11 @@ def peatland_restoration(datablock, restore_fraction, land_type, items,
                                   items=scaled_items,
                                   add=False)
     datablock["food"]["g/cap/day"] = out
-    
-    ratio = out / food_orig
-    ratio = ratio.where(~np.isnan(ratio), 1)
 
     # Update per cap/day values and per year values using the same ratio, which
     # is independent of population growth
     qty_key = ["g_prot/cap/day", "g_fat/cap/day", "kCal/cap/day"]
-    for key in qty_key:
-        datablock["food"][key] *= ratio
+    datablock = propagate_ratio(datablock, out, food_orig, qty_key)
 
     # datablock["food"]["g/cap/day"] = out
 
@@ -641,12 +817,12 @@ def ccs_model(datablock, waste_BECCS, overseas_BECCS, DACCS):
     
     timescale = datablock["global_parameters"]["timescale"]
     food_orig = datablock["food"]["g/cap/day"]
-    pctg = datablock["land"]["percentage_land_use"]
+    land = datablock["land"]["state"]
 
     # Compute the total area of BECCS land used in hectares, and the total
     # sequestration in Mt CO2e / year
 
-    land_BECCS_area = pctg.sel({"aggregate_class":"BECCS"}).sum().to_numpy()
+    land_BECCS_area = land_area(land, "BECCS")
     land_BECCS = land_BECCS_area * st.session_state.beccs_crops_seq_ha_yr
 
     logistic_0_val = logistic_food_supply(food_orig, timescale, 0, 1)
@@ -656,22 +832,6 @@ def ccs_model(datablock, waste_BECCS, overseas_BECCS, DACCS):
     DACCS_seq_array = DACCS * logistic_0_val
     land_BECCS_seq_array = land_BECCS * logistic_0_val
 
-    # Create a dataset with the different sequestration sources
-    seq_ds = xr.Dataset({"BECCS from waste": waste_BECCS_seq_array,
-                         "BECCS from overseas biomass": overseas_BECCS_seq_array,
-                         "BECCS from land": land_BECCS_seq_array,
-                         "DACCS": DACCS_seq_array})
-    
-    seq_da = seq_ds.to_array(dim="Item", name="sequestration")
-    
-    if "co2e_sequestration" not in datablock["impact"]:
-        datablock["impact"]["co2e_sequestration"] = seq_da
-    else:
-        # append sequestration to existing sequestration da
-        seq_da_in = datablock["impact"]["co2e_sequestration"]
-        seq_da = xr.concat([seq_da_in, seq_da], dim="Item")
-        datablock["impact"]["co2e_sequestration"] = seq_da
-
     # Compute the total cost of sequestration in pounds per year
     cost_BECCS_tCO2e = linear_scale(food_orig.Year.values[0],
                               2030,
@@ -687,23 +847,29 @@ def ccs_model(datablock, waste_BECCS, overseas_BECCS, DACCS):
                                     c_init=245,
                                     c_end=180)
 
+    # Keep only the evaluated years
+    cost_BECCS_tCO2e = cost_BECCS_tCO2e.sel(Year=food_orig.Year.values)
+    cost_DACCS_tCO2e = cost_DACCS_tCO2e.sel(Year=food_orig.Year.values)
+
     cost_waste_BECCS = waste_BECCS_seq_array * cost_BECCS_tCO2e
     cost_overseas_BECCS = overseas_BECCS_seq_array * cost_BECCS_tCO2e
     cost_land_BECCS = land_BECCS_seq_array * cost_BECCS_tCO2e
     cost_DACCSS = DACCS_seq_array * cost_DACCS_tCO2e
 
-    cost_CCS_ds = xr.Dataset({"BECCS from waste": cost_waste_BECCS,
-                             "BECCS from overseas biomass": cost_overseas_BECCS,
-                             "BECCS from land": cost_land_BECCS,
-                             "DACCS": cost_DACCSS})
-    
-    cost_CCS_da = cost_CCS_ds.to_array(dim="Item", name="cost")
-    datablock["impact"]["cost"] = cost_CCS_da
+    # Write the different sequestration sources and their costs to the ledger
+    datablock = write_sequestration(datablock, "BECCS from waste", waste_BECCS_seq_array, cost_waste_BECCS)
+    datablock = write_sequestration(datablock, "BECCS from overseas biomass", overseas_BECCS_seq_array, cost_overseas_BECCS)
+    datablock = write_sequestration(datablock, "BECCS from land", land_BECCS_seq_array, cost_land_BECCS)
+    datablock = write_sequestration(datablock, "DACCS", DACCS_seq_array, cost_DACCSS)
 
     return datablock    
 
-def forest_sequestration_model(datablock, land_type, seq):
-    """Computes total annual sequestration from the different sources"""
+def forest_sequestration_model(datablock, land_type, seq, growth_curves=False):
+    """Computes total annual sequestration from the different sources.
+    If growth_curves is True, land converted into each class follows the
+    carbon stock growth curves in carbon.py, instead of sequestering at a
+    constant rate per hectare.
+    """
     
     if np.isscalar(land_type):
         land_type = [land_type]
@@ -715,29 +881,30 @@ def forest_sequestration_model(datablock, land_type, seq):
     food_orig = datablock["food"]["g/cap/day"]
 
     # Load the land use data from the datablock
-    pctg = datablock["land"]["percentage_land_use"].copy(deep=True)
+    land = datablock["land"]["state"]
+
+    if growth_curves:
+        sequestration = carbon_sequestration(land, land_type, seq,
+                                             land_adoption(datablock),
+                                             food_orig.Year.values)
+        for land_type_i in land_type:
+            datablock = write_sequestration(datablock, land_type_i,
+                                            sequestration.sel(aggregate_class=land_type_i).values)
+
+        return datablock
+
     logistic_0_val = logistic_food_supply(food_orig, timescale, 0, 1)
 
     for land_type_i, seq_i in zip(land_type, seq):
 
         # Compute forest area in ha, maximum anual sequestration, and growth curve
-        area_land = pctg.loc[{"aggregate_class":land_type_i}].sum().to_numpy()
+        area_land = land_area(land, land_type_i)
         max_seq = area_land * seq_i
 
     
         land_type_seq = max_seq * logistic_0_val
 
-        # Create a dataset with the different sequestration sources
-        seq_ds = xr.Dataset({land_type_i: land_type_seq})
-        seq_da = seq_ds.to_array(dim="Item", name="sequestration")
-    
-        if "co2e_sequestration" not in datablock["impact"]:
-            datablock["impact"]["co2e_sequestration"] = seq_da
-        else:
-            # append sequestration to existing sequestration da
-            seq_da_in = datablock["impact"]["co2e_sequestration"]
-            seq_da = xr.concat([seq_da_in, seq_da], dim="Item")
-            datablock["impact"]["co2e_sequestration"] = seq_da
+        datablock = write_sequestration(datablock, land_type_i, land_type_seq)
 
     # Compute agroecology sequestration
 
@@ -749,9 +916,23 @@ def scale_impact(datablock, scale_factor, item_origin=None, items=None):
     """
 
     timescale = datablock["global_parameters"]["timescale"]
+    food_orig = datablock["food"]["g/cap/day"]
+
+    # if no items are specified, do nothing
+    if items is None and item_origin is None:
+        return datablock
+
+    scale = logistic_food_supply(food_orig, timescale, 1, scale_factor)
+
+    return impact_curve_scaling(datablock, scale, item_origin, items)
+
+def impact_curve_scaling(datablock, scale, item_origin=None, items=None):
+    """Multiplies the impact values for the selected items by a scale curve.
+    """
+
     # load quantities and impacts
     food_orig = datablock["food"]["g/cap/day"]
-    impacts = datablock["impact"]["gco2e/gfood"].copy(deep=True)
+    impacts = datablock["impact"]["gco2e/gfood"]
 
     # if no items are specified, do nothing
     if items is None and item_origin is None:
@@ -765,14 +946,16 @@ def scale_impact(datablock, scale_factor, item_origin=None, items=None):
         elif item_origin is not None:
             items = food_orig.sel(Item = food_orig.Item_origin==item_origin).Item.values
             items = items[np.isin(items, impacts.Item.values)]
-    
-    scale = logistic_food_supply(food_orig, timescale, 1, scale_factor)
 
-    # scale the impacts
-    impacts.loc[{"Item": items}] *= scale
+    # a scale of one leaves the impacts unchanged
+    if np.all(scale == 1):
+        return datablock
+
+    # scale the impacts, only on the selected rows
+    impacts = write_item_rows(impacts, impacts.sel(Item=items) * scale)
     datablock["impact"]["gco2e/gfood"] = impacts
 
-    return datablock
+    return mark_changed_items(datablock, items)
 
 def scale_production(datablock, scale_factor, item_origin=None, items=None):
     """ Scales the production values for the selected items by multiplying them by
@@ -780,9 +963,23 @@ def scale_production(datablock, scale_factor, item_origin=None, items=None):
     """
 
     timescale = datablock["global_parameters"]["timescale"]
+    food_orig = datablock["food"]["g/cap/day"]
+
+    # if no items are specified, do nothing
+    if items is None and item_origin is None:
+        return datablock
+
+    scale_prod = logistic_food_supply(food_orig, timescale, 1, scale_factor)
+
+    return production_curve_scaling(datablock, scale_prod, item_origin, items)
+
+def production_curve_scaling(datablock, scale_prod, item_origin=None, items=None):
+    """Multiplies the production values for the selected items by a scale
+    curve, moving the difference to imports.
+    """
 
     # load quantities and impacts
-    food_orig = datablock["food"]["g/cap/day"].copy(deep=True)
+    food_orig = datablock["food"]["g/cap/day"]
 
     # if no items are specified, do nothing
     if items is None and item_origin is None:
@@ -796,62 +993,105 @@ def scale_production(datablock, scale_factor, item_origin=None, items=None):
         elif item_origin is not None:
             items = food_orig.sel(Item = food_orig.Item_origin==item_origin).Item.values
 
-    scale_prod = logistic_food_supply(food_orig, timescale, 1, scale_factor)
-
-    out = food_orig.fbs.scale_add(element_in="production",
-                                element_out="imports",
-                                scale=scale_prod,
-                                items=items,
-                                add=False)
-    
-    ratio = out / food_orig
-    ratio = ratio.where(~np.isnan(ratio), 1)
+    # Only the rows of the selected items are scaled
+    food_items = food_orig.sel(Item=items)
+    out = food_items.fbs.scale_add(element_in="production",
+                                   element_out="imports",
+                                   scale=scale_prod,
+                                   add=False)
 
     # Update per cap/day values and per year values using the same ratio, which
     # is independent of population growth
     qty_key = ["g/cap/day", "g_prot/cap/day", "g_fat/cap/day", "kCal/cap/day"]
-    for key in qty_key:
-        datablock["food"][key] *= ratio
+    datablock = propagate_ratio(datablock, out, food_items, qty_key)
 
     return datablock
 
-def BECCS_farm_land(datablock, farm_percentage, land_type="Arable",
-                    new_land_type="BECCS", mask_map=None, mask_values=None):
-    """Repurposes farm land for BECCS, reducing the amount of food production,
-    and increasing the amount of CO2e sequestered.
+def fused_scaling(datablock, impact_factors=None, production_factors=None,
+                  item_origin=None, items=None):
+    """Applies a run of scale_impact and scale_production nodes acting on the
+    same items in a single pass.
+
+    The factors of each node are purely multiplicative, so the logistic curves
+    of every node are multiplied into one combined curve per quantity on the
+    logistic basis, which is then expanded and applied once. The result is the
+    same as running the nodes one after the other.
+
+    Parameters
+    ----------
+    datablock : dict
+        The datablock dictionary.
+    impact_factors : list, optional
+        Scale factors of the fused scale_impact nodes.
+    production_factors : list, optional
+        Scale factors of the fused scale_production nodes.
+    item_origin : str, optional
+        Item origin of the items to scale.
+    items : list, optional
+        Items to scale. Takes priority over item_origin.
+
+    Returns
+    -------
+    datablock : dict
+        The updated datablock dictionary.
     """
 
     timescale = datablock["global_parameters"]["timescale"]
-    pctg = datablock["land"]["percentage_land_use"].copy(deep=True)
-    old_use = datablock["land"]["percentage_land_use"].sel({"aggregate_class":land_type}).sum()
+    food_orig = datablock["food"]["g/cap/day"]
 
-    mask_map = datablock["land"][mask_map].copy(deep=True)
-    
-    # if no alc grade is provided, then use the whole map
-    if mask_values is not None:
-        peat_mask = np.isin(mask_map, mask_values)
-    else:
-        peat_mask = np.ones_like(pctg, dtype=bool)
+    # if no items are specified, do nothing
+    if items is None and item_origin is None:
+        return datablock
 
-    to_spare = pctg.where(peat_mask, other=0).sel({"aggregate_class":land_type})
+    basis = logistic_basis(food_orig.Year.values, timescale)
 
-    # Spare the specified land type
-    delta_spared =  to_spare * farm_percentage
-    pctg.loc[{"aggregate_class":land_type}] -= delta_spared
+    # Combine the curves on the logistic basis and expand them only once
+    if impact_factors:
+        coefs = logistic_coefficients(1, impact_factors[0])
+        for scale_factor in impact_factors[1:]:
+            coefs = multiply_coefficients(coefs, logistic_coefficients(1, scale_factor))
+        scale = expand_coefficients(coefs, basis)
+        datablock = impact_curve_scaling(datablock, scale, item_origin, items)
 
-    if new_land_type not in pctg.aggregate_class.values:
-        spared_new_class = xr.zeros_like(pctg.isel(aggregate_class=0)).where(np.isfinite(pctg.isel(aggregate_class=0)))
-        spared_new_class["aggregate_class"] = new_land_type
-        pctg = xr.concat([pctg, spared_new_class], dim="aggregate_class")
+    if production_factors:
+        coefs = logistic_coefficients(1, production_factors[0])
+        for scale_factor in production_factors[1:]:
+            coefs = multiply_coefficients(coefs, logistic_coefficients(1, scale_factor))
+        scale = expand_coefficients(coefs, basis)
+        datablock = production_curve_scaling(datablock, scale, item_origin, items)
+
+    return datablock
+
+def BECCS_farm_land(datablock, farm_percentage, land_type="Arable",
+                    new_land_type="BECCS", mask_map=None, mask_values=None,
+                    priority=None):
+    """Repurposes farm land for BECCS, reducing the amount of food production,
+    and increasing the amount of CO2e sequestered. If a priority ranking is
+    given, cells are repurposed in rank order instead of a uniform fraction of
+    every cell.
+    """
 
-    pctg.loc[{"aggregate_class":new_land_type}] += delta_spared
+    timescale = datablock["global_parameters"]["timescale"]
+    land = copy_land_state(datablock["land"]["state"])
+    old_use = land_area(land, land_type)
+
+    # Spare the specified land type. If no mask value is provided, then use
+    # the whole map
+    if priority is not None:
+        farm_area = farm_percentage * land_area(land, land_type, mask_map, mask_values)
+        land_allocate(land, land_type, new_land_type, farm_area, priority,
+                      mask_layer=mask_map, mask_values=mask_values)
+    else:
+        land_transfer(land, land_type, new_land_type, farm_percentage,
+                      mask_layer=mask_map, mask_values=mask_values)
 
     # Add spared class to the land use map
-    datablock["land"]["percentage_land_use"] = pctg
+    datablock["land"]["state"] = land_stage(land, datablock["land"]["state"],
+                                            new_land_type, land_adoption(datablock))
 
     # Scale food production and imports
-    new_use = pctg.sel({"aggregate_class":land_type}).sum()
-    scale_use = (new_use/old_use).fillna(1).to_numpy()
+    new_use = land_area(land, land_type)
+    scale_use = new_use/old_use if old_use != 0 else 1
 
     food_orig = datablock["food"]["g/cap/day"]
     scale_spare = logistic_food_supply(food_orig, timescale, 1, scale_use)
@@ -864,15 +1104,12 @@ def BECCS_farm_land(datablock, farm_percentage, land_type="Arable",
                                   items=scaled_items,
                                   add=False)
     
-    ratio = out / food_orig
-    ratio = ratio.where(~np.isnan(ratio), 1)
     datablock["food"]["g/cap/day"] = out
 
     # Update per cap/day values and per year values using the same ratio, which
     # is independent of population growth
     qty_key = ["g_prot/cap/day", "g_fat/cap/day", "kCal/cap/day"]
-    for key in qty_key:
-        datablock["food"][key] *= ratio
+    datablock = propagate_ratio(datablock, out, food_orig, qty_key)
 
     return datablock
 
@@ -913,33 +1150,22 @@ def agroecology_model(datablock, land_percentage, land_type,
     """
 
     # Load land use and food data from datablock
-    pctg = datablock["land"]["percentage_land_use"].copy(deep=True)
+    land = copy_land_state(datablock["land"]["state"])
     food_orig = datablock["food"]["g/cap/day"].copy(deep=True)
-    old_use = pctg.sel({"aggregate_class":land_type}).sum()
-    alc = datablock["land"]["dominant_classification"]
+    old_use = land_area(land, land_type)
     timescale = datablock["global_parameters"]["timescale"]
 
-    # Compute land percentages to be converted to agroecology and remove them
-    # from the land_type classes
-    delta_agroecology = pctg.loc[{"aggregate_class":land_type}] * land_percentage
-    pctg.loc[{"aggregate_class":land_type}] -= delta_agroecology
-
-    # Add the agroecology percentage to the new agroecology class
-    if agroecology_class not in pctg.aggregate_class.values:
-        new_class = xr.zeros_like(pctg.isel(aggregate_class=0)).where(np.isfinite(pctg.isel(aggregate_class=0)))
-        new_class["aggregate_class"] = agroecology_class
-        pctg = xr.concat([pctg, new_class], dim="aggregate_class")
-
-    delta_total = delta_agroecology.sum(dim="aggregate_class")
-    pctg.loc[{"aggregate_class":agroecology_class}] += delta_total
+    # Move the land percentages to be converted to agroecology from the
+    # land_type classes to the new agroecology class
+    delta_total = land_transfer(land, land_type, agroecology_class,
+                                land_percentage)
 
     out = food_orig.copy(deep=True)
 
     # Reduce production of replaced items if they are provided
     if replaced_items is not None:
-        new_use = pctg.sel({"aggregate_class":land_type}).sum()
+        new_use = land_area(land, land_type)
         scale_use = (new_use/old_use) + (1-tree_coverage) * (1-new_use/old_use)
-        scale_use = scale_use.to_numpy()
 
         scale_arr = logistic_food_supply(out, timescale, 1, scale_use)
 
@@ -959,11 +1185,12 @@ def agroecology_model(datablock, land_percentage, land_type,
         if np.isscalar(item_yield):
             item_yield = [item_yield]
 
-        pop = datablock["population"]["population"].isel(Year=-1, Region=0)
+        target_year = datablock["global_parameters"]["target_year"]
+        pop = datablock["population"]["population"].sel(Year=target_year).isel(Region=0)
 
         for item, yld in zip(new_items, item_yield):
-            old_production = food_orig["production"].sel({"Item":item}).isel(Year=-1)
-            new_production = old_production + yld * delta_agroecology.sum()/pop
+            old_production = food_orig["production"].sel({"Item":item}).sel(Year=target_year)
+            new_production = old_production + yld * delta_total/pop
             production_scale = (new_production / old_production).to_numpy()
             production_scale_array = logistic_food_supply(food_orig, timescale, 1, production_scale)
 
@@ -974,35 +1201,21 @@ def agroecology_model(datablock, land_percentage, land_type,
                                 add=False)
         
     # Compute forest area in ha, maximum anual sequestration, and growth curve
-    area_agroecology = pctg.loc[{"aggregate_class":agroecology_class}].sum().to_numpy()
+    area_agroecology = land_area(land, agroecology_class)
     max_seq_agroecology = area_agroecology * seq_ha_yr
 
     agroecology_seq = logistic_food_supply(food_orig, timescale, 1, c_end=max_seq_agroecology)
     
-    # Create a dataset with the different sequestration sources
-    seq_ds = xr.Dataset({agroecology_class: agroecology_seq})
-    
-    seq_da = seq_ds.to_array(dim="Item", name="sequestration")
-    if "co2e_sequestration" not in datablock["impact"]:
-        datablock["impact"]["co2e_sequestration"] = seq_da
-
-    else:
-        # append sequestration to existing sequestration da
-        seq_da_in = datablock["impact"]["co2e_sequestration"]
-        seq_da = xr.concat([seq_da_in, seq_da], dim="Item")
-        datablock["impact"]["co2e_sequestration"] = seq_da
+    datablock = write_sequestration(datablock, agroecology_class, agroecology_seq)
 
     # Rewrite land use data to datablock
-    datablock["land"]["percentage_land_use"] = pctg
-
-    ratio = out / food_orig
-    ratio = ratio.where(~np.isnan(ratio), 1)
+    datablock["land"]["state"] = land_stage(land, datablock["land"]["state"],
+                                            agroecology_class, land_adoption(datablock))
 
     # Update per cap/day values and per year values using the same ratio, which
     # is independent of population growth
     qty_key = ["g/cap/day", "g_prot/cap/day", "g_fat/cap/day", "kCal/cap/day"]
-    for key in qty_key:
-        datablock["food"][key] *= ratio
+    datablock = propagate_ratio(datablock, out, food_orig, qty_key)
 
     return datablock
 
@@ -1056,19 +1269,217 @@ def check_negative_source(fbs, source, fallback=None):
 
     return fbs
 
+def propagate_ratio(datablock, out, food_orig, qty_key):
+    """Scales the per capita quantities in qty_key by the ratio between the
+    new and original food quantities.
+
+    out and food_orig can be restricted to the items touched by a node, the
+    other items keep their values. Only the rows of the items with a ratio
+    other than one are rescaled and flagged with mark_changed_items.
+    """
+
+    ratio = out / food_orig
+    ratio = ratio.where(~np.isnan(ratio), 1).reset_coords(drop=True)
+
+    changed = (ratio != 1).to_array()
+    changed = changed.any(dim=[dim for dim in changed.dims if dim != "Item"])
+    ratio = ratio.isel(Item=changed.values)
+
+    if ratio.sizes["Item"] == 0:
+        return datablock
+
+    for key in qty_key:
+        fbs = datablock["food"][key]
+        ratio_key = ratio.sel(Item=ratio.Item.isin(fbs.Item.values))
+        rows = fbs[list(ratio.data_vars)].sel(Item=ratio_key.Item.values) * ratio_key
+        write_item_rows(fbs, rows)
+
+    return mark_changed_items(datablock, ratio.Item.values)
+
+def write_item_rows(fbs, rows):
+    """Writes the rows of the items in rows into a food balance sheet or
+    DataArray with an Item dimension.
+
+    The arrays are copied before the rows are written, as they can be shared
+    with other datablocks. As with *=, the variables of a Dataset are replaced
+    on the same object, and a new DataArray is returned.
+    """
+
+    index = fbs.get_index("Item").get_indexer(rows.Item.values)
+
+    if isinstance(fbs, xr.DataArray):
+        return _write_rows(fbs, rows, index)
+
+    for element in rows.data_vars:
+        fbs[element] = _write_rows(fbs[element], rows[element], index)
+
+    return fbs
+
+def _write_rows(da, rows, index):
+    """Returns a copy of da with the Item positions in index set to rows"""
+
+    rows = rows.sel({dim:da[dim].values for dim in da.dims
+                     if dim != "Item" and dim in da.coords})
+
+    values = da.values.copy()
+    axis = da.dims.index("Item")
+    values[(slice(None),)*axis + (index,)] = rows.transpose(*da.dims).values
+
+    return da.copy(data=values)
+
+def mark_changed_items(datablock, items):
+    """Flags the items whose per capita quantities or emission factors were
+    changed by a node, so that compute_emissions only recomputes their rows.
+
+    The flags are stored as a boolean DataArray over the food items in
+    datablock["food"]["changed_items"]. It is replaced rather than written in
+    place, and items without a flag, such as newly added ones, are flagged.
+    """
+
+    food_items = datablock["food"]["g/cap/day"].Item.values
+    changed = datablock["food"].get("changed_items")
+
+    if changed is None:
+        changed = xr.DataArray(np.ones(len(food_items), dtype=bool),
+                               dims="Item", coords={"Item":food_items})
+    else:
+        changed = changed.reindex(Item=food_items, fill_value=True)
+
+    datablock["food"]["changed_items"] = changed | changed.Item.isin(items)
+
+    return datablock
+
+def clear_changed_items(datablock):
+    """Resets the changed item flags once the emissions are up to date"""
+
+    food_items = datablock["food"]["g/cap/day"].Item.values
+    datablock["food"]["changed_items"] = xr.DataArray(np.zeros(len(food_items), dtype=bool),
+                                                      dims="Item", coords={"Item":food_items})
+
+    return datablock
+
+def item_changes(out, ref):
+    """Returns the items with any value of out different from ref"""
+
+    changed = ((out != ref) & ~(out.isnull() & ref.isnull())).to_array()
+    changed = changed.any(dim=[dim for dim in changed.dims if dim != "Item"])
+
+    return changed.Item.values[changed.values]
+
 def logistic_food_supply(fbs, timescale, c_init, c_end):
     """Creates a logistic curve using the year range of the input food balance
     supply"""
 
-    y0 = fbs.Year.values[0]
-    y1 = 2021
-    y2 = 2021 + timescale
-    y3 = fbs.Year.values[-1]
-
-    scale = logistic_scale(y0, y1, y2, y3, c_init=c_init, c_end=c_end)
+    basis = logistic_basis(fbs.Year.values, timescale)
+    scale = expand_coefficients(logistic_coefficients(c_init, c_end), basis)
 
     return scale
 
+def land_adoption(datablock):
+    """Adoption curve of land use changes, evaluated on every year up to the
+    horizon. Land use changes follow the shared logistic basis, as the food
+    system changes they come from."""
+
+    years = np.arange(datablock["global_parameters"]["years"][0],
+                      datablock["global_parameters"]["horizon"]+1)
+
+    return logistic_basis(years, datablock["global_parameters"]["timescale"])
+
+def logistic_basis(years, timescale, y1=2021):
+    """Shared logistic adoption curve evaluated on a list of years.
+
+    The curve is 0 before y1, follows the same logistic shape as
+    agrifoodpy.utils.scaling.logistic_scale between y1 and y1 + timescale and
+    is 1 afterwards. Every logistic intervention curve is an affine function
+    of this basis, c_init + (c_end - c_init) * basis.
+
+    Parameters
+    ----------
+    years : array_like
+        Years at which to evaluate the basis.
+    timescale : int
+        Number of years for the adoption to complete.
+    y1 : int, optional
+        Year when the adoption starts.
+
+    Returns
+    -------
+    basis : xarray.DataArray
+        Basis values with a "Year" coordinate.
+    """
+
+    years = np.atleast_1d(years)
+    values = _logistic_basis_values(tuple(years.tolist()), timescale, y1)
+
+    return xr.DataArray(values, dims="Year", coords={"Year": years})
+
+@functools.lru_cache(maxsize=32)
+def _logistic_basis_values(years, timescale, y1):
+    years = np.array(years)
+    y2 = y1 + timescale
+
+    values = np.zeros(len(years))
+    if y1 < y2:
+        var_segment = np.logical_and(years >= y1, years < y2)
+        t = (years[var_segment] - y1) / (y2 - y1)
+        values[var_segment] = 1 / (1 + np.exp(-10 * (t - 0.5)))
+    values[years >= y2] = 1
+
+    values.flags.writeable = False
+    return values
+
+def logistic_coefficients(c_init, c_end):
+    """Coefficients of a logistic curve going from c_init to c_end on the
+    logistic basis.
+
+    Trajectories are represented as polynomials on the basis, with the
+    coefficient of basis**k stored at position k of the first axis. Products
+    of logistic curves stay in this representation, so any number of
+    multiplicative interventions reduces to a handful of coefficients.
+    """
+
+    c_init = np.asarray(c_init, dtype=float)
+    c_end = np.asarray(c_end, dtype=float)
+
+    return np.stack(np.broadcast_arrays(c_init, c_end - c_init))
+
+def multiply_coefficients(coefs_a, coefs_b):
+    """Coefficients of the product of two trajectories on the logistic basis"""
+
+    shape = np.broadcast_shapes(np.shape(coefs_a)[1:], np.shape(coefs_b)[1:])
+    out = np.zeros((len(coefs_a) + len(coefs_b) - 1,) + shape)
+    for i, coef_a in enumerate(coefs_a):
+        for j, coef_b in enumerate(coefs_b):
+            out[i+j] += coef_a * coef_b
+
+    return out
+
+def expand_coefficients(coefs, basis):
+    """Expands a trajectory on the logistic basis over the years of the basis.
+
+    Parameters
+    ----------
+    coefs : array_like
+        Trajectory coefficients, with the basis power along the first axis.
+        Additional axes are broadcast against the basis.
+    basis : xarray.DataArray
+        Logistic basis, as returned by logistic_basis.
+
+    Returns
+    -------
+    trajectory : xarray.DataArray
+        Trajectory values on the "Year" coordinate of the basis.
+    """
+
+    coefs = np.asarray(coefs, dtype=float)
+
+    # Horner evaluation of the polynomial on the basis
+    out = xr.zeros_like(basis) + coefs[-1]
+    for coef in coefs[-2::-1]:
+        out = out * basis + coef
+
+    return out
+
 def scale_kcal_feed(obs, ref, items):
     """Scales the feed quantities according to the difference in production of 
     specified items, on a calorie by calorie basis"""
@@ -1094,48 +1505,30 @@ def scale_kcal_feed(obs, ref, items):
     
     return out
 
-def production_land_scale(land, obs, ref, bdleaf_conif_ratio):
+def production_land_scale(land, obs, ref, bdleaf_conif_ratio, year=2050):
 
     # Obtain reference and observed production values
-    ref_livest = ref["production"].sel(Year=2050, Item=ref.Item_origin=="Animal Products").sum(dim="Item")
-    ref_arable = ref["production"].sel(Year=2050, Item=ref.Item_origin=="Vegetal Products").sum(dim="Item")
+    ref_livest = ref["production"].sel(Year=year, Item=ref.Item_origin=="Animal Products").sum(dim="Item")
+    ref_arable = ref["production"].sel(Year=year, Item=ref.Item_origin=="Vegetal Products").sum(dim="Item")
 
-    obs_livest = obs["production"].sel(Year=2050, Item=obs.Item_origin=="Animal Products").sum(dim="Item")
-    obs_arable = obs["production"].sel(Year=2050, Item=obs.Item_origin=="Vegetal Products").sum(dim="Item")
+    obs_livest = obs["production"].sel(Year=year, Item=obs.Item_origin=="Animal Products").sum(dim="Item")
+    obs_arable = obs["production"].sel(Year=year, Item=obs.Item_origin=="Vegetal Products").sum(dim="Item")
 
     # Compute ratios
     livest_ratio = obs_livest / ref_livest
     arable_ratio = obs_arable / ref_arable
 
-    # Scale land use types
-    delta_pasture = land.loc[{"aggregate_class":["Improved grassland", "Semi-natural grassland"]}] * (1-livest_ratio)
-    land.loc[{"aggregate_class":["Improved grassland", "Semi-natural grassland"]}] -= delta_pasture
-
-    delta_arable = land.loc[{"aggregate_class":"Arable"}] * (1-arable_ratio)
-    land.loc[{"aggregate_class":"Arable"}] -= delta_arable
+    # Scale land use types. Remaining or excess land is allocated to or from
+    # forest, so each cell still adds up to 100%
+    forest = ["Broadleaf woodland", "Coniferous woodland"]
+    forest_weights = [bdleaf_conif_ratio, 1-bdleaf_conif_ratio]
 
-    # Remaining or excess land is allocated to or from forest
-    # Calculate total percentage
-    total = land.sum(dim="aggregate_class")
-    
-    # Check if total differs from 100
-    delta = 100 - total
-    delta = delta.where(np.isfinite(land.isel(aggregate_class=0)))
-    
-    # Adjust Broadleaf woodland to maintain 100% total
-    if "Broadleaf woodland" in land.aggregate_class:
-        land.loc[{"aggregate_class":"Broadleaf woodland"}] += delta*bdleaf_conif_ratio
-    else:
-        # If Broadleaf woodland doesn't exist, create it
-        land.loc[{"aggregate_class":"Broadleaf woodland"}] = delta*bdleaf_conif_ratio
+    land_transfer(land, ["Improved grassland", "Semi-natural grassland"],
+                  forest, float(1-livest_ratio), weights=forest_weights)
+    land_transfer(land, "Arable", forest, float(1-arable_ratio),
+                  weights=forest_weights)
+    land_fill(land, forest, weights=forest_weights, total=100)
 
-    # Adjust Broadleaf woodland to maintain 100% total
-    if "Coniferous woodland" in land.aggregate_class:
-        land.loc[{"aggregate_class":"Coniferous woodland"}] += delta*(1-bdleaf_conif_ratio)
-    else:
-        # If Broadleaf woodland doesn't exist, create it
-        land.loc[{"aggregate_class":"Coniferous woodland"}] = delta*(1-bdleaf_conif_ratio)
-    
     return land
 
 def managed_agricultural_land_carbon_model(datablock, fraction):
@@ -1144,27 +1537,18 @@ def managed_agricultural_land_carbon_model(datablock, fraction):
     """
 
     # Load land use data from datablock
-    pctg = datablock["land"]["percentage_land_use"].copy(deep=True)
-
-    # Create new category for "managed arable" land
-    for new_class_name in ["Managed arable", "Managed pasture"]:
-        if new_class_name not in pctg.aggregate_class.values:
-            _new_class = xr.zeros_like(pctg.isel(aggregate_class=0)).where(np.isfinite(pctg.isel(aggregate_class=0)))
-            _new_class["aggregate_class"] = new_class_name
-            pctg = xr.concat([pctg, _new_class], dim="aggregate_class")
+    land = copy_land_state(datablock["land"]["state"])
 
-    # Compute arable fraction to be managed and remove from the arable
-    delta_arable = pctg.loc[{"aggregate_class":"Arable"}] * fraction
-    pctg.loc[{"aggregate_class":"Arable"}] -= delta_arable
-    pctg.loc[{"aggregate_class":"Managed arable"}] += delta_arable
+    # Move the arable fraction to be managed to the managed arable class
+    land_transfer(land, "Arable", "Managed arable", fraction)
 
-    # Compute psature fraction to be managed and remove from the pasture classes
-    delta_arable = pctg.loc[{"aggregate_class":["Improved grassland", "Semi-natural grassland"]}] * fraction
-    pctg.loc[{"aggregate_class":["Improved grassland", "Semi-natural grassland"]}] -= delta_arable
-    pctg.loc[{"aggregate_class":"Managed pasture"}] += delta_arable.sum(dim="aggregate_class")
+    # Move the pasture fraction to be managed to the managed pasture class
+    land_transfer(land, ["Improved grassland", "Semi-natural grassland"],
+                  "Managed pasture", fraction)
 
     # Rewrite land use data to datablock
-    datablock["land"]["percentage_land_use"] = pctg
+    datablock["land"]["state"] = land_stage(land, datablock["land"]["state"],
+                                            "Managed agricultural land", land_adoption(datablock))
     return datablock
 
 def zero_land_farming_model(datablock, fraction, items, land_type="Arable",
@@ -1184,7 +1568,7 @@ def zero_land_farming_model(datablock, fraction, items, land_type="Arable",
     timescale = datablock["global_parameters"]["timescale"]
 
     # Load land use data from datablock
-    pctg = datablock["land"]["percentage_land_use"].copy(deep=True)
+    land = copy_land_state(datablock["land"]["state"])
 
     # Load production data from datablock
     plant_items = food_orig.sel(Item=food_orig.Item_origin=="Vegetal Products").Item.values
@@ -1199,18 +1583,15 @@ def zero_land_farming_model(datablock, fraction, items, land_type="Arable",
     food_to_shift = food_orig["production"].sel(Item=items).sum(dim="Item") * scale
 
     shift_ratio_da =  food_to_shift / food_orig["production"].sel(Item=plant_items).sum(dim="Item")
-    shift_ratio = shift_ratio_da.isel(Year=-1).values
+    shift_ratio = shift_ratio_da.sel(Year=datablock["global_parameters"]["target_year"]).values
 
-    # Compute delta land use
-    delta_arable = pctg.loc[{"aggregate_class":land_type}] * shift_ratio
-    pctg.loc[{"aggregate_class":land_type}] -= delta_arable
-    # Rewrite land use data to datablock
-
-    # Add forested percentage to the land use map
-    pctg.loc[{"aggregate_class":"Broadleaf woodland"}] += delta_arable * bdleaf_conif_ratio
-    pctg.loc[{"aggregate_class":"Coniferous woodland"}] += delta_arable * (1-bdleaf_conif_ratio)
+    # Move the shifted land to forest
+    land_transfer(land, land_type, ["Broadleaf woodland", "Coniferous woodland"],
+                  shift_ratio, weights=[bdleaf_conif_ratio, 1-bdleaf_conif_ratio])
 
-    datablock["land"]["percentage_land_use"] = pctg
+    # Rewrite land use data to datablock
+    datablock["land"]["state"] = land_stage(land, datablock["land"]["state"],
+                                            "Zero land farming", land_adoption(datablock))
 
     return datablock
 
@@ -1233,26 +1614,17 @@ def mixed_farming_model(datablock, fraction, prod_scale_factor, items,
     """
 
     # Load land use data from datablock
-    old_land = datablock["land"]["percentage_land_use"]
-    pctg = datablock["land"]["percentage_land_use"].copy(deep=True)
+    land = copy_land_state(datablock["land"]["state"])
     food_orig = datablock["food"]["g/cap/day"].copy(deep=True)
     timescale = datablock["global_parameters"]["timescale"]
+    old_use = land_area(land, land_type)
 
-    # Create new category for "mixed farming" land
-    if new_land_type not in pctg.aggregate_class.values:
-        _new_class = xr.zeros_like(pctg.isel(aggregate_class=0)).where(np.isfinite(pctg.isel(aggregate_class=0)))
-        _new_class["aggregate_class"] = new_land_type
-        pctg = xr.concat([pctg, _new_class], dim="aggregate_class")
-
-    # Compute arable fraction to be converted to mixed farming
-    delta_arable = pctg.loc[{"aggregate_class":land_type}] * fraction
-    pctg.loc[{"aggregate_class":land_type}] -= delta_arable
-    pctg.loc[{"aggregate_class":new_land_type}] += delta_arable.sum(dim="aggregate_class")
+    # Move the arable fraction to be converted to mixed farming
+    delta_arable = land_transfer(land, land_type, new_land_type, fraction)
 
     # Compute relative change in arable land
-    mixed_farm_frac = delta_arable.sum() / old_land.loc[{"aggregate_class":land_type}].sum()
+    mixed_farm_frac = delta_arable / old_use
     arable_scale = 1 - mixed_farm_frac + mixed_farm_frac * prod_scale_factor
-    arable_scale = arable_scale.values
 
     # Get items
     if isinstance(items, tuple):
@@ -1275,10 +1647,9 @@ def mixed_farming_model(datablock, fraction, prod_scale_factor, items,
     
     # Compute relative change in secondary items
     # Get relative new area of mixed farming to secondary producing area
-    total_area_secondary = pctg.loc[{"aggregate_class":secondary_land_type}].sum()
-    mixed_farm_to_secondary_ratio = delta_arable.sum() / total_area_secondary
+    total_area_secondary = land_area(land, secondary_land_type)
+    mixed_farm_to_secondary_ratio = delta_arable / total_area_secondary
     secondary_ratio = 1 + mixed_farm_to_secondary_ratio * secondary_prod_scale_factor
-    secondary_ratio = secondary_ratio.values
 
     secondary_scale = logistic_food_supply(food_orig, timescale, 1, secondary_ratio)
 
@@ -1290,10 +1661,12 @@ def mixed_farming_model(datablock, fraction, prod_scale_factor, items,
     
 
     # Update land use data to datablock
-    datablock["land"]["percentage_land_use"] = pctg
+    datablock["land"]["state"] = land_stage(land, datablock["land"]["state"],
+                                            new_land_type, land_adoption(datablock))
 
     # Rewrite food data datablock
     datablock["food"]["g/cap/day"] = out
+    datablock = mark_changed_items(datablock, item_changes(out, food_orig))
 
     # TO-DO: update the rest of the nutrient data
 
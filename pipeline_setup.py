@@ -2,11 +2,81 @@ from agrifoodpy.pipeline import Pipeline
 from datablock_setup import *
 from model import *
 import streamlit as st
-
-def pipeline_setup(food_system):
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from scipy import sparse
+
+logger = logging.getLogger(__name__)
+
+# Memory, in bytes, of the evaluated datablocks shared between sessions
+result_cache_size = 512 * 2**20
+
+def evaluation_years(mode="trajectory", metric_years=(2050,), start=2020, end=2050,
+                     steady_year=None, tail_step=5):
+    """Returns the years evaluated by the pipeline.
+
+    Parameters
+    ----------
+    mode : str, optional
+        "trajectory" evaluates every year between start and end. "endpoint"
+        only evaluates the start and end years and the requested metric
+        years, as needed by the summary views and batch runs.
+    metric_years : list, optional
+        Additional years to evaluate in "endpoint" mode.
+    start, end : int, optional
+        First and last years of the evaluated period.
+    steady_year : int, optional
+        Year from which every adoption curve is flat. In "trajectory" mode,
+        the years after it are only evaluated every tail_step years, and
+        expanded to yearly values at the end of the pipeline.
+    tail_step : int, optional
+        Step, in years, of the steady state tail.
+
+    Returns
+    -------
+    years : numpy.ndarray
+        Sorted array of years to evaluate.
+    """
+
+    if mode == "trajectory":
+        if steady_year is None or steady_year >= end:
+            return np.arange(start, end+1)
+        tail = np.arange(steady_year, end, tail_step)
+        return np.unique([*np.arange(start, steady_year+1), *tail, end])
+    elif mode == "endpoint":
+        return np.unique([start, end, *metric_years])
+    else:
+        raise ValueError("Mode must be one of 'trajectory' or 'endpoint'")
+
+def pipeline_setup(food_system, mode="trajectory", metric_years=(2050,),
+                   horizon=2050, tail_step=5):
 
     # Global parameters
-    food_system.datablock_write(["global_parameters", "timescale"], st.session_state.n_scale)
+    # Interventions are assessed at the target year. After the adoption
+    # period and the target year every logistic curve is flat, so the rest of
+    # the horizon is evaluated as a strided steady state tail
+    target_year = 2050
+    if horizon < target_year:
+        raise ValueError(f"The horizon must be at least the target year {target_year}")
+
+    timescale = st.session_state.n_scale
+    steady_year = max(2021 + timescale, target_year)
+    years = evaluation_years(mode, (*metric_years, target_year), end=horizon,
+                             steady_year=steady_year, tail_step=tail_step)
+
+    food_system.datablock_write(["global_parameters", "timescale"], timescale)
+    food_system.datablock_write(["global_parameters", "evaluation_mode"], mode)
+    food_system.datablock_write(["global_parameters", "horizon"], horizon)
+    food_system.datablock_write(["global_parameters", "target_year"], target_year)
+    food_system.datablock_write(["global_parameters", "years"], years)
+
+    # Land conversions take a uniform fraction of every eligible cell, unless
+    # a cell ranking is selected
+    land_priority = st.session_state.land_priority
+    if land_priority == "uniform":
+        land_priority = None
 
     # Consumer demand
     food_system.add_node(project_future,
@@ -90,26 +160,30 @@ def pipeline_setup(food_system):
                             "map_mask":"peatland",
                             "mask_vals":0,
                             "bdleaf_conif_ratio":st.session_state.bdleaf_conif_ratio/100,
+                            "priority":land_priority,
                             })
 
     food_system.add_node(BECCS_farm_land,
                             {"farm_percentage":st.session_state.land_BECCS/100,
                              "mask_map":"peatland",
-                             "mask_values":0})
+                             "mask_values":0,
+                             "priority":land_priority})
 
     food_system.add_node(peatland_restoration,
                         {"restore_fraction":st.session_state.lowland_peatland/100,
                          "land_type":["Arable"],
                          "items":"Vegetal Products",
                          "peat_map_key":"peatland",
-                         "mask_val":1})
+                         "mask_val":1,
+                         "priority":land_priority})
     
     food_system.add_node(peatland_restoration,
                         {"restore_fraction":st.session_state.upland_peatland/100,
                          "land_type":["Improved grassland", "Semi-natural grassland"],
                          "items":"Animal Products",
                          "peat_map_key":"peatland",
-                         "mask_val":1})
+                         "mask_val":1,
+                         "priority":land_priority})
 
     food_system.add_node(managed_agricultural_land_carbon_model,
                         {"fraction":st.session_state.soil_carbon/100})
@@ -187,30 +261,403 @@ def pipeline_setup(food_system):
                             {"scale_factor":1 - st.session_state.fossil_arable_prod_factor*st.session_state.fossil_arable/100,
                             "item_origin":"Vegetal Products"})
 
-    # Technology & Innovation    
-    food_system.add_node(ccs_model,
-                            {"waste_BECCS":st.session_state.waste_BECCS*1e6,
-                            "overseas_BECCS":st.session_state.overseas_BECCS*1e6,
-                            "DACCS":st.session_state.DACCS*1e6})
-
-
-    # Compute emissions and sequestration
-    food_system.add_node(forest_sequestration_model,
-                            {"land_type":["Broadleaf woodland",
-                                          "Coniferous woodland",
-                                          "Peatland",
-                                          "Managed arable",
-                                          "Managed pasture",
-                                          "Mixed farming",
-                                          ],
-                            "seq":[st.session_state.bdleaf_seq_ha_yr,
-                                   st.session_state.conif_seq_ha_yr,
-                                   st.session_state.peatland_seq_ha_yr,
-                                   st.session_state.managed_arable_seq_ha_yr,
-                                   st.session_state.managed_pasture_seq_ha_yr,
-                                   st.session_state.mixed_farming_seq_ha_yr,
-                                   ]})
-
-    food_system.add_node(compute_emissions)
+    # Technology & Innovation sequestration is an optional output, computed
+    # by output_nodes
+
+    # Optional outputs are added on demand by evaluate_outputs
+    food_system.datablock_write(["global_parameters", "outputs"],
+                                ["trajectory"] if mode == "trajectory" else [])
+
+    # Fold consecutive multiplicative scaling nodes into single passes
+    fuse_scaling_nodes(food_system)
+
+    return food_system
+
+# Optional outputs the pipeline can materialise, in evaluation order, and the
+# outputs each of them is computed from
+pipeline_outputs = ["emissions", "sequestration", "metrics", "temperature"]
+
+output_requirements = {"metrics":["emissions", "sequestration"],
+                       "temperature":["emissions"]}
+
+# Session state values read by the nodes or the datablock setup instead of
+# being passed as node parameters
+pipeline_session_keys = ["population_projection",
+                         "emission_factors",
+                         "beccs_crops_seq_ha_yr",
+                         "bdleaf_conif_ratio"]
+
+def output_nodes(outputs, mode="trajectory"):
+    """Returns the nodes computing a set of optional pipeline outputs.
+
+    Parameters
+    ----------
+    outputs : list
+        Outputs to compute, from pipeline_outputs. The temperature response
+        needs the yearly emissions trajectory, and is only computed in
+        "trajectory" mode.
+    mode : str, optional
+        Evaluation mode of the pipeline.
+
+    Returns
+    -------
+    nodes : list
+        List of (output, node, params) tuples, in evaluation order.
+    """
+
+    nodes = []
+
+    if "emissions" in outputs:
+        nodes.append(("emissions", compute_emissions, {}))
+
+    if "sequestration" in outputs:
+        nodes.append(("sequestration", ccs_model,
+                      {"waste_BECCS":st.session_state.waste_BECCS*1e6,
+                       "overseas_BECCS":st.session_state.overseas_BECCS*1e6,
+                       "DACCS":st.session_state.DACCS*1e6}))
+
+        sequestration_land_types = ["Broadleaf woodland",
+                                    "Coniferous woodland",
+                                    "Peatland",
+                                    "Managed arable",
+                                    "Managed pasture",
+                                    "Mixed farming",
+                                    ]
+        sequestration_rates = [st.session_state.bdleaf_seq_ha_yr,
+                               st.session_state.conif_seq_ha_yr,
+                               st.session_state.peatland_seq_ha_yr,
+                               st.session_state.managed_arable_seq_ha_yr,
+                               st.session_state.managed_pasture_seq_ha_yr,
+                               st.session_state.mixed_farming_seq_ha_yr,
+                               ]
+
+        # With growth curves, the trees on agroecology land also follow the carbon
+        # stock model, replacing the constant rate sequestration of their nodes
+        growth_curves = st.session_state.sequestration_model == "growth"
+        if growth_curves:
+            sequestration_land_types += ["Silvopasture", "Agroforestry"]
+            sequestration_rates += [st.session_state.agroecology_tree_coverage*st.session_state.bdleaf_seq_ha_yr]*2
+
+        nodes.append(("sequestration", forest_sequestration_model,
+                      {"land_type":sequestration_land_types,
+                       "seq":sequestration_rates,
+                       "growth_curves":growth_curves}))
+
+    # Arrays evaluated on the strided steady state tail are expanded to
+    # yearly values after every evaluation. Arrays already expanded by a
+    # previous evaluation are left untouched
+    if mode == "trajectory":
+        nodes.append((None, expand_steady_tail, {}))
+
+    # Headline metrics are computed on the yearly values
+    if "metrics" in outputs:
+        nodes.append(("metrics", compute_metrics, {}))
+
+    # FaIR needs the yearly emissions trajectory
+    if mode == "trajectory" and "temperature" in outputs:
+        nodes.append(("temperature", compute_t_anomaly, {}))
+
+    return nodes
+
+def output_setup(food_system, outputs):
+    """Adds the nodes computing a set of optional outputs to the end of a
+    pipeline, and records them in ["global_parameters", "outputs"]."""
+
+    evaluated = food_system.datablock["global_parameters"]["outputs"]
+    mode = food_system.datablock["global_parameters"]["evaluation_mode"]
+
+    for output, node, params in output_nodes(outputs, mode):
+        food_system.add_node(node, params)
+        if output is not None and output not in evaluated:
+            evaluated.append(output)
+
+    return food_system
+
+def pipeline_key(food_system):
+    """Returns a hash of the inputs of a pipeline, including the parameters
+    of every optional output node, so that an evaluated datablock can be
+    reused and extended with new outputs while the inputs are unchanged."""
+
+    global_parameters = {key:value for key, value in food_system.datablock["global_parameters"].items()
+                         if key not in ["outputs", "fused_nodes"]}
+    session = [st.session_state.get(key) for key in pipeline_session_keys]
+    outputs = [(node.__name__, params) for _, node, params
+               in output_nodes(pipeline_outputs, global_parameters["evaluation_mode"])]
+
+    key = repr((food_system.names, food_system.params, global_parameters, session, outputs,
+                baseline_version()))
+
+    return hashlib.sha1(key.encode()).hexdigest()
+
+@st.cache_resource
+def result_cache():
+    """Returns the process-wide cache of evaluated datablocks, shared by all
+    sessions and keyed by pipeline_key. Least recently used datablocks are
+    evicted once their memory exceeds result_cache_size."""
+
+    return {"entries":OrderedDict(),
+            "lock":threading.Lock(),
+            "hits":0,
+            "misses":0,
+            "evictions":0,
+            "nbytes":0}
+
+def datablock_nbytes(datablock):
+    """Estimates the memory used by the arrays of a datablock, counting
+    arrays which share memory once.
+
+    The cell level land arrays are shared by every datablock, as built by
+    datablock_setup, so they are not counted."""
+
+    seen = set()
+    if "state" in datablock.get("land", {}):
+        for array in land_cell_arrays(datablock["land"]["state"]):
+            base = array
+            while isinstance(base.base, np.ndarray):
+                base = base.base
+            seen.add(id(base))
+
+    nbytes = 0
+    stack = [datablock]
+
+    while stack:
+        value = stack.pop()
+        if isinstance(value, dict):
+            stack.extend(value.values())
+        elif isinstance(value, (list, tuple)):
+            stack.extend(value)
+        elif isinstance(value, xr.Dataset):
+            stack.extend(value.variables.values())
+        elif isinstance(value, xr.DataArray):
+            stack.extend(value.coords[name].variable for name in value.coords)
+            stack.append(value.variable)
+        elif isinstance(value, xr.Variable):
+            stack.append(np.asarray(value.values))
+        elif sparse.issparse(value):
+            stack.extend([value.data, value.indices, value.indptr])
+        elif isinstance(value, np.ndarray):
+            base = value
+            while isinstance(base.base, np.ndarray):
+                base = base.base
+            if id(base) not in seen:
+                seen.add(id(base))
+                nbytes += base.nbytes
+
+    return nbytes
+
+def cached_result(key):
+    """Returns the datablock cached under a pipeline key, or None, and marks
+    it as the most recently used"""
+
+    cache = result_cache()
+    with cache["lock"]:
+        entry = cache["entries"].get(key)
+        if entry is not None:
+            cache["entries"].move_to_end(key)
+            return entry["datablock"]
+
+    return None
+
+def store_result(key, datablock):
+    """Stores an evaluated datablock in the result cache, replacing any
+    datablock with the same key and evicting the least recently used ones
+    until the cache fits in result_cache_size"""
+
+    nbytes = datablock_nbytes(datablock)
+    if nbytes > result_cache_size:
+        return
+
+    cache = result_cache()
+    with cache["lock"]:
+        previous = cache["entries"].pop(key, None)
+        if previous is not None:
+            cache["nbytes"] -= previous["nbytes"]
+
+        while cache["entries"] and cache["nbytes"] + nbytes > result_cache_size:
+            _, evicted = cache["entries"].popitem(last=False)
+            cache["nbytes"] -= evicted["nbytes"]
+            cache["evictions"] += 1
+            logger.info("Evicted a result of %d bytes from the result cache", evicted["nbytes"])
+
+        cache["entries"][key] = {"datablock":datablock, "nbytes":nbytes}
+        cache["nbytes"] += nbytes
+
+def record_lookup(hit):
+    """Counts a result cache lookup as a hit, served without running any
+    node, or as a miss"""
+
+    cache = result_cache()
+    with cache["lock"]:
+        cache["hits" if hit else "misses"] += 1
+
+def result_cache_stats():
+    """Returns the hits, misses, evictions, hit rate and memory use of the
+    result cache"""
+
+    cache = result_cache()
+    with cache["lock"]:
+        lookups = cache["hits"] + cache["misses"]
+        return {"hits":cache["hits"],
+                "misses":cache["misses"],
+                "hit_rate":cache["hits"] / lookups if lookups else 0.,
+                "evictions":cache["evictions"],
+                "entries":len(cache["entries"]),
+                "nbytes":cache["nbytes"],
+                "capacity":result_cache_size}
+
+def copy_datablock(datablock):
+    """Copies the dictionaries and lists of a datablock, sharing its arrays,
+    so that new outputs can be added without modifying a datablock served
+    to other sessions. Output nodes replace the arrays they write instead of
+    writing into them, so the shared arrays are left untouched."""
+
+    if isinstance(datablock, dict):
+        return {key:copy_datablock(value) for key, value in datablock.items()}
+    if isinstance(datablock, list):
+        return [copy_datablock(value) for value in datablock]
+
+    return datablock
+
+def evaluate_outputs(food_system, outputs=None):
+    """Runs a pipeline lazily, materialising only a set of optional outputs.
+
+    The evaluated datablock is kept in the session state and in the result
+    cache shared by all sessions. If a datablock was evaluated for the same
+    inputs, by this or any other session, its nodes are not run again, and
+    only the outputs missing from it are computed and added to a copy.
+
+    Parameters
+    ----------
+    food_system : Pipeline
+        Pipeline built by pipeline_setup, without optional output nodes.
+    outputs : list, optional
+        Outputs to materialise, from pipeline_outputs, together with the
+        outputs they are computed from. Other values, such as "trajectory",
+        are ignored. If not given, every output is computed.
+
+    Returns
+    -------
+    datablock : dict
+        The evaluated datablock.
+    """
+
+    if outputs is None:
+        outputs = pipeline_outputs
+    outputs = set(outputs)
+    for output in pipeline_outputs[::-1]:
+        if output in outputs:
+            outputs.update(output_requirements.get(output, []))
+    outputs = [output for output in pipeline_outputs if output in outputs]
+
+    key = pipeline_key(food_system)
+    evaluated = st.session_state.get("evaluated_pipeline")
+
+    # Reruns of the same session reuse its datablock directly
+    if evaluated is not None and evaluated["key"] == key:
+        datablock = evaluated["datablock"]
+        if set(outputs) <= set(datablock["global_parameters"]["outputs"]):
+            return datablock
+    else:
+        datablock = cached_result(key)
+
+    if datablock is None:
+        record_lookup(hit=False)
+        output_setup(food_system, outputs)
+        food_system.run()
+
+    else:
+        done = datablock["global_parameters"]["outputs"]
+        missing = [output for output in outputs if output not in done]
+        record_lookup(hit=not missing)
+
+        if missing:
+            # Cached datablocks may be in use by other sessions, so outputs
+            # are added to a copy
+            food_system.datablock = copy_datablock(datablock)
+            core_nodes = len(food_system.nodes)
+            output_setup(food_system, missing)
+            food_system.run(from_node=core_nodes)
+        else:
+            food_system.datablock = datablock
+
+    if food_system.datablock is not datablock:
+        store_result(key, food_system.datablock)
+
+    st.session_state["evaluated_pipeline"] = {"key":key,
+                                              "datablock":food_system.datablock}
+
+    return food_system.datablock
+
+# Nodes whose only effect is a multiplicative logistic scaling of a set of
+# items, and the fused_scaling parameter collecting their factors
+fusable_nodes = {scale_impact: "impact_factors",
+                 scale_production: "production_factors"}
+
+def fuse_scaling_nodes(food_system):
+    """Replaces runs of consecutive scale_impact and scale_production nodes
+    acting on the same items by a single fused_scaling node.
+
+    Impact and production scalings commute, so a run can mix both node types.
+    A trace with the fused node indices and factors is written to the
+    datablock under ["global_parameters", "fused_nodes"].
+    """
+
+    def target(params):
+        items = params.get("items")
+        if items is not None:
+            items = tuple(np.atleast_1d(items).tolist())
+        return items, params.get("item_origin")
+
+    old_nodes = list(zip(food_system.nodes, food_system.params, food_system.names))
+    skip = getattr(food_system, "skip", [False] * len(old_nodes))
+    nodes, params, names, new_skip = [], [], [], []
+    trace = []
+
+    i = 0
+    while i < len(old_nodes):
+        node, node_params, name = old_nodes[i]
+
+        # Find the end of the run of fusable nodes on the same items
+        j = i + 1
+        if node in fusable_nodes and not skip[i]:
+            while j < len(old_nodes) and old_nodes[j][0] in fusable_nodes \
+                    and not skip[j] and target(old_nodes[j][1]) == target(node_params):
+                j += 1
+
+        if j - i < 2:
+            nodes.append(node)
+            params.append(node_params)
+            names.append(name)
+            new_skip.append(skip[i])
+            i += 1
+            continue
+
+        fused_params = {"impact_factors": [],
+                        "production_factors": [],
+                        "item_origin": node_params.get("item_origin"),
+                        "items": node_params.get("items")}
+
+        for run_node, run_params, _ in old_nodes[i:j]:
+            fused_params[fusable_nodes[run_node]].append(run_params["scale_factor"])
+
+        trace.append({"nodes": list(range(i, j)),
+                      "names": [run_name for _, _, run_name in old_nodes[i:j]],
+                      "functions": [run_node.__name__ for run_node, _, _ in old_nodes[i:j]],
+                      "scale_factors": [run_params["scale_factor"] for _, run_params, _ in old_nodes[i:j]],
+                      "name": f"Fused scaling ({name} - {old_nodes[j-1][2]})"})
+
+        nodes.append(fused_scaling)
+        params.append(fused_params)
+        names.append(trace[-1]["name"])
+        new_skip.append(False)
+        i = j
+
+    food_system.nodes = nodes
+    food_system.params = params
+    food_system.names = names
+    if hasattr(food_system, "skip"):
+        food_system.skip = new_skip
+
+    food_system.datablock_write(["global_parameters", "fused_nodes"], trace)
 
     return food_system
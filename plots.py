@@ -4,12 +4,158 @@ from streamlit_extras.add_vertical_space import add_vertical_space
 import matplotlib
 import matplotlib.pyplot as plt
 from matplotlib import colors
+from matplotlib.figure import Figure
 import matplotlib.patches as mpatches
 from utils.altair_plots import *
 from agrifoodpy.food.food import FoodBalanceSheet
 from glossary import *
 from utils.helper_functions import *
 from consultation_utils import submit_scenario, get_user_list, stage_I_deadline
+from grouping import group_sum
+from land import land_display_map, land_class_totals, land_transitions, land_zone_totals, land_fingerprint, land_state_at, land_class_trajectory
+from io import BytesIO
+from functools import partial
+
+@st.cache_resource(max_entries=64)
+def _land_map_image(fingerprint, figsize, left, top, _datablock, _year):
+    # Figures are created without pyplot, whose global state is not thread
+    # safe, so maps can be rendered on the chart thread pool
+    f = Figure(figsize=figsize)
+    plot1 = f.add_subplot()
+
+    # Use the coarsest map level which still fills the figure
+    pctg, factor = land_display_map(_datablock, int(max(figsize) * f.dpi), _year)
+    LC_toplot = map_max(pctg, dim="aggregate_class")
+
+    color_list = [land_color_dict[key] for key in pctg.aggregate_class.values]
+
+    cmap_tar = colors.ListedColormap(color_list)
+    bounds_tar = np.linspace(-0.5, len(color_list)-0.5, len(color_list)+1)
+    norm_tar = colors.BoundaryNorm(bounds_tar, cmap_tar.N)
+
+    plot1.imshow(LC_toplot, interpolation="none", origin="lower",
+                 cmap=cmap_tar, norm=norm_tar,
+                 extent=(-0.5, LC_toplot.shape[1]*factor - 0.5,
+                         -0.5, LC_toplot.shape[0]*factor - 0.5))
+
+    plot1.axis("off")
+    plot1.set_xlim(left=left)
+    plot1.set_ylim(top=top)
+
+    # Same output as st.pyplot
+    image = BytesIO()
+    f.savefig(image, format="png", bbox_inches="tight", dpi=200)
+
+    return LC_toplot, image.getvalue()
+
+def land_map_image(datablock, figsize, left=-100, top=1000, year=None):
+    """Returns the PNG image of the dominant class land map, at a given year
+    or for the final land use. The dominant class array and the image are
+    computed once for each land state and figure layout, so reruns which do
+    not change land use, and years with the same land use, reuse them."""
+
+    state = datablock["land"]["state"]
+    if year is not None:
+        state = land_state_at(state, year)
+
+    fingerprint = land_fingerprint(state)
+    return _land_map_image(fingerprint, tuple(figsize), left, top, datablock, year)[1]
+
+def summary_year_charts(datablock, emission_factors, afolu_only, ssr_metric, reference):
+    """Builds the charts of the Summary view for every evaluated year.
+
+    The data of each chart is aggregated for all years in a single pass, and
+    the charts are prepared concurrently on the chart thread pool.
+
+    Returns
+    -------
+    charts : dict
+        Charts, emissions balance and SSR of each year.
+    """
+
+    metrics = datablock["metrics"]
+    years = metrics["ssr"].Year.values
+    jobs = {}
+
+    if emission_factors == "NDC 2020":
+
+        balance = metrics["sector_balance"]
+
+        if afolu_only:
+            balance = balance.sel(Sector=["Agriculture", "Land use sinks", "Removals"])
+
+        jobs["balance"] = partial(plot_single_bar_altair, balance, show="Sector", color=sector_emissions_colors,
+            axis_title="Mt CO2e / year", unit="Mt CO2e / year", vertical=True,
+            mark_total=True, show_zero=True, ax_ticks=True, legend=True,
+            ax_min=-90, ax_max=120, reference=reference,
+            height=500, dim="Year")
+
+    elif emission_factors == "PN18":
+
+        emissions = metrics["origin_emissions"]
+        seq_da = datablock["impact"]["co2e_sequestration"].sel(Year=years)
+
+        balance = xr.concat([emissions/1e6, -seq_da/1e6], dim="Item")
+
+        jobs["balance"] = partial(plot_single_bar_altair, balance, show="Item",
+            axis_title="Sequestration / Production emissions [M tCO2e]",
+            ax_min=-3e2, ax_max=3e2, unit="M tCO2e", vertical=True,
+            mark_total=True, show_zero=True, ax_ticks=True,
+            height=500, dim="Year")
+
+    supply = metrics["origin_supply"].sel(Quantity=ssr_metric)
+
+    origin_color={"Animal Products": "red",
+                  "Plant Products": "green",
+                  "Alternative Food": "blue"}
+
+    # Production and domestic use share their axis over all years
+    ssr_ax_max = max(supply["production"].sum(dim="Item").max().item(),
+                     supply["domestic"].sum(dim="Item").max().item())
+
+    jobs["production"] = partial(plot_single_bar_altair, supply["production"],
+                                 show="Item",
+                                 legend=True,
+                                 vertical=False,
+                                 ax_ticks=True,
+                                 bar_width=100,
+                                 ax_min=0,
+                                 ax_max=ssr_ax_max,
+                                 axis_title="Food production per capita",
+                                 unit=ssr_metric.replace("_"," "),
+                                 color=origin_color,
+                                 dim="Year")
+
+    jobs["imports"] = partial(plot_single_bar_altair, supply["domestic"],
+                              show="Item",
+                              legend=True,
+                              vertical=False,
+                              ax_ticks=True,
+                              bar_width=100,
+                              ax_min=0,
+                              ax_max=ssr_ax_max,
+                              axis_title="Domestic use per capita",
+                              unit=ssr_metric.replace("_"," "),
+                              color=origin_color,
+                              dim="Year")
+
+    jobs["land_bar"] = partial(plot_single_bar_altair, land_class_trajectory(datablock["land"]["state"], years),
+        show="aggregate_class", axis_title="Land use [ha]", unit="Hectares",
+        vertical=False, color=land_color_dict, ax_ticks=True, bar_width=100,
+        dim="Year")
+
+    # Land maps are not prepared here, as rendering them for every year would
+    # multiply the matplotlib work. The view renders the selected year only
+    charts = build_charts(jobs)
+    ssr = metrics["ssr"].sel(Quantity=ssr_metric)
+
+    return {year.item():{"balance":charts["balance"][year],
+                         "balance_data":balance.sel(Year=year),
+                         "production":charts["production"][year],
+                         "imports":charts["imports"][year],
+                         "land_bar":charts["land_bar"][year],
+                         "ssr":float(ssr.sel(Year=year))}
+            for year in years}
 
 @st.fragment()
 def plots(datablock):
@@ -20,11 +166,18 @@ def plots(datablock):
     #                  Plots
     # ----------------------------------------
 
-    # Summary
-    # -------
-    metric_yr = 2050
+    # Year at which the interventions are assessed. The summary views show
+    # the metric year selected by the user instead
+    target_yr = datablock["global_parameters"]["target_year"]
     plot_key = st.session_state["plot_key"]
 
+    # Views declare the outputs they need, which are only computed on demand.
+    # Rerun the whole app if the datablock is missing any of them
+    if not set(view_outputs[plot_key]) <= set(datablock["global_parameters"]["outputs"]):
+        st.rerun()
+
+    reset_payloads(plot_key)
+
     if plot_key == "Summary":
 
         st.markdown("# Agrifood Calculator - The UK in 2050")
@@ -41,6 +194,28 @@ def plots(datablock):
                 your proposed solution at the bottom of this page!
                 """)
                 
+        # Charts of every evaluated year are precomputed, so scrubbing the
+        # metric year only reruns this fragment and looks them up
+        afolu_only = st.session_state["show_afolu_only"]
+        if st.session_state.emission_factors == "NDC 2020" and afolu_only:
+            reference_emissions_baseline = 31.61
+
+        ssr_metric = st.session_state["ssr_metric"]
+        summary = year_charts(datablock, summary_year_charts, st.session_state.emission_factors,
+                              afolu_only, ssr_metric, reference_emissions_baseline)
+
+        years = list(summary)
+        metric_yr = nearest_year(years, st.session_state.metric_year)
+        st.select_slider("Year", options=years, value=metric_yr, key="update_metric_year",
+                         on_change=update_metric_year)
+
+        charts = summary[metric_yr]
+        emissions_balance = charts["balance_data"]
+
+        SSR = datablock["metrics"]["ssr"].sel(Quantity=ssr_metric)
+        SSR_ref = float(SSR.sel(Year=2020))
+        SSR_metric_yr = charts["ssr"]
+
         col_comp_1, col_comp_2, col_comp_3 = st.columns([1,1,1])
 
         # Emissions and removals balance
@@ -49,53 +224,7 @@ def plots(datablock):
             with st.container(height=800, border=True):
                 
                 st.markdown('''**UK Emissions balance**''')
-                if st.session_state.emission_factors == "NDC 2020":
-                    
-                    seq_da = datablock["impact"]["co2e_sequestration"].sel(Year=metric_yr)
-                    emissions = datablock["impact"]["g_co2e/year"]["production"].sel(Year=metric_yr)/1e6
-                    total_emissions = emissions.sum(dim="Item").values/1e6
-                    total_seq = seq_da.sel(Item=["Broadleaf woodland",
-                                                 "Coniferous woodland",
-                                                 "Peatland",
-                                                 "Managed pasture",
-                                                 "Managed arable",
-                                                 "Mixed farming",
-                                                 "Silvopasture",
-                                                 "Agroforestry"]).sum(dim="Item").values/1e6
-                    total_removals = seq_da.sel(Item=["BECCS from waste", "BECCS from overseas biomass", "BECCS from land", "DACCS"]).sum(dim="Item").values/1e6
-
-                    emissions_balance = xr.DataArray(data = list(sector_emissions_dict.values()),
-                                          name="Sectoral emissions",
-                                          coords={"Sector": list(sector_emissions_dict.keys())})
-                    
-                    emissions_balance.loc[{"Sector": "Agriculture"}] = total_emissions
-                    emissions_balance.loc[{"Sector": "Land use sinks"}] = -total_seq
-                    emissions_balance.loc[{"Sector": "Removals"}] = -total_removals
-                    
-                    if st.session_state["show_afolu_only"]:
-                        reference_emissions_baseline = 31.61
-                        emissions_balance = emissions_balance.sel(Sector=["Agriculture", "Land use sinks", "Removals"])
-
-                    c = plot_single_bar_altair(emissions_balance, show="Sector", color=sector_emissions_colors,
-                        axis_title="Mt CO2e / year", unit="Mt CO2e / year", vertical=True,
-                        mark_total=True, show_zero=True, ax_ticks=True, legend=True,
-                        ax_min=-90, ax_max=120, reference=reference_emissions_baseline)
-                    
-                elif st.session_state.emission_factors == "PN18":
-
-                    emissions = datablock["impact"]["g_co2e/year"]["production"].sel(Year=metric_yr)/1e6
-                    emissions = emissions.fbs.group_sum(coordinate="Item_origin", new_name="Item")
-                    seq_da = datablock["impact"]["co2e_sequestration"].sel(Year=metric_yr)
-
-                    emissions_balance = xr.concat([emissions/1e6, -seq_da/1e6], dim="Item")
-                    
-                    c = plot_single_bar_altair(emissions_balance, show="Item",
-                                                    axis_title="Sequestration / Production emissions [M tCO2e]",
-                                                    ax_min=-3e2, ax_max=3e2, unit="M tCO2e", vertical=True,
-                                                    mark_total=True, show_zero=True, ax_ticks=True)
-                    
-                c = c.properties(height=500)
-                st.altair_chart(c, use_container_width=True)
+                show_chart(charts["balance"], "Emissions balance", use_container_width=True)
                 st.checkbox("Show agriculture and land use only", value=False, on_change=change_to_afolu_only, key="show_afolu_only_checkbox")
                 st.markdown(f"Total emissions: **{emissions_balance.sum().to_numpy():.2f} Mt CO2e / year**")
                 st.caption('''<div style="text-align: justify;">
@@ -118,52 +247,11 @@ def plots(datablock):
 
                 st.markdown('''**Self-sufficiency**''')
 
-                ssr_metric = st.session_state["ssr_metric"]
-                gcapday = datablock["food"][ssr_metric].sel(Year=metric_yr).fillna(0)
-                gcapday = gcapday.fbs.group_sum(coordinate="Item_origin", new_name="Item")
-                gcapday_ref = datablock["food"][ssr_metric].sel(Year=2020).fillna(0)
-                gcapday_ref = gcapday_ref.fbs.group_sum(coordinate="Item_origin", new_name="Item")
-
-                SSR_ref = gcapday_ref.fbs.SSR()
-                SSR_metric_yr = gcapday.fbs.SSR()
-
                 st.metric(label="SSR", value="{:.2f} %".format(100*SSR_metric_yr),
                     delta="{:.2f} %".format(100*(SSR_metric_yr-SSR_ref)), label_visibility="collapsed")
-                
-                origin_color={"Animal Products": "red",
-                              "Plant Products": "green",
-                              "Alternative Food": "blue"}
-                
-                domestic_use = gcapday["imports"]+gcapday["production"]-gcapday["exports"]
-                domestic_use.name="domestic"
-
-                production_bar = plot_single_bar_altair(gcapday["production"],
-                                                        show="Item",
-                                                        legend=True,
-                                                        vertical=False,
-                                                        ax_ticks=True,
-                                                        bar_width=100,
-                                                        ax_min=0,
-                                                        ax_max=np.max([gcapday["production"].sum(), domestic_use.sum()]),
-                                                        axis_title="Food production per capita",
-                                                        unit=ssr_metric.replace("_"," "),
-                                                        color=origin_color)
-
-                imports_bar = plot_single_bar_altair(domestic_use,
-                                                     show="Item",
-                                                     legend=True,
-                                                     vertical=False,
-                                                     ax_ticks=True,
-                                                     bar_width=100,
-                                                     ax_min=0,
-                                                     ax_max=np.max([gcapday["production"].sum(), domestic_use.sum()]),
-                                                     axis_title="Domestic use per capita",
-                                                     unit=ssr_metric.replace("_"," "),
-                                                     color=origin_color)
-
 
-                st.altair_chart(production_bar, use_container_width=True)
-                st.altair_chart(imports_bar, use_container_width=True)
+                show_chart(charts["production"], "Production bar", use_container_width=True)
+                show_chart(charts["imports"], "Imports bar", use_container_width=True)
 
                 st.selectbox("Select metric", ["g/cap/day",
                                                "g_prot/cap/day",
@@ -213,40 +301,14 @@ def plots(datablock):
 
                 st.markdown('''**Land use**''')
 
-
-                f, plot1 = plt.subplots(1, figsize=(6, 6))
-                pctg = datablock["land"]["percentage_land_use"]
-                LC_toplot = map_max(pctg, dim="aggregate_class")
-
-                color_list = [land_color_dict[key] for key in pctg.aggregate_class.values]
-                label_list = [land_label_dict[key] for key in pctg.aggregate_class.values]
-
-                unique_index = np.unique(label_list, return_index=True)[1]
-
-                cmap_tar = colors.ListedColormap(color_list)
-                bounds_tar = np.linspace(-0.5, len(color_list)-0.5, len(color_list)+1)
-                norm_tar = colors.BoundaryNorm(bounds_tar, cmap_tar.N)
-
-                plot1.imshow(LC_toplot, interpolation="none", origin="lower",
-                                cmap=cmap_tar, norm=norm_tar)
-                patches = [mpatches.Patch(color=color_list[i],
-                                            label=label_list[i]) for i in unique_index]
-
-                plot1.axis("off")
-                plot1.set_xlim(left=-100)
-                plot1.set_ylim(top=1000)
-
                 _, col_plot, _ = st.columns((0.1, 0.7, 0.1))
                 with col_plot:
-                    st.pyplot(f)
+                    # Rendered for the selected year only. Maps are cached by
+                    # land use state, so scrubbing back to a year reuses them
+                    land_png = land_map_image(datablock, figsize=(6, 6), top=1000, year=metric_yr)
+                    show_image(land_png, "Land use map", use_container_width=True)
 
-                pctg = datablock["land"]["percentage_land_use"]
-                totals = pctg.sum(dim=["x", "y"])
-                bar_land_use = plot_single_bar_altair(totals, show="aggregate_class",
-                    axis_title="Land use [ha]", unit="Hectares", vertical=False,
-                    color=land_color_dict, ax_ticks=True, bar_width=100)
-                
-                st.altair_chart(bar_land_use, use_container_width=True)
+                show_chart(charts["land_bar"], "Land use bar", use_container_width=True)
 
                 st.caption('''<div style="text-align: justify;">
                 The map above shows the distribution of land use types in the UK.
@@ -268,8 +330,8 @@ def plots(datablock):
             y_key = st.selectbox("Quantity", ["Emissions", "kCal/cap/day", "g/cap/day"])
 
         if y_key == "Emissions":
-            emissions = datablock["impact"]["g_co2e/year"].sel(Year=slice(None, metric_yr))
-            seq_da = datablock["impact"]["co2e_sequestration"].sel(Year=slice(None, metric_yr))
+            emissions = datablock["impact"]["g_co2e/year"].sel(Year=slice(None, target_yr))
+            seq_da = datablock["impact"]["co2e_sequestration"].sel(Year=slice(None, target_yr))
 
             if option_key == "Food origin":
                 f = plot_years_altair(emissions[element_key]/1e6, show="Item_origin", ylabel="t CO2e / Year")
@@ -280,14 +342,13 @@ def plots(datablock):
             if element_key == "production":
                 # Plot sequestration
                 f += plot_years_altair(-seq_da, show="Item", ylabel="t CO2e / Year")
-                emissions_sum = emissions[element_key].sum(dim="Item")
-                seqestration_sum = seq_da.sum(dim="Item")
+                net_emissions = datablock["metrics"]["net_emissions"].sel(Year=slice(None, target_yr))
 
-                f += plot_years_total((emissions_sum/1e6 - seqestration_sum),
+                f += plot_years_total(net_emissions,
                                     ylabel="t CO2e / Year",
                                     color="black")
         else:
-            emissions = datablock["food"][y_key].sel(Year=slice(None, metric_yr))
+            emissions = datablock["food"][y_key].sel(Year=slice(None, target_yr))
 
             if option_key == "Food origin":
                 f = plot_years_altair(emissions[element_key], show="Item_origin", ylabel=y_key)
@@ -299,7 +360,7 @@ def plots(datablock):
             labelFontSize=15,
             titleFontSize=15)
         
-        st.altair_chart(f, use_container_width=True)
+        show_chart(f, "Emissions per food group", use_container_width=True)
 
     # Emissions per food item from each group
     # ---------------------------------------
@@ -313,11 +374,11 @@ def plots(datablock):
             y_key = st.selectbox("Quantity", ["Emissions", "kCal/cap/day", "g/cap/day"])
 
         if y_key == "Emissions":
-            to_plot = datablock["impact"]["g_co2e/year"].sel(Year=slice(None, metric_yr))
+            to_plot = datablock["impact"]["g_co2e/year"].sel(Year=slice(None, target_yr))
             to_plot = to_plot[element_key].sel(Item=to_plot["Item_group"] == option_key)/1e6
 
         else:
-            to_plot = datablock["food"][y_key].sel(Year=slice(None, metric_yr))
+            to_plot = datablock["food"][y_key].sel(Year=slice(None, target_yr))
             to_plot = to_plot[element_key].sel(Item=to_plot["Item_group"] == option_key)
         
         f = plot_years_altair(to_plot, show="Item_group", ylabel="t CO2e / Year")
@@ -325,7 +386,29 @@ def plots(datablock):
                 labelFontSize=15,
                 titleFontSize=15)
             
-        st.altair_chart(f, use_container_width=True)
+        show_chart(f, "Emissions per food item", use_container_width=True)
+
+    # Climate response to the agrifood emissions
+    # ------------------------------------------
+    elif plot_key in ["CO2e concentration", "Radiative forcing", "Temperature anomaly"]:
+        climate_options = {"CO2e concentration": ("C", "CO2 concentration [ppm]", 1),
+                           "Radiative forcing": ("F", "Radiative forcing [mW / m²]", 1e3),
+                           "Temperature anomaly": ("T", "Temperature anomaly [mK]", 1e3)}
+        key, ylabel, scale = climate_options[plot_key]
+
+        # FaIR responses are given at the time bounds of each year, and are
+        # shown at the end of each year over the whole horizon
+        response = datablock["impact"][key]
+        response = response.rename({response.dims[0]:"Year"})
+        response = response.assign_coords(Year=(response.Year.values - 0.5).astype(int)) * scale
+
+        yrange = [float(response.min()), float(response.max())]
+        f = plot_years_total(response, ylabel=ylabel, color="black", yrange=yrange)
+        f = f.configure_axis(
+                labelFontSize=15,
+                titleFontSize=15)
+
+        show_chart(f, plot_key, use_container_width=True)
 
     # FAOSTAT bar plot with per-capita daily values
     # ---------------------------------------------
@@ -347,9 +430,9 @@ def plots(datablock):
             item_selection = {"Item":item_list}
         adjust_scale = st.checkbox("Adjust scale", value=True)
 
-        to_plot = datablock["food"][option_key].sel(Year=metric_yr).fillna(0)
+        to_plot = datablock["food"][option_key].sel(Year=target_yr).fillna(0)
         to_plot[dissagregation].values = np.array(to_plot[dissagregation].values, dtype=str)
-        to_plot = to_plot.fbs.group_sum(coordinate=dissagregation, new_name="Item")
+        to_plot = group_sum(to_plot, dissagregation, "Item", datablock["food"].get("memberships"))
         to_plot = to_plot.sel(item_selection)
 
         if adjust_scale:
@@ -366,7 +449,7 @@ def plots(datablock):
             color=alt.Color('color:N', scale=None)
             )
 
-        st.altair_chart(f, use_container_width=True)
+        show_chart(f, "Per capita values", use_container_width=True)
         
     # Self-sufficiency ratio as a function of time
     # --------------------------------------------
@@ -384,11 +467,11 @@ def plots(datablock):
                 item_selection = {"Item":item_list}
 
             # Build fbs for plotting
-            fbs = datablock["food"][ssr_metric].sel(Year=metric_yr).fillna(0)
-            fbs = fbs.fbs.group_sum(coordinate=dissagregation, new_name="Item")
+            fbs = datablock["food"][ssr_metric].sel(Year=target_yr).fillna(0)
+            fbs = group_sum(fbs, dissagregation, "Item", datablock["food"].get("memberships"))
             fbs = fbs.sel(item_selection)
             SSR_metric_yr = fbs.fbs.SSR()
-            SSR = datablock["food"][ssr_metric].fillna(0).fbs.SSR().sel(Year=slice(None, metric_yr)) * 100
+            SSR = datablock["metrics"]["ssr"].sel(Quantity=ssr_metric, Year=slice(None, target_yr)) * 100
 
             with st.container(border=True):
                 st.metric("Self-sufficiency for your selection",
@@ -444,38 +527,17 @@ def plots(datablock):
         
 
             with st.container(border=True):
-                st.altair_chart(f, use_container_width=True)
+                show_chart(f, "Self-sufficiency ratio", use_container_width=True)
             with st.container(border=True):
-                st.altair_chart(production_bar, use_container_width=True)
-                st.altair_chart(imports_bar, use_container_width=True)
+                show_chart(production_bar, "Production bar", use_container_width=True)
+                show_chart(imports_bar, "Imports bar", use_container_width=True)
 
     # Various land plots, including Land use and ALC
     # ----------------------------------------------
     elif plot_key == "Land":
 
-        f, plot1 = plt.subplots(1, figsize=(8,8))
-        pctg = datablock["land"]["percentage_land_use"]
-        LC_toplot = map_max(pctg, dim="aggregate_class")
-
-        color_list = [land_color_dict[key] for key in pctg.aggregate_class.values]
-        label_list = [land_label_dict[key] for key in pctg.aggregate_class.values]
-
-        unique_index = np.unique(label_list, return_index=True)[1]
-
-        cmap_tar = colors.ListedColormap(color_list)
-        bounds_tar = np.linspace(-0.5, len(color_list)-0.5, len(color_list)+1)
-        norm_tar = colors.BoundaryNorm(bounds_tar, cmap_tar.N)
-
-        plot1.imshow(LC_toplot, interpolation="none", origin="lower",
-                        cmap=cmap_tar, norm=norm_tar)
-        # patches = [mpatches.Patch(color=color_list[i],
-                                    # label=label_list[i]) for i in unique_index]
-        # plot1.legend(handles=patches, loc="upper left")
-
-        plot1.axis("off")
-        plot1.set_xlim(left=-100)
-        plot1.set_ylim(top=980)
-
+        land_png = land_map_image(datablock, figsize=(8, 8), top=980)
+        
         col2_1, col2_2, col2_3 = st.columns((1,1.4,1))
         with col2_1:
             st.markdown("""# Land use""")
@@ -488,12 +550,20 @@ def plots(datablock):
                         for food production.""")
         with col2_2:
             with st.container(border=True):
-                st.pyplot(fig=f)
+                show_image(land_png, "Land use map", use_container_width=True)
         with col2_3:
             with st.container(border=True):
-                land_pctg = pctg.sum(dim=["x", "y"])
-                pie = pie_chart_altair(land_pctg, show="aggregate_class", unit="ha")
-                st.altair_chart(pie)
+                land_pctg = land_class_totals(datablock["land"]["state"])
+                land_zone = st.selectbox("Group land use by",
+                                         ["UK"] + list(datablock["land"]["state"]["zones"]),
+                                         key="land_zone")
+                if land_zone == "UK":
+                    pie = pie_chart_altair(land_pctg, show="aggregate_class", unit="ha")
+                    show_chart(pie, "Land use pie")
+                else:
+                    zone_totals = land_zone_totals(datablock["land"]["state"], land_zone)
+                    show_chart(plot_zone_bars_altair(zone_totals, land_zone, unit="ha"),
+                               "Land use per zone", use_container_width=True)
 
             total_area = land_pctg.sum().values
             baseline_forest_fraction = 100*datablock["land"]["baseline"].sel(aggregate_class=["Broadleaf woodland", "Coniferous woodland"]).sum().values/total_area
@@ -502,6 +572,14 @@ def plots(datablock):
 
             st.metric("Forested % of UK land", value=f"{forest_fraction:.2f}% ", delta=f"{forest_fraction-baseline_forest_fraction:.2f}%")
             st.metric("Mixed farming % of UK land", value=f"{100*mixed_farming_fraction:.2f}% ")
+
+            with st.expander("Land use transitions"):
+                transitions = land_transitions(datablock["land"]["state"]).to_series()
+                transitions = transitions[transitions > 1].sort_values(ascending=False)
+                st.dataframe(transitions.rename("Area [ha]").reset_index(),
+                             hide_index=True,
+                             column_config={"from_class":"From",
+                                            "to_class":"To"})
     
     st.selectbox("Choose from the options below to explore a more detailed breakdown of your selected pathway", option_list, on_change=update_plot_key, key="update_plot_key")
 
@@ -528,34 +606,39 @@ def plots(datablock):
             st.caption("""By clicking ‘Submit’ you are agreeing to our Data Protection Policy [Data Protection Policy](https://docs.google.com/document/d/1E24m5bvY2g-LbHpyN2Y44A_GzYtMmNUKRFJ_Wc-JTP0/edit?tab=t.0)""")
             submit_state = st.button("Submit")
 
-            # submit scenario
+            # submit scenario, assessed at the target year
             if submit_state:
+                emissions_balance = summary[target_yr]["balance_data"]
+                SSR_target_yr = summary[target_yr]["ssr"]
+                metrics = datablock["metrics"]
+
                 total_emissions = emissions_balance.sum()
                 reducion_emissions_pctg = (total_emissions - reference_emissions_baseline) / reference_emissions_baseline * 100
-                forest_land_ha = datablock["land"]["percentage_land_use"].sel(aggregate_class=["Broadleaf woodland", "Coniferous woodland"]).sum().values
-                total_area = datablock["land"]["percentage_land_use"].sum().values
+                land_totals = land_class_totals(datablock["land"]["state"])
+                forest_land_ha = land_totals.sel(aggregate_class=["Broadleaf woodland", "Coniferous woodland"]).sum().values
+                total_area = land_totals.sum().values
                 new_forest_land_Mha = (forest_land_ha - datablock["land"]["baseline"].sel(aggregate_class=["Broadleaf woodland", "Coniferous woodland"]).sum().values)/1e6
                 agricultural_emissions = emissions_balance.sel(Sector="Agriculture").sum().values
                 reduction_emissions_agricultural_pctg = (agricultural_emissions - reference_emissions_baseline_agriculture) / reference_emissions_baseline_agriculture * 100
 
-                arable_land = datablock["land"]["percentage_land_use"].sel(aggregate_class=["Arable", "Managed arable", "Mixed farming", "Agroforestry"]).sum().values / 1e6
+                arable_land = land_totals.sel(aggregate_class=["Arable", "Managed arable", "Mixed farming", "Agroforestry"]).sum().values / 1e6
                 baseline_arable = datablock["land"]["baseline"].sel(aggregate_class=["Arable"]).sum().values / 1e6
                 new_arable_land_pctg = (arable_land - baseline_arable) / baseline_arable * 100
 
-                pasture_land = datablock["land"]["percentage_land_use"].sel(aggregate_class=["Improved grassland",
-                                                                                             "Semi-natural grassland",
-                                                                                             "Managed pasture",
-                                                                                             "Silvopasture"]).sum().values / 1e6
+                pasture_land = land_totals.sel(aggregate_class=["Improved grassland",
+                                                                "Semi-natural grassland",
+                                                                "Managed pasture",
+                                                                "Silvopasture"]).sum().values / 1e6
 
                 baseline_pasture = datablock["land"]["baseline"].sel(aggregate_class=["Improved grassland",
                                                                                       "Semi-natural grassland"]).sum().values / 1e6
                 
                 new_pasture_land_pctg = (pasture_land - baseline_pasture) / baseline_pasture * 100
 
-                forest_sequestration_MtCO2 = seq_da.sel(Item=["Broadleaf woodland", "Coniferous woodland"]).sum(dim="Item").values/1e6
-                total_removals = seq_da.sel(Item=["BECCS from waste", "BECCS from overseas biomass", "BECCS from land", "DACCS"]).sum(dim="Item").values/1e6
+                forest_sequestration_MtCO2 = metrics["forest_sinks"].sel(Year=target_yr).values/1e6
+                total_removals = metrics["removals"].sel(Year=target_yr).values/1e6
 
-                extra_values = [SSR_metric_yr,
+                extra_values = [SSR_target_yr,
                                 total_emissions,
                                 reducion_emissions_pctg,
                                 new_forest_land_Mha,
@@ -574,6 +657,13 @@ def plots(datablock):
     if plot_key != "Summary":
         with bottom():
             from bottom import bottom_panel
-            bottom_panel(datablock, metric_yr)
+            bottom_panel(datablock, st.session_state.metric_year)
+
+    # Serialised size of each chart of the view, for debugging
+    if st.session_state.get("debug_payloads", False):
+        report = payload_report(plot_key)
+        with st.expander("Chart payloads"):
+            st.dataframe(report, hide_index=True)
+            st.markdown(f"Total: **{report['Size [kB]'].sum():.1f} kB**")
 
 
@@ -6,7 +6,7 @@ from utils.helper_functions import *
 
 from agrifoodpy.pipeline import Pipeline
 from datablock_setup import datablock_setup
-from pipeline_setup import pipeline_setup
+from pipeline_setup import pipeline_setup, evaluate_outputs, result_cache_stats
 
 from glossary import *
 from consultation_utils import get_pathways, call_scenarios
@@ -29,6 +29,9 @@ if "ssr_metric" not in st.session_state:
 if "plot_key" not in st.session_state:
     st.session_state["plot_key"] = "Summary"
 
+if "metric_year" not in st.session_state:
+    st.session_state["metric_year"] = 2050
+
 # ------------------------
 # Help and tooltip strings
 # ------------------------
@@ -245,13 +248,35 @@ with st.sidebar:
 #                  Main
 # ----------------------------------------
 
-food_system = Pipeline(datablock_setup())
-food_system = pipeline_setup(food_system)
-food_system.run()
-datablock_result = food_system.datablock
+# Only the outputs needed by the open view are computed. Summary views only
+# need the metric years which can be selected, and the full trajectory is
+# computed when a time series view is open
+outputs = view_outputs[st.session_state["plot_key"]]
+if "trajectory" in outputs:
+    evaluation_mode = "trajectory"
+else:
+    evaluation_mode = "endpoint"
+
+horizon = int(st.session_state.horizon)
+food_system = Pipeline(datablock_setup(horizon))
+metric_years = range(2020, horizon+1, metric_year_step)
+food_system = pipeline_setup(food_system, mode=evaluation_mode,
+                             metric_years=metric_years, horizon=horizon)
+datablock_result = evaluate_outputs(food_system, outputs)
 
 # -------------------
 # Execute plots block
 # -------------------
 from plots import plots
 metric_yr = plots(datablock_result)
+
+# Results shared between sessions, for debugging
+if st.session_state.debug_result_cache:
+    stats = result_cache_stats()
+    with st.sidebar.expander("Result cache"):
+        st.metric("Hit rate", f"{100*stats['hit_rate']:.1f} %")
+        st.markdown(f"""Hits: **{stats['hits']}**, misses: **{stats['misses']}**,
+                    evictions: **{stats['evictions']}**  
+                    Memory: **{stats['nbytes']/2**20:.1f}** of
+                    **{stats['capacity']/2**20:.0f} MB** in
+                    **{stats['entries']}** results""")
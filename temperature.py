@@ -0,0 +1,175 @@
+import numpy as np
+import xarray as xr
+import threading
+from collections import OrderedDict
+
+# Responses are cached per quantised emissions trajectory, so slider moves
+# which do not change emissions by more than the tolerance reuse the result.
+# The cache is shared by all sessions, and guarded by _fair_lock
+fair_tolerance = 1e-4
+fair_cache_size = 256
+_fair_cache = OrderedDict()
+_fair_lock = threading.Lock()
+
+def emissions_key(emissions, tolerance=fair_tolerance):
+    """Returns a hashable key for an emissions trajectory, with emissions
+    quantised to multiples of the tolerance.
+
+    Parameters
+    ----------
+    emissions : xarray.DataArray
+        Emissions in Gt CO2e per year, with a Year dimension.
+    tolerance : float
+        Quantisation step, in Gt CO2e per year.
+
+    Returns
+    -------
+    key : tuple
+        Tuple containing the years and the quantised emissions.
+    """
+
+    years = tuple(int(year) for year in emissions.Year.values)
+    levels = tuple(np.round(emissions.values / tolerance).astype(np.int64))
+
+    return (years, tolerance, levels)
+
+def fair_batch(emissions_list):
+    """Runs FaIR on a set of CO2 emissions trajectories in a single call.
+
+    Uses the same configuration as agrifoodpy's fair_co2_only, with one FaIR
+    scenario per trajectory. All trajectories must cover the same years.
+
+    Parameters
+    ----------
+    emissions_list : list of xarray.DataArray
+        Emissions in Gt CO2e per year, with a Year dimension.
+
+    Returns
+    -------
+    responses : list of tuple
+        (T, C, F) tuple for each trajectory, with the temperature anomaly in
+        K, the CO2 concentration in ppm and the effective radiative forcing in
+        W m^-2.
+    """
+
+    from fair import FAIR
+    from fair.interface import fill, initialise
+
+    years = np.unique(emissions_list[0].Year.values)
+    for emissions in emissions_list[1:]:
+        if not np.array_equal(np.unique(emissions.Year.values), years):
+            raise ValueError("All emissions trajectories must cover the same years")
+
+    scenarios = [f"scenario_{i}" for i in range(len(emissions_list))]
+
+    f = FAIR()
+
+    # Configure method, timebounds, and labels
+    f.ghg_method = 'myhre1998'
+    f.define_time(years[0]-0.5, years[-1]+0.5, 1)
+    f.define_scenarios(scenarios)
+    f.define_configs(["default"])
+
+    # Define CO2 as the only specie
+    species = ['CO2']
+    properties = {
+        'CO2': {
+            'type': 'co2',
+            'input_mode': 'emissions',
+            'greenhouse_gas': True,
+            'aerosol_chemistry_from_emissions': False,
+            'aerosol_chemistry_from_concentration': False,
+        }}
+
+    f.define_species(species, properties)
+    f.allocate()
+
+    fill(f.climate_configs["ocean_heat_transfer"], [1.1, 1.6, 0.9],
+         config='default')
+    fill(f.climate_configs["ocean_heat_capacity"], [8, 14, 100],
+         config='default')
+    fill(f.climate_configs["deep_ocean_efficacy"], 1.1, config='default')
+
+    initialise(f.concentration, 278.3, specie='CO2')
+    initialise(f.forcing, 0)
+    initialise(f.temperature, 0)
+    initialise(f.cumulative_emissions, 0)
+    initialise(f.airborne_emissions, 0)
+
+    f.fill_species_configs()
+
+    for scenario, emissions in zip(scenarios, emissions_list):
+        f.emissions.loc[{"scenario":scenario,
+                         "specie":"CO2",
+                         "config":"default"}] = emissions.sortby("Year").to_numpy()
+
+    f.run(progress=False)
+
+    T_all = f.temperature.sel(config="default", layer=0)
+    C_all = f.concentration.sel(config="default", specie="CO2")
+    F_all = f.forcing.sel(config="default", specie="CO2")
+
+    responses = []
+    for scenario in scenarios:
+        T = T_all.sel(scenario=scenario).drop_vars(["scenario", "config", "layer"])
+        C = C_all.sel(scenario=scenario).drop_vars(["scenario", "config", "specie"])
+        F = F_all.sel(scenario=scenario).drop_vars(["scenario", "config", "specie"])
+        responses.append((T, C, F))
+
+    return responses
+
+def fair_responses(emissions_list, tolerance=fair_tolerance):
+    """Returns the FaIR response for a set of emissions trajectories, using
+    cached results where available.
+
+    Trajectories are matched to the cache after quantising them to the
+    tolerance, and all the trajectories missing from the cache are evaluated
+    together in batched FaIR runs, one per set of years.
+
+    Parameters
+    ----------
+    emissions_list : list of xarray.DataArray
+        Emissions in Gt CO2e per year, with a Year dimension.
+    tolerance : float
+        Quantisation step, in Gt CO2e per year.
+
+    Returns
+    -------
+    responses : list of tuple
+        (T, C, F) tuple for each trajectory.
+    """
+
+    keys = [emissions_key(emissions, tolerance) for emissions in emissions_list]
+
+    # Group the missing trajectories by year range, evaluating each distinct
+    # quantised trajectory only once
+    found = {}
+    missing = {}
+    with _fair_lock:
+        for key, emissions in zip(keys, emissions_list):
+            if key in _fair_cache:
+                _fair_cache.move_to_end(key)
+                found[key] = _fair_cache[key]
+            else:
+                missing.setdefault(key[0], {}).setdefault(key, emissions)
+
+    # FaIR runs outside the lock, so other sessions are not blocked by them
+    for group in missing.values():
+        group_keys = list(group.keys())
+        found.update(zip(group_keys, fair_batch(list(group.values()))))
+
+    with _fair_lock:
+        for group in missing.values():
+            for key in group:
+                _fair_cache[key] = found[key]
+
+        while len(_fair_cache) > fair_cache_size:
+            _fair_cache.popitem(last=False)
+
+    return [found[key] for key in keys]
+
+def fair_response(emissions, tolerance=fair_tolerance):
+    """Returns the cached FaIR (T, C, F) response for a single emissions
+    trajectory in Gt CO2e per year."""
+
+    return fair_responses([emissions], tolerance)[0]
@@ -4,10 +4,173 @@ import numpy as np
 import pandas as pd
 import streamlit as st
 from glossary import *
+from grouping import membership_matrix
 
 import base64
+import functools
+import json
+import logging
+import threading
+import pyarrow as pa
+from concurrent.futures import ThreadPoolExecutor
 from io import BytesIO
 from PIL import Image
+from streamlit.runtime.scriptrunner import get_script_run_ctx
+try:
+    from streamlit.runtime.scriptrunner_utils.script_run_context import SCRIPT_RUN_CONTEXT_ATTR_NAME
+except ImportError:
+    from streamlit.runtime.scriptrunner.script_run_context import SCRIPT_RUN_CONTEXT_ATTR_NAME
+
+logger = logging.getLogger(__name__)
+
+# Bounded pool shared by all sessions, on which the charts of a view are
+# prepared concurrently
+chart_workers = 4
+chart_pool = ThreadPoolExecutor(max_workers=chart_workers, thread_name_prefix="charts")
+
+# Altair themes are global, so they are switched by one thread at a time
+theme_lock = threading.Lock()
+
+def build_charts(jobs):
+    """Prepares independent charts concurrently on the chart thread pool.
+
+    Jobs must not call Streamlit layout functions or read the session state,
+    so the layout code places the finished charts once they are all ready.
+
+    Parameters
+    ----------
+    jobs : dict
+        Functions without arguments, such as functools.partial objects,
+        which build each chart.
+
+    Returns
+    -------
+    charts : dict
+        Result of each job, with the same keys as jobs. Exceptions raised by
+        a job are raised again here.
+    """
+
+    ctx = get_script_run_ctx()
+
+    def run(job):
+        # Streamlit caches called by the jobs need the session context. Pool
+        # threads are shared by all sessions, so the context of the submitting
+        # session, or its absence, is set for the job only
+        thread = threading.current_thread()
+        previous = getattr(thread, SCRIPT_RUN_CONTEXT_ATTR_NAME, None)
+        setattr(thread, SCRIPT_RUN_CONTEXT_ATTR_NAME, ctx)
+        try:
+            return job()
+        finally:
+            setattr(thread, SCRIPT_RUN_CONTEXT_ATTR_NAME, previous)
+
+    futures = {name:chart_pool.submit(run, job) for name, job in jobs.items()}
+
+    return {name:future.result() for name, future in futures.items()}
+
+def year_charts(datablock, build, *settings):
+    """Returns the charts of a panel for every evaluated year, so that the
+    metric year can be scrubbed with a lookup.
+
+    The charts are built once for each evaluated datablock and set of
+    display settings, and kept in the session state until the pipeline is
+    evaluated again. Evaluated datablocks are shared between sessions by the
+    result cache, so the charts are not stored in them.
+
+    Parameters
+    ----------
+    datablock : dict
+        The evaluated datablock.
+    build : function
+        Function of the datablock and the settings which builds the charts.
+    *settings
+        Display settings the charts depend on.
+    """
+
+    # Charts are cached for the pipeline key of the evaluated datablock
+    evaluated = st.session_state.get("evaluated_pipeline", {})
+    if evaluated.get("datablock") is not datablock:
+        return build(datablock, *settings)
+
+    cache = st.session_state.get("year_charts")
+    if cache is None or cache["key"] != evaluated["key"]:
+        cache = {"key":evaluated["key"], "charts":{}}
+        st.session_state["year_charts"] = cache
+
+    key = (build.__name__, *settings)
+    if key not in cache["charts"]:
+        cache["charts"][key] = build(datablock, *settings)
+
+    return cache["charts"][key]
+
+def nearest_year(years, year):
+    """Returns the year closest to the given one among a set of years"""
+
+    years = np.asarray(years)
+    return years[np.argmin(np.abs(years - year))].item()
+
+def quantise(values, decimals=2):
+    """Rounds chart values to their display precision.
+
+    The rounded values are stored in single precision when it keeps them
+    exact to the given number of decimals, which halves their size in the
+    Arrow payload sent to the browser.
+    """
+
+    values = np.round(np.asarray(values, dtype=float), decimals)
+    single = values.astype(np.float32)
+
+    if np.all(np.abs(single - values) <= 0.5 * 10.0**-decimals):
+        return single
+
+    return values
+
+def chart_data(da, show, keep=(), decimals=2):
+    """Aggregates a dataarray to the marks drawn by a chart.
+
+    Values are summed over every dimension not in keep, grouping them by the
+    show coordinate, so the chart receives one row per mark instead of the
+    full array and does not need to aggregate in the browser.
+
+    Parameters
+    ----------
+    da : xarray.DataArray
+        The dataarray to be aggregated. NaN values are treated as zero.
+    show : str
+        The coordinate used to group the values. It can be a dimension or a
+        coordinate along a dimension, such as Item_origin.
+    keep : list, optional
+        Dimensions which are kept in the output, such as Year.
+    decimals : int, optional
+        Display precision of the values, see quantise.
+
+    Returns
+    -------
+    df : pandas.DataFrame
+        DataFrame with the show coordinate, the kept dimensions and a value
+        column.
+    """
+
+    keep = list(keep)
+    group_dim = da[show].dims[0]
+    other = [d for d in da.dims if d != group_dim and d not in keep]
+
+    values = da.fillna(0).sum(dim=other).transpose(group_dim, *keep).values
+    values = values.reshape(values.shape[0], -1)
+
+    # Group sums as a single product with the sparse membership matrix
+    groups, membership = membership_matrix(da[show].values, sort=False)
+    sums = membership @ values
+
+    shape = (len(groups),) + tuple(da.sizes[d] for d in keep)
+    index = np.unravel_index(np.arange(sums.size), shape)
+
+    df = {show:np.asarray(groups)[index[0]]}
+    for d, i in zip(keep, index[1:]):
+        df[d] = da[d].values[i]
+    df["value"] = quantise(sums.ravel(), decimals)
+
+    return pd.DataFrame(df)
 
 def plot_years_altair(food, show="Item", ylabel=None, colors=None, ymin=None, ymax=None):
     """Plots a stacked area chart for the given xarray dataarray using altair.
@@ -41,8 +204,7 @@ def plot_years_altair(food, show="Item", ylabel=None, colors=None, ymin=None, ym
         if ymin > 0: ymin = 0
 
     # Create dataframe for altair
-    df = food.to_dataframe().reset_index().fillna(0)
-    df = df.melt(id_vars=sum_dims, value_vars=food.name)
+    df = chart_data(food, show, keep=["Year"])
 
 #     selection = alt.selection_multi(fields=[show])
     selection = alt.selection_point(on='mouseover')
@@ -55,14 +217,14 @@ def plot_years_altair(food, show="Item", ylabel=None, colors=None, ymin=None, ym
 
     # Create altair chart
     c = alt.Chart(df).mark_area().encode(
-            x=alt.X('Year:O', axis=alt.Axis(values = np.linspace(2020, 2050, 5))),
-            y=alt.Y('sum(value):Q', axis=alt.Axis(format="~s", title=ylabel, ), scale=alt.Scale(domain=[ymin, ymax])),
+            x=alt.X('Year:O', axis=alt.Axis(values = np.linspace(food.Year.values[0], food.Year.values[-1], 5))),
+            y=alt.Y('value:Q', axis=alt.Axis(format="~s", title=ylabel, ), scale=alt.Scale(domain=[ymin, ymax])),
             # color=alt.Color(f'{show}:N', scale=alt.Scale(scheme='category20b')),
             color=alt.Color(f'{show}:N', scale=color_scale),
             # opacity=alt.condition(selection, alt.value(0.5), alt.value(0.8)),
             tooltip=[alt.Tooltip(f'{show}:N', title=show.replace("_", " ")),
                      alt.Tooltip('Year'),
-                     alt.Tooltip('sum(value)', title='Total', format=".2f")],
+                     alt.Tooltip('value:Q', title='Total', format=".2f")],
             ).add_params(selection).properties(height=550)
     
     return c
@@ -100,11 +262,11 @@ def plot_years_total(food, ylabel=None, sumdim=None, color="red", yrange=None):
         yrange = [0, float(total.max().values)]
 
     scale = alt.Scale(domain=[yrange[0], yrange[1]])
-    y_ax = alt.Y('sum(value):Q', axis=alt.Axis(format="~s", title=ylabel), scale=scale)
+    y_ax = alt.Y('value:Q', axis=alt.Axis(format="~s", title=ylabel), scale=scale)
 
-    df = pd.DataFrame(data={"Year":years, "value":total})
+    df = pd.DataFrame(data={"Year":years, "value":quantise(total)})
     c = alt.Chart(df).encode(
-        alt.X('Year:O', axis=alt.Axis(values = np.linspace(2020, 2050, 5))),
+        alt.X('Year:O', axis=alt.Axis(values = np.linspace(years[0], years[-1], 5))),
         y_ax
     ).mark_line(color=color).properties(height=550)
 
@@ -138,8 +300,11 @@ def plot_bars_altair(food, show="Item", x_axis_title='', xlimit=None, labels=Non
 
     n_origins = len(food.Item.values)
 
-    df = food.to_dataframe().reset_index().fillna(0)
-    df = df.melt(id_vars=show, value_vars=["production", "imports", "exports", "stock", "losses", "processing", "other", "feed", "seed", "food"])
+    elements = ["production", "imports", "exports", "stock", "losses", "processing", "other", "feed", "seed", "food"]
+    element_data = [chart_data(food[element], show) for element in elements]
+    df = pd.DataFrame({show:np.concatenate([data[show].values for data in element_data]),
+                       "variable":np.repeat(elements, [len(data) for data in element_data]),
+                       "value":np.concatenate([data["value"].values for data in element_data])})
     df["value_start"] = 0.
     df["value_end"] = 0.
 
@@ -197,15 +362,23 @@ def plot_bars_altair(food, show="Item", x_axis_title='', xlimit=None, labels=Non
 
     return c
 
-def plot_land_altair(land):
+def plot_land_altair(land, max_size=250):
     """Creates an Altair chart from a land DataArray
 
     Parameters
     ----------
     land : xarray.DataArray        
         The land use dataarray to be plotted.
+    max_size : int, optional
+        Maximum number of rects along each side of the chart. Larger maps are
+        averaged over blocks of cells, so the chart size does not depend on
+        the map resolution.
     """
 
+    factor = int(np.ceil(max(land.sizes["x"], land.sizes["y"]) / max_size))
+    if factor > 1:
+        land = land.coarsen(x=factor, y=factor, boundary="pad").mean()
+
     df = land.to_dataframe().reset_index()
     df = df.melt(id_vars = ['x', 'y'], value_vars = 'grade')
     c = alt.Chart(df).mark_rect().encode(
@@ -217,122 +390,214 @@ def plot_land_altair(land):
 
     return c
 
-def plot_single_bar_altair(da, show="Item", axis_title=None,
-                                    ax_min=None, ax_max=None, unit="",
-                                    vertical=True, mark_total=False,
-                                    bar_width=80, show_zero=False,
-                                    ax_ticks=False, color=None, legend=False,
-                                    reference=None):
-    
-    """Creates a single bar chart using Altair to visualize the given dataarray.
+@functools.lru_cache(maxsize=8)
+def zone_bars_template(zone, show, unit):
+    """Builds the Vega-Lite template of a zone stacked bar chart, reading the
+    "data" named dataset"""
+
+    c = alt.Chart(alt.Data(name="data")).transform_calculate(
+        value_with_unit=unit_label("value", unit)
+    ).mark_bar().encode(
+        x=alt.X("value:Q", title=f"Area [{unit}]"),
+        y=alt.Y(f"{zone}:N", title=zone, sort=None),
+        color=alt.Color(f"{show}:N",
+                        title="Land type",
+                        scale=alt.Scale(domain=list(land_color_dict.keys()),
+                                        range=list(land_color_dict.values()))),
+        tooltip=[alt.Tooltip(f'{zone}:N'),
+                 alt.Tooltip(f'{show}:N'),
+                 alt.Tooltip('value_with_unit:N', title='Total')],
+    )
+
+    return template_spec(c)
+
+def plot_zone_bars_altair(da, zone, show="aggregate_class", unit=""):
+    """Creates a stacked bar chart of land class totals on each zone of a
+    zone layer.
 
     Parameters
     ----------
     da : xarray.DataArray
-        The dataarray to be plotted.
+        Class totals, with the zone and class dimensions.
+    zone : str
+        Name of the zone dimension, shown on the vertical axis.
     show : str, optional
-        The coordinate to use to dissagregate the bars.
-    axis_title : str, optional
-        The title for the x or y axis.
-    ax_min, ax_max : float, optional
-        The minimum and maximum values for the y or x axis.
+        The class dimension used to colour the bars.
     unit : str, optional
-        The units of the quantity to be displayed in the tooltip.
-    vertical : bool, optional
-        If True, the chart is vertical, otherwise it is horizontal.
-    mark_total : bool, optional
-        If True, a marker for the total value is added to the chart.
-    bar_width : int, optional
-        The width of the bars in the chart.
-    show_zero : bool, optional
-        If True, a marker for the zero value is added to the chart.
-    ax_ticks : bool, optional
-        If True, the axis ticks are displayed.
-    color : dict, optional
-        A dictionary mapping the show values to colors.
-    legend : bool, optional
-        If True, a legend is displayed.
-    reference : float, optional
-        A reference value to add to the chart.
+        The unit of the quantity to be displayed in the tooltip.
 
     Returns
     -------
-    alt.Chart
-        An Altair chart object representing the single bar chart
+    dict
+        Vega-Lite spec of the chart, to be displayed with st.vega_lite_chart
     """
-    
-    df_pos = da.where(da>0).to_dataframe().reset_index().fillna(0)
-    df_neg = da.where(da<0).to_dataframe().reset_index().fillna(0)
 
-    df_pos = df_pos.melt(id_vars=show, value_vars=da.name)
-    df_neg = df_neg.melt(id_vars=show, value_vars=da.name)
-    
-    # Create a new column for the tooltip with units
-    df_pos['value_with_unit'] = df_pos['value'].apply(lambda x: f"{x:.2f} {unit}")
-    df_pos['order'] = np.arange(len(da[show].values))
-    df_neg['value_with_unit'] = df_neg['value'].apply(lambda x: f"{x:.2f} {unit}")
-    df_neg['order'] = np.arange(len(da[show].values))
+    df = chart_data(da, show, keep=[zone])
+    df[zone] = df[zone].astype(str)
+
+    return chart_spec(zone_bars_template(zone, show, unit), {"data":df})
+
+@functools.lru_cache(maxsize=1)
+def ssr_gauge_template():
+    """Builds the Vega-Lite template of the self-sufficiency gauge, reading
+    the "bands" and "ssr" named datasets"""
+
+    bars = alt.Chart(alt.Data(name="bands")).mark_bar().encode(
+        x=alt.X("sum(value):Q",
+                title="Self-sufficiency ratio",
+                axis=alt.Axis(labels=False)),
+        color=alt.Color("Item:N",
+                        title=None,
+                        legend=None,
+                        scale=alt.Scale(domain=["High", "Mid", "Low"],
+                                        range=["#008000", "#FF8800", "#FF0000"])),
+        tooltip="Item:N",
+        order=alt.Order("value:Q", sort="descending")
+    ).properties(height=80)
+
+    ssr_line = alt.Chart(alt.Data(name="ssr")).mark_rule().encode(
+        x='Self-sufficiency ratio:Q',
+        tooltip='Self-sufficiency ratio:Q',
+        color=alt.Color('color:N', scale=None),
+        strokeWidth=alt.value(4)
+    )
 
-    for df in [df_pos, df_neg]:
-        df[show] = df[show].replace("Vegetal Products", "Plant Products")
-        df[show] = df[show].replace("Cukltured Product", "Alternative Products")
+    ref_line = alt.Chart(pd.DataFrame({
+                'value': 0.682,
+                'color': ['blue']
+                })).mark_rule(
+                    color="blue",
+                    thickness=1,
+                ).encode(x="value:Q")
 
-    # Set yaxis limits
-    if ax_max is None:
-        ax_max = da.where(da>0).sum(dim=show).max().item()
-    if ax_min is None:
-        ax_min = np.min([da.where(da<0).sum(dim=show).min().item(), 0])
+    return template_spec(bars + ssr_line + ref_line)
+
+def plot_ssr_gauge_altair(ssr, ssr_ref):
+    """Creates a horizontal gauge with the self-sufficiency ratio of the
+    metric year, over low, mid and high bands set by the reference ratio.
+
+    Parameters
+    ----------
+    ssr : float
+        Self-sufficiency ratio to mark on the gauge.
+    ssr_ref : float
+        Reference self-sufficiency ratio.
+
+    Returns
+    -------
+    dict
+        Vega-Lite spec of the gauge, to be displayed with st.vega_lite_chart
+    """
+
+    bands = pd.DataFrame({"Item":["Low", "Mid", "High"],
+                          "variable":["SSR", "SSR", "SSR"],
+                          "value":[float(ssr_ref), float(1-ssr_ref), 0.2]})
+
+    ssr = pd.DataFrame({'Self-sufficiency ratio': [float(ssr)],
+                        'color': ['black']})
+
+    return chart_spec(ssr_gauge_template(), {"bands":bands, "ssr":ssr})
+
+def chart_spec(template, datasets, params=None):
+    """Returns a Vega-Lite spec from a cached chart template and the named
+    datasets it reads, to be displayed with st.vega_lite_chart.
+
+    Templates are built once for each set of static chart parameters. Their
+    data sources are named, so a rerun only swaps the datasets and the spec
+    sent to the browser is unchanged while the parameters are the same.
+    Data dependent settings, such as axis limits, are top level Vega-Lite
+    params of the template, and their values are set from params.
+    """
+
+    spec = {**template, "datasets":{**template.get("datasets", {}), **datasets}}
+    if params:
+        spec["params"] = [{**param, "value":params[param["name"]]} if param["name"] in params else param
+                          for param in template["params"]]
+
+    return spec
+
+def unit_label(field, unit):
+    """Vega expression formatting a field to two decimals followed by a
+    unit, as shown in the chart tooltips"""
+
+    return f"format(datum.{field}, '.2f') + {json.dumps(' ' + unit)}"
+
+def template_spec(chart):
+    """Converts an Altair chart with named data sources into a Vega-Lite spec
+    dictionary, without the default Altair theme, as st.altair_chart does"""
+
+    with theme_lock:
+        if alt.theme.active == "default":
+            with alt.theme.enable("none"):
+                return chart.to_dict()
+
+        return chart.to_dict()
+
+@functools.lru_cache(maxsize=8)
+def marker_image(img_path):
+    """Returns a PNG marker image as a base64 data URL"""
+
+    pil_image = Image.open(img_path)
+    output = BytesIO()
+    pil_image.save(output, format='PNG')
+
+    return "data:image/png;base64," + base64.b64encode(output.getvalue()).decode()
+
+@functools.lru_cache(maxsize=64)
+def single_bar_template(show, variable, axis_title, unit,
+                        vertical, mark_total, bar_width, show_zero, ax_ticks,
+                        color, legend_sort, legend, reference, height):
+    """Builds the Vega-Lite template of a single bar chart. The positive and
+    negative bar segments are read from the "positive" and "negative" named
+    datasets, and the total marker from the "total" dataset. The axis limits
+    are read from the "ax_min" and "ax_max" params, so the template does not
+    depend on the data. See plot_single_bar_altair for the parameters."""
+
+    # Same scale as an explicit domain of (ax_min, ax_max)
+    scale = alt.Scale(domainMin=alt.ExprRef(expr="ax_min"),
+                      domainMax=alt.ExprRef(expr="ax_max"),
+                      nice=False, zero=False)
 
     if vertical:
-        chart_params = {"y":alt.Y('sum(value):Q',
+        chart_params = {"y":alt.Y('value:Q',
                             title=axis_title,
                             axis=alt.Axis(labels=ax_ticks),
-                            scale=alt.Scale(domain=(ax_min, ax_max))),
-                        "x":alt.X('variable', axis=alt.Axis(labels=False, title=None))}
-        icon_params = {"y": "total", "x": "variable"}
+                            scale=scale),
+                        "x":alt.X('variable:N', axis=alt.Axis(labels=False, title=None))}
+        icon_params = {"y": "total:Q", "x": "variable:N"}
     else:
-        chart_params = {"x":alt.X('sum(value):Q',
+        chart_params = {"x":alt.X('value:Q',
                             title=axis_title,
                             axis=alt.Axis(labels=ax_ticks),
-                            scale=alt.Scale(domain=(ax_min, ax_max))),
-                        "y":alt.Y('variable', axis=alt.Axis(labels=False, title=None))}
-        icon_params = {"x": "total", "y": "variable"}
+                            scale=scale),
+                        "y":alt.Y('variable:N', axis=alt.Axis(labels=False, title=None))}
+        icon_params = {"x": "total:Q", "y": "variable:N"}
 
     if color is None:
-        if legend:
-            alt_color = alt.Color(show, title=None, scale=alt.Scale(scheme='category20b'),
-                                  sort=list(reversed(df_pos[show].values)))
-        else:
-            alt_color = alt.Color(show, title=None, legend=None, scale=alt.Scale(scheme='category20b'))
-    
+        scale = alt.Scale(scheme='category20b')
     else:
-        if legend:
-            alt_color = alt.Color(show, title=None, scale=alt.Scale(domain=color.keys(),
-                                  range=color.values()), sort=list(reversed(df_pos[show].values)))
-        else:
-            alt_color = alt.Color(show, title=None, legend=None, scale=alt.Scale(domain=color.keys(),
-                                          range=color.values()))
-
-    # Plot positive values
-    c = alt.Chart(df_pos).mark_bar().encode(
-        **chart_params,
-        color=alt_color,
-        tooltip=[alt.Tooltip(f'{show}:N'),
-                 alt.Tooltip('value_with_unit:N', title='Total')],
-        order=alt.Order(f'order:N', sort='ascending')
-    )
+        color = dict(color)
+        scale = alt.Scale(domain=list(color.keys()), range=list(color.values()))
 
-    # Plot negative values
-    c += alt.Chart(df_neg).mark_bar().encode(
+    if legend:
+        alt_color = alt.Color(f'{show}:N', title=None, scale=scale, sort=list(legend_sort))
+    else:
+        alt_color = alt.Color(f'{show}:N', title=None, legend=None, scale=scale)
+
+    # Plot positive and negative values. Tooltips with units are formatted in
+    # the browser
+    c = alt.layer(*[alt.Chart(alt.Data(name=name)).transform_calculate(
+        value_with_unit=unit_label("value", unit)
+    ).mark_bar().encode(
         **chart_params,
         color=alt_color,
         tooltip=[alt.Tooltip(f'{show}:N'),
                  alt.Tooltip('value_with_unit:N', title='Total')],
         order=alt.Order(f'order:N', sort='ascending')
-    )
+    ) for name in ["positive", "negative"]])
 
     # Add a line for arbitrary reference
-    zero_line_params = {"y": "value"} if vertical else {"x": "value"}
+    zero_line_params = {"y": "value:Q"} if vertical else {"x": "value:Q"}
     if reference is not None:
         c += alt.Chart(pd.DataFrame({
             'value': reference,
@@ -346,42 +611,22 @@ def plot_single_bar_altair(da, show="Item", axis_title=None,
         )
 
     # Add a marker for the total
-    if mark_total == True:
-
-        img_path = "images/rhomboid.png"
-        pil_image = Image.open(img_path)
-        output = BytesIO()
-        pil_image.save(output, format='PNG')
-
-        base64_img = "data:image/png;base64," + base64.b64encode(output.getvalue()).decode()
-
-        total = da.sum(dim=show).item()
-        source = pd.DataFrame.from_records([
-            {"variable": da.name, "total": total, "total_with_unit": f"{total:.2f} {unit}",
-            "img": base64_img},
-        ])        
-
-        c += alt.Chart(source).mark_image(
+    if mark_total:
+        c += alt.Chart(alt.Data(name="total")).transform_calculate(
+            total_with_unit=unit_label("total", unit)
+        ).mark_image(
             width=25,
             height=25
         ).encode(
             **icon_params,
-            url='img',
+            url=alt.value(marker_image("images/rhomboid.png")),
             tooltip=[alt.Tooltip('total_with_unit:N', title='Total')]
         )
-    
+
     # Add a line for zero
-    if show_zero == True:
-        img_path = "images/small_marker.png"
-        pil_image = Image.open(img_path)
-        output = BytesIO()
-        pil_image.save(output, format='PNG')
-        base64_img = "data:image/png;base64," + base64.b64encode(output.getvalue()).decode()
-
-        total = 0
+    if show_zero:
         source = pd.DataFrame.from_records([
-            {"variable": da.name, "total": total, "total_with_unit": f"{total:.2f} {unit}",
-            "img": base64_img},
+            {"variable": variable, "total": 0, "total_with_unit": f"{0:.2f} {unit}"},
         ])
 
         c += alt.Chart(source).mark_image(
@@ -389,46 +634,132 @@ def plot_single_bar_altair(da, show="Item", axis_title=None,
             height=25
         ).encode(
             **icon_params,
-            url='img',
+            url=alt.value(marker_image("images/small_marker.png")),
             tooltip=[alt.Tooltip('total_with_unit:N', title='Total')]
         )
 
-
-
     # Set bar width
     if vertical:
         c = c.properties(width=bar_width)
     else:
         c = c.properties(height=bar_width)
 
-    return c
+    if height is not None:
+        c = c.properties(height=height)
 
-def pie_chart_altair(da, show="Item", unit=""):
-    """Creates a pie chart using Altair to visualize the given dataarray.
+    c = c.add_params(alt.param(name="ax_min", value=0.),
+                     alt.param(name="ax_max", value=1.))
+
+    return template_spec(c)
+
+def plot_single_bar_altair(da, show="Item", axis_title=None,
+                                    ax_min=None, ax_max=None, unit="",
+                                    vertical=True, mark_total=False,
+                                    bar_width=80, show_zero=False,
+                                    ax_ticks=False, color=None, legend=False,
+                                    reference=None, height=None, dim=None):
+    
+    """Creates a single bar chart to visualize the given dataarray.
 
     Parameters
     ----------
     da : xarray.DataArray
         The dataarray to be plotted.
     show : str, optional
-        The coordinate to use to dissagregate the pie chart.
+        The coordinate to use to dissagregate the bars.
+    axis_title : str, optional
+        The title for the x or y axis.
+    ax_min, ax_max : float, optional
+        The minimum and maximum values for the y or x axis.
     unit : str, optional
-        The unit of the quantity to be displayed in the tooltip.
+        The units of the quantity to be displayed in the tooltip.
+    vertical : bool, optional
+        If True, the chart is vertical, otherwise it is horizontal.
+    mark_total : bool, optional
+        If True, a marker for the total value is added to the chart.
+    bar_width : int, optional
+        The width of the bars in the chart.
+    show_zero : bool, optional
+        If True, a marker for the zero value is added to the chart.
+    ax_ticks : bool, optional
+        If True, the axis ticks are displayed.
+    color : dict, optional
+        A dictionary mapping the show values to colors.
+    legend : bool, optional
+        If True, a legend is displayed.
+    reference : float, optional
+        A reference value to add to the chart.
+    height : int, optional
+        Height of the chart.
+    dim : str, optional
+        Dimension along which a chart is built for each value, such as Year.
+        The data of every chart is aggregated in a single pass, and the
+        charts share their template and axis limits.
 
     Returns
     -------
-    alt.Chart
-        An Altair chart object representing the pie chart.
+    dict
+        Vega-Lite spec of the single bar chart, to be displayed with
+        st.vega_lite_chart. If dim is given, a dictionary with the spec of
+        each value of dim.
     """
 
-    df = da.to_dataframe().reset_index().fillna(0)
-    df = df.melt(id_vars=show, value_vars=da.name)
-    df["order"] = np.arange(len(da[show].values))
-    df['value_with_unit'] = df['value'].apply(lambda x: f"{x:.2f} {unit}")
+    keep = () if dim is None else (dim,)
+    df_pos = chart_data(da.where(da>0), show, keep)
+    df_neg = chart_data(da.where(da<0), show, keep)
+
+    for df in [df_pos, df_neg]:
+        df[show] = df[show].replace("Vegetal Products", "Plant Products")
+        df[show] = df[show].replace("Cukltured Product", "Alternative Products")
 
-    c = alt.Chart(df).mark_arc().encode(
+    # Set yaxis limits
+    if ax_max is None:
+        ax_max = da.where(da>0).sum(dim=show).max().item()
+    if ax_min is None:
+        ax_min = np.min([da.where(da<0).sum(dim=show).min().item(), 0])
+
+    # Rows are ordered by mark, then by value of dim
+    values = [None] if dim is None else da[dim].values
+    marks = df_pos[show].values[::len(values)]
+
+    template = single_bar_template(show, da.name, axis_title, unit,
+                                   vertical, mark_total, bar_width, show_zero, ax_ticks,
+                                   None if color is None else tuple(color.items()),
+                                   tuple(reversed(marks)), legend,
+                                   reference, height)
+
+    if mark_total:
+        totals = np.atleast_1d(da.sum(dim=show).values)
+
+    specs = {}
+    for i, value in enumerate(values):
+        datasets = {}
+        for name, df in [("positive", df_pos), ("negative", df_neg)]:
+            df = df.iloc[i::len(values)].drop(columns=list(keep)).reset_index(drop=True)
+            df.insert(1, "variable", da.name)
+            df['order'] = np.arange(len(df))
+            datasets[name] = df
+
+        if mark_total:
+            datasets["total"] = pd.DataFrame.from_records([
+                {"variable": da.name, "total": totals[i]},
+            ])
+
+        specs[value] = chart_spec(template, datasets,
+                                  {"ax_min":float(ax_min), "ax_max":float(ax_max)})
+
+    return specs[None] if dim is None else specs
+
+@functools.lru_cache(maxsize=8)
+def pie_chart_template(show, unit):
+    """Builds the Vega-Lite template of a land use pie chart, reading the
+    "data" named dataset"""
+
+    c = alt.Chart(alt.Data(name="data")).transform_calculate(
+        value_with_unit=unit_label("value", unit)
+    ).mark_arc().encode(
         theta=alt.Theta("value:Q", sort=None),
-        color=alt.Color(show,
+        color=alt.Color(f"{show}:N",
                         title="Land type",
                         scale=alt.Scale(domain=list(land_color_dict.keys()),
                                         range=list(land_color_dict.values()))),
@@ -437,4 +768,111 @@ def pie_chart_altair(da, show="Item", unit=""):
         order=alt.Order(f'order:N', sort='ascending')
     ).resolve_scale(theta='independent')
 
-    return c
\ No newline at end of file
+    return template_spec(c)
+
+def pie_chart_altair(da, show="Item", unit=""):
+    """Creates a pie chart to visualize the given dataarray.
+
+    Parameters
+    ----------
+    da : xarray.DataArray
+        The dataarray to be plotted.
+    show : str, optional
+        The coordinate to use to dissagregate the pie chart.
+    unit : str, optional
+        The unit of the quantity to be displayed in the tooltip.
+
+    Returns
+    -------
+    dict
+        Vega-Lite spec of the pie chart, to be displayed with
+        st.vega_lite_chart
+    """
+
+    df = chart_data(da, show)
+    df.insert(1, "variable", da.name)
+    df["order"] = np.arange(len(df))
+
+    return chart_spec(pie_chart_template(show, unit), {"data":df})
+
+def dataset_bytes(data):
+    """Size in bytes of a chart dataset serialised in Arrow format"""
+
+    table = pa.Table.from_pandas(pd.DataFrame(data), preserve_index=False)
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+
+    return sink.getvalue().size
+
+def chart_payload_size(chart):
+    """Returns the serialised size in bytes of a chart sent to the browser,
+    as the JSON spec plus its datasets in Arrow format.
+
+    Parameters
+    ----------
+    chart : dict or altair.Chart
+        Vega-Lite spec or Altair chart.
+    """
+
+    if not isinstance(chart, dict):
+        with alt.data_transformers.enable("default", max_rows=None):
+            chart = template_spec(chart)
+
+    spec = {key:value for key, value in chart.items() if key != "datasets"}
+    size = len(json.dumps(spec, default=str).encode())
+    for data in chart.get("datasets", {}).values():
+        size += dataset_bytes(data)
+
+    return size
+
+def record_payload(name, size):
+    """Records the payload size of a chart of the open view in
+    st.session_state["payload_sizes"], and logs it"""
+
+    view = st.session_state.get("plot_key")
+    st.session_state.setdefault("payload_sizes", {}).setdefault(view, {})[name] = size
+    logger.info("Payload of '%s' in view '%s': %d bytes", name, view, size)
+
+def reset_payloads(view):
+    """Clears the recorded payload sizes of a view before it is drawn"""
+
+    st.session_state.setdefault("payload_sizes", {})[view] = {}
+
+def payload_report(view):
+    """Returns the recorded payload sizes of a view as a DataFrame"""
+
+    sizes = st.session_state.get("payload_sizes", {}).get(view, {})
+    return pd.DataFrame({"Chart":list(sizes.keys()),
+                         "Size [kB]":np.array(list(sizes.values())) / 1e3})
+
+def show_chart(chart, name, **kwargs):
+    """Displays an Altair chart or a Vega-Lite spec. If payload debugging is
+    enabled, its serialised size is recorded under name.
+
+    Parameters
+    ----------
+    chart : dict or altair.Chart
+        Vega-Lite spec or Altair chart.
+    name : str
+        Name of the chart in the payload report.
+    **kwargs
+        Arguments passed to st.vega_lite_chart or st.altair_chart.
+    """
+
+    if st.session_state.get("debug_payloads", False):
+        record_payload(name, chart_payload_size(chart))
+
+    if isinstance(chart, dict):
+        st.vega_lite_chart(chart, **kwargs)
+    else:
+        st.altair_chart(chart, **kwargs)
+
+def show_image(image, name, **kwargs):
+    """Displays an encoded image with st.image. If payload debugging is
+    enabled, its size is recorded under name."""
+
+    if st.session_state.get("debug_payloads", False):
+        record_payload(name, len(image))
+
+    st.image(image, **kwargs)
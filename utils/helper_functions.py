@@ -132,6 +132,9 @@ def change_to_afolu_only():
 def update_SSR_metric():
     st.session_state.ssr_metric = st.session_state.update_ssr_metric
 
+def update_metric_year():
+    st.session_state.metric_year = st.session_state.update_metric_year
+
 def update_plot_key():
     st.session_state.plot_key = st.session_state.update_plot_key
 
@@ -217,5 +220,15 @@ def set_advanced_settings():
         st.session_state.emission_factors = "NDC 2020"
     if "population_projection" not in st.session_state:    
         st.session_state.population_projection = "Medium"
+    if "horizon" not in st.session_state:
+        st.session_state.horizon = 2050
+    if "land_priority" not in st.session_state:
+        st.session_state.land_priority = "uniform"
+    if "sequestration_model" not in st.session_state:
+        st.session_state.sequestration_model = "constant"
+    if "debug_payloads" not in st.session_state:
+        st.session_state.debug_payloads = False
+    if "debug_result_cache" not in st.session_state:
+        st.session_state.debug_result_cache = False
 
     read_advanced_settings()
\ No newline at end of file